@@ -0,0 +1,597 @@
+"""AQI threshold alerts for subscribed grid cells.
+
+A subscription (cell, threshold, hysteresis, target) fires once when its
+cell's AQI rises to `threshold` or above. It clears once the AQI falls below
+`threshold - hysteresis`, so a value hovering around the threshold does not
+notify on every refresh.
+
+Subscriptions of all cells live in columnar arrays. Two views are sorted by
+(cell, level): one on thresholds, one on clear levels. When a cell goes from
+`prev` to `new`, only subscriptions with a threshold in (prev, new] can fire,
+and only those with a clear level in (new, prev] can clear. Every other
+subscription's state is already consistent with the new value. Both ranges
+are found by binary search, one np.searchsorted call for all the cells of a
+refresh, so an evaluation costs O(cells log n + notifications) however many
+subscriptions there are.
+
+Notifications go to a sink, a callable that receives an `AlertBatch`: columns
+that become dicts only when they are iterated. See `OutboxSink`, `FileSink`
+and `sink_from_spec` below. `AlertService` shares all of this between worker
+processes through an `AlertStore` file.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+FIRED = "above"
+CLEARED = "cleared"
+
+# Levels are clipped into one stride per cell in the composite sort key
+_STRIDE = 4096.0
+_MAX_LEVEL = 4000.0
+
+
+class AlertBatch:
+    """The notifications of one evaluation, as columns."""
+    __slots__ = ("subscription", "fired", "aqi", "threshold", "cell", "targets", "cells", "time")
+
+    def __init__(self, subscription, fired, aqi, threshold, cell, targets, cells, time):
+        self.subscription = subscription
+        self.fired = fired
+        self.aqi = aqi
+        self.threshold = threshold
+        self.cell = cell
+        self.targets = targets
+        self.cells = cells
+        self.time = time
+
+    def __len__(self):
+        return len(self.subscription)
+
+    def __iter__(self):
+        for sub_id, fired, aqi, threshold, cell, target in zip(
+            self.subscription.tolist(), self.fired.tolist(), self.aqi.tolist(),
+            self.threshold.tolist(), self.cell.tolist(), self.targets,
+        ):
+            yield {
+                "subscription": sub_id,
+                "target": target,
+                "event": FIRED if fired else CLEARED,
+                "cell": list(self.cells[cell]),
+                "aqi": aqi,
+                "threshold": threshold,
+                "time": self.time,
+            }
+
+
+class FileSink:
+    """Appends notifications as JSON lines (a stand-in for a delivery queue)."""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.delivered = 0
+        self._file = open(path, "a", encoding="utf-8")
+
+    def __call__(self, batch):
+        self._file.write("".join(json.dumps(n, separators=(",", ":")) + "\n" for n in batch))
+        self._file.flush()
+        self.delivered += len(batch)
+
+    def close(self):
+        self._file.close()
+
+
+class OutboxSink:
+    """Queues the latest `maxlen` notifications in the AlertStore, for any worker to drain."""
+
+    def __init__(self, store, maxlen=10000):
+        self.store = store
+        self.maxlen = maxlen
+        self.delivered = 0
+
+    def __call__(self, batch):
+        self.store.push_notifications(list(batch), self.maxlen)
+        self.delivered += len(batch)
+
+    def drain(self, limit):
+        return self.store.take_notifications(limit)
+
+
+def sink_from_spec(spec, store):
+    """Build a sink from a spec string: "queue[:<maxlen>]" (in `store`) or "file:<path>"."""
+    kind, _, rest = (spec or "queue").partition(":")
+    if kind == "queue":
+        return OutboxSink(store, int(rest) if rest else 10000)
+    if kind == "file":
+        return FileSink(rest)
+    raise ValueError(f"Unknown alert sink: {spec!r}")
+
+
+class AlertLimitExceeded(ValueError):
+    pass
+
+
+class AlertStore:
+    """
+    SQLite file shared by every worker: subscriptions (soft-deleted, with a change
+    sequence number so the evaluating process can apply changes incrementally),
+    per-cell subscription counts, observations waiting to be evaluated and queued
+    notifications.
+    """
+
+    def __init__(self, path, max_subscriptions=1_000_000, max_cells=5000, max_per_cell=10000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_subscriptions = max_subscriptions
+        self.max_cells = max_cells
+        self.max_per_cell = max_per_cell
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10.0)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_subscriptions ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, cell_lat REAL NOT NULL, cell_lng REAL NOT NULL,"
+            " threshold REAL NOT NULL, hysteresis REAL NOT NULL, target TEXT NOT NULL,"
+            " deleted INTEGER NOT NULL DEFAULT 0, seq INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(alert_subscriptions)")}
+        if "seq" not in columns:
+            # Files from before subscriptions were shared between workers
+            self.db.execute("ALTER TABLE alert_subscriptions ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("ALTER TABLE alert_subscriptions ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("UPDATE alert_subscriptions SET seq = id")
+        self.db.execute("CREATE INDEX IF NOT EXISTS alert_subscriptions_seq ON alert_subscriptions (seq)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_cells ("
+            " cell_lat REAL NOT NULL, cell_lng REAL NOT NULL, subscriptions INTEGER NOT NULL,"
+            " PRIMARY KEY (cell_lat, cell_lng)) WITHOUT ROWID"
+        )
+        if "seq" not in columns:
+            self.db.execute(
+                "INSERT OR REPLACE INTO alert_cells SELECT cell_lat, cell_lng, COUNT(*)"
+                " FROM alert_subscriptions GROUP BY cell_lat, cell_lng"
+            )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_observations ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, cell_lat REAL NOT NULL, cell_lng REAL NOT NULL, aqi REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, notification TEXT NOT NULL)"
+        )
+
+    def _transaction(self, work):
+        with self._lock:
+            # IMMEDIATE: take the write lock up front, so checks and writes see the same counts
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self.db)
+                self.db.execute("COMMIT")
+                return result
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def add(self, cell, threshold, hysteresis, target):
+        """Store a subscription and return its id; AlertLimitExceeded if a cap is reached."""
+        def work(db):
+            row = db.execute(
+                "SELECT subscriptions FROM alert_cells WHERE cell_lat = ? AND cell_lng = ?", cell
+            ).fetchone()
+            in_cell = row[0] if row else 0
+            if in_cell >= self.max_per_cell:
+                raise AlertLimitExceeded(f"At most {self.max_per_cell} subscriptions per cell")
+            total, cells = db.execute(
+                "SELECT COALESCE(SUM(subscriptions), 0), COUNT(*) FROM alert_cells WHERE subscriptions > 0"
+            ).fetchone()
+            if total >= self.max_subscriptions:
+                raise AlertLimitExceeded(f"At most {self.max_subscriptions} subscriptions")
+            if in_cell == 0 and cells >= self.max_cells:
+                raise AlertLimitExceeded(f"At most {self.max_cells} subscribed cells")
+            db.execute(
+                "INSERT INTO alert_cells VALUES (?, ?, 1) ON CONFLICT (cell_lat, cell_lng)"
+                " DO UPDATE SET subscriptions = subscriptions + 1", cell,
+            )
+            return db.execute(
+                "INSERT INTO alert_subscriptions (cell_lat, cell_lng, threshold, hysteresis, target, seq)"
+                " VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM alert_subscriptions))",
+                (cell[0], cell[1], threshold, hysteresis, target),
+            ).lastrowid
+
+        return self._transaction(work)
+
+    def delete(self, sub_id):
+        def work(db):
+            row = db.execute(
+                "SELECT cell_lat, cell_lng FROM alert_subscriptions WHERE id = ? AND deleted = 0", (sub_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            db.execute(
+                "UPDATE alert_subscriptions SET deleted = 1,"
+                " seq = (SELECT MAX(seq) + 1 FROM alert_subscriptions) WHERE id = ?", (sub_id,)
+            )
+            db.execute(
+                "UPDATE alert_cells SET subscriptions = subscriptions - 1 WHERE cell_lat = ? AND cell_lng = ?", row
+            )
+            return True
+
+        return self._transaction(work)
+
+    def changes(self, since):
+        """(seq, id, cell, threshold, hysteresis, target, deleted) rows changed after `since`, in order."""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT seq, id, cell_lat, cell_lng, threshold, hysteresis, target, deleted"
+                " FROM alert_subscriptions WHERE seq > ? ORDER BY seq", (since,)
+            ).fetchall()
+        return [(seq, sub_id, (lat, lng), t, h, target, bool(deleted))
+                for seq, sub_id, lat, lng, t, h, target, deleted in rows]
+
+    def counts(self):
+        """(subscriptions, subscribed cells)."""
+        with self._lock:
+            return self.db.execute(
+                "SELECT COALESCE(SUM(subscriptions), 0), COUNT(*) FROM alert_cells WHERE subscriptions > 0"
+            ).fetchone()
+
+    def top_cells(self, limit):
+        """Subscribed cells, most subscribed first."""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT cell_lat, cell_lng FROM alert_cells WHERE subscriptions > 0"
+                " ORDER BY subscriptions DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [(lat, lng) for lat, lng in rows]
+
+    def add_observations(self, observations):
+        with self._lock:
+            self.db.executemany(
+                "INSERT INTO alert_observations (cell_lat, cell_lng, aqi) VALUES (?, ?, ?)",
+                [(cell[0], cell[1], aqi) for cell, aqi in observations],
+            )
+
+    def take_observations(self):
+        """Every waiting (cell, aqi), oldest first, removing them."""
+        rows = self._transaction(lambda db: db.execute(
+            "DELETE FROM alert_observations RETURNING id, cell_lat, cell_lng, aqi"
+        ).fetchall())
+        return [((lat, lng), aqi) for _, lat, lng, aqi in sorted(rows)]
+
+    def push_notifications(self, notifications, maxlen):
+        def work(db):
+            db.executemany(
+                "INSERT INTO alert_outbox (notification) VALUES (?)",
+                [(json.dumps(n, separators=(",", ":")),) for n in notifications],
+            )
+            # Keep the newest `maxlen`
+            db.execute("DELETE FROM alert_outbox WHERE id <= (SELECT MAX(id) FROM alert_outbox) - ?", (maxlen,))
+
+        self._transaction(work)
+
+    def take_notifications(self, limit):
+        rows = self._transaction(lambda db: db.execute(
+            "DELETE FROM alert_outbox WHERE id IN (SELECT id FROM alert_outbox ORDER BY id LIMIT ?)"
+            " RETURNING id, notification", (limit,)
+        ).fetchall())
+        return [json.loads(notification) for _, notification in sorted(rows)]
+
+    def close(self):
+        self.db.close()
+
+
+def _expand(lo, hi):
+    """Concatenation of arange(lo[i], hi[i]) for all i, without a Python loop."""
+    counts = hi - lo
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), counts
+    starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    return starts + np.arange(total), counts
+
+
+class _SortedView:
+    """Subscription ids sorted by (cell, level), with the composite keys searched."""
+    __slots__ = ("ids", "keys")
+
+    def __init__(self, ids, cells, levels):
+        keys = cells * _STRIDE + np.clip(levels, -1.0, _MAX_LEVEL)
+        order = np.argsort(keys, kind="stable")
+        self.ids = ids[order]
+        self.keys = keys[order]
+
+    def between(self, cells, low, high):
+        """Ids whose level is in (low[i], high[i]] for cell cells[i], and the count per cell."""
+        base = cells * _STRIDE
+        lo = np.searchsorted(self.keys, base + np.clip(low, -1.0, _MAX_LEVEL), side="right")
+        hi = np.searchsorted(self.keys, base + np.clip(high, -1.0, _MAX_LEVEL), side="right")
+        positions, counts = _expand(lo, np.maximum(hi, lo))
+        return self.ids[positions], counts
+
+
+class AlertEngine:
+    """
+    In-memory evaluation: `observe(cells, aqis)` after cells are refreshed;
+    subscriptions whose state changes are delivered to `sink` in one call.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._cell_index = {}
+        self._cells = []
+        self._last_aqi = np.full(0, np.nan)
+        capacity = 1024
+        self._sub_cell = np.zeros(capacity, dtype=np.int64)
+        self._threshold = np.zeros(capacity)
+        self._hysteresis = np.zeros(capacity)
+        self._active = np.zeros(capacity, dtype=bool)
+        self._alerting = np.zeros(capacity, dtype=bool)
+        self._targets = {}
+        self._next_id = 1
+        self._by_threshold = None
+        self._by_clear = None
+        self.evaluations = 0
+        self.fired = 0
+        self.cleared = 0
+        self.rebuilds = 0
+        self.last_duration = None
+
+    def __len__(self):
+        return len(self._targets)
+
+    def _cell(self, cell):
+        index = self._cell_index.get(cell)
+        if index is None:
+            index = self._cell_index[cell] = len(self._cells)
+            self._cells.append(cell)
+            if index >= len(self._last_aqi):
+                grown = np.full(max(64, 2 * len(self._last_aqi)), np.nan)
+                grown[:len(self._last_aqi)] = self._last_aqi
+                self._last_aqi = grown
+        return index
+
+    def _grow(self, size):
+        capacity = len(self._active)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name in ("_sub_cell", "_threshold", "_hysteresis", "_active", "_alerting"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def load(self, rows):
+        """Bulk-add (id, cell, threshold, hysteresis, target) rows, e.g. persisted ones."""
+        if not rows:
+            return
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        self._grow(int(ids.max()) + 1)
+        self._sub_cell[ids] = [self._cell(row[1]) for row in rows]
+        self._threshold[ids] = [row[2] for row in rows]
+        self._hysteresis[ids] = [row[3] for row in rows]
+        self._active[ids] = True
+        self._alerting[ids] = self._last_aqi[self._sub_cell[ids]] >= self._threshold[ids]
+        self._targets.update((row[0], row[4]) for row in rows)
+        self._next_id = max(self._next_id, int(ids.max()) + 1)
+        self._by_threshold = self._by_clear = None
+
+    def remove(self, ids):
+        """Drop subscriptions by id (unknown ids are ignored)."""
+        ids = [sub_id for sub_id in ids if self._targets.pop(sub_id, None) is not None]
+        if ids:
+            self._active[ids] = False
+            self._alerting[ids] = False
+            self._by_threshold = self._by_clear = None
+
+    def _views(self):
+        if self._by_threshold is None:
+            ids = np.flatnonzero(self._active[:self._next_id])
+            cells = self._sub_cell[ids]
+            self._by_threshold = _SortedView(ids, cells, self._threshold[ids])
+            self._by_clear = _SortedView(ids, cells, self._threshold[ids] - self._hysteresis[ids])
+            self.rebuilds += 1
+        return self._by_threshold, self._by_clear
+
+    def observe(self, cells, aqis, now=None):
+        """Record new AQI values for cells; returns the AlertBatch sent to the sink (or None)."""
+        start = time.perf_counter()
+        known = [(self._cell_index[cell], aqi) for cell, aqi in zip(cells, aqis)
+                 if cell in self._cell_index and aqi is not None]
+        if not known:
+            return None
+        index = np.fromiter((k for k, _ in known), dtype=np.int64, count=len(known))
+        new = np.fromiter((a for _, a in known), dtype=float, count=len(known))
+        prev = self._last_aqi[index]
+        self._last_aqi[index] = new
+        # Never seen before: anything at or above its threshold fires
+        prev = np.where(np.isnan(prev), -np.inf, prev)
+        by_threshold, by_clear = self._views()
+
+        rising = new > prev
+        ids, counts = by_threshold.between(index[rising], prev[rising], new[rising])
+        changed = ~self._alerting[ids]
+        fired, fired_aqi = ids[changed], np.repeat(new[rising], counts)[changed]
+        self._alerting[fired] = True
+
+        falling = new < prev
+        ids, counts = by_clear.between(index[falling], new[falling], prev[falling])
+        changed = self._alerting[ids]
+        cleared, cleared_aqi = ids[changed], np.repeat(new[falling], counts)[changed]
+        self._alerting[cleared] = False
+
+        self.evaluations += 1
+        self.fired += len(fired)
+        self.cleared += len(cleared)
+        batch = None
+        if len(fired) or len(cleared):
+            subscription = np.concatenate([fired, cleared])
+            batch = AlertBatch(
+                subscription,
+                np.arange(len(subscription)) < len(fired),
+                np.concatenate([fired_aqi, cleared_aqi]),
+                self._threshold[subscription],
+                self._sub_cell[subscription],
+                [self._targets[i] for i in subscription.tolist()],
+                self._cells,
+                time.time() if now is None else now,
+            )
+            try:
+                self.sink(batch)
+            except Exception as e:
+                print(f"Alert sink error: {e}")
+        self.last_duration = time.perf_counter() - start
+        return batch
+
+    def snapshot_stats(self):
+        return {
+            "subscriptions": len(self),
+            "cells": len(self._cells),
+            "alerting": int(self._alerting.sum()),
+            "evaluations": self.evaluations,
+            "fired": self.fired,
+            "cleared": self.cleared,
+            "index_rebuilds": self.rebuilds,
+            "last_duration_ms": round(self.last_duration * 1000, 3) if self.last_duration is not None else None,
+        }
+
+
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): every process evaluates, so run a single worker there
+    fcntl = None
+
+
+class AlertService:
+    """
+    What the API uses. Subscriptions, reported observations and queued
+    notifications all live in the shared AlertStore, so any worker can
+    subscribe, unsubscribe, report refreshed cells and drain notifications.
+    Evaluation needs every subscription's state in one place, so only the
+    worker holding an exclusive lock on the store runs the AlertEngine. Every
+    `interval` seconds it applies subscription changes and evaluates the
+    observations all workers reported. If that worker exits, another one
+    takes the lock over (alert state starts afresh there).
+    """
+
+    def __init__(self, store, sink_spec="queue", interval=1.0):
+        self.store = store
+        self.sink = sink_from_spec(sink_spec, store)
+        self.interval = interval
+        self.engine = None
+        self._seq = 0
+        self._lock_file = None
+        self._pending = []
+        self._task = None
+        # (subscriptions, subscribed cells), refreshed every step off the event loop
+        self.counts = (0, 0)
+
+    @property
+    def leader(self):
+        return self.engine is not None
+
+    async def subscribe(self, cell, threshold, hysteresis=10.0, target=""):
+        """Store a subscription; returns its id. Raises AlertLimitExceeded past the caps."""
+        return await asyncio.to_thread(
+            self.store.add, cell, float(threshold), max(0.0, float(hysteresis)), target
+        )
+
+    async def unsubscribe(self, sub_id):
+        return await asyncio.to_thread(self.store.delete, sub_id)
+
+    async def recent(self, limit):
+        """Up to `limit` queued notifications (oldest first), or None if the sink does not queue."""
+        if not isinstance(self.sink, OutboxSink):
+            return None
+        return await asyncio.to_thread(self.sink.drain, limit)
+
+    def observe(self, cells, aqis):
+        """Report refreshed cells; evaluated at the next step by whichever worker evaluates."""
+        self._pending.extend((cell, aqi) for cell, aqi in zip(cells, aqis) if aqi is not None)
+
+    async def pinned_cells(self, limit):
+        """Up to `limit` subscribed cells, most subscribed first."""
+        return await asyncio.to_thread(self.store.top_cells, limit)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._step()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Alert evaluation error: {e}")
+
+    async def _step(self):
+        observations, self._pending = self._pending, []
+        await asyncio.to_thread(self.step, observations)
+
+    def step(self, observations):
+        """Publish this worker's observations; if it is the evaluating worker, evaluate all waiting ones."""
+        if observations:
+            self.store.add_observations(observations)
+        self.counts = self.store.counts()
+        if self.engine is None and self._take_lock():
+            self.engine = AlertEngine(self.sink)
+        if self.engine is None:
+            return None
+        changes = self.store.changes(self._seq)
+        if changes:
+            # A subscription only changes when it is added or deleted
+            self.engine.remove([row[1] for row in changes if row[6]])
+            self.engine.load([row[1:6] for row in changes if not row[6]])
+            self._seq = changes[-1][0]
+        # Newest value per cell
+        latest = dict(self.store.take_observations())
+        if not latest:
+            return None
+        return self.engine.observe(list(latest), list(latest.values()))
+
+    def _take_lock(self):
+        if fcntl is None:
+            return True
+        lock_file = open(self.store.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def snapshot_stats(self):
+        subscriptions, cells = await asyncio.to_thread(self.store.counts)
+        stats = {"subscriptions": subscriptions, "cells": cells, "evaluating": self.leader}
+        if self.engine is not None:
+            stats.update(self.engine.snapshot_stats())
+            stats["subscriptions"], stats["cells"] = subscriptions, cells
+        return stats
+
+    def close(self):
+        if hasattr(self.sink, "close"):
+            self.sink.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+        self.store.close()
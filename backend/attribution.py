@@ -0,0 +1,159 @@
+"""Pollution source attribution ("pollution_sources" in AQI responses).
+
+Both directions work on source x pollutant coefficient matrices over the
+canonical POLLUTANTS columns, so N readings are attributed in one pass:
+
+- "signature" (default): fingerprint scores, scores = readings @ SIGNATURES.T
+  (plus the PM10/PM2.5 ratio term for dust), normalized to percentages.
+- "nnls": unmixes readings against simulation.IMPACT_MATRIX, the matrix
+  /simulate uses to go from source multipliers to pollutant levels. With
+  concentrations measured in REFERENCE_LEVELS, a reading is modelled as
+  activity @ IMPACT_MATRIX with non-negative per-source activity (1 = the
+  reference share), solved exactly by enumerating active sets, which for a
+  handful of sources is a few small matrix products instead of an iterative
+  solver per row.
+"""
+import itertools
+
+import numpy as np
+
+from pollutants import POLLUTANTS
+from simulation import IMPACT_MATRIX, SOURCES as IMPACT_SOURCES
+
+SIGNATURE_SOURCES = ("traffic", "industrial", "dust", "biomass", "photochemical")
+
+# Linear fingerprint weights (n_sources, n_pollutants); columns in POLLUTANTS order
+# (PM2.5, PM10, NO2, SO2, CO, O3). Based on research on pollutant fingerprints:
+SIGNATURES = np.array([
+    [0.3 / 3, 0.0, 2 / 3, 0.0, 50 / 3, 0.0],    # traffic: high NO2 + CO, moderate PM2.5
+    [0.5 / 3, 0.2 / 3, 0.0, 1.0, 0.0, 0.0],     # industrial: high SO2, elevated PM
+    [0.0, 0.0, 0.0, 0.0, 0.0, 0.0],             # dust: PM10 relative to PM2.5, see _dust_scores
+    [0.4, 0.0, 0.0, 0.0, 15.0, 0.0],            # biomass burning: high PM2.5, moderate CO
+    [0.0, 0.0, 0.0, 0.0, 0.0, 1.5],             # photochemical: high O3
+])
+
+# Shown for very clean air, where the scores say nothing
+CLEAN_AIR_DEFAULT = np.array([30, 20, 25, 15, 10])
+
+# Typical urban levels (µg/m³, CO in mg/m³) that IMPACT_MATRIX shares refer to
+REFERENCE_LEVELS = np.array([25.0, 50.0, 40.0, 20.0, 1.0, 60.0])
+
+_PM25, _PM10 = POLLUTANTS.index("PM2.5"), POLLUTANTS.index("PM10")
+_DUST = SIGNATURE_SOURCES.index("dust")
+
+
+def _as_values(readings):
+    """(n, n_pollutants) float array; missing pollutants count as zero."""
+    return np.nan_to_num(np.atleast_2d(np.asarray(readings, dtype=np.float64)), nan=0.0)
+
+
+def _dust_scores(values):
+    pm25, pm10 = values[:, _PM25], values[:, _PM10]
+    ratio = pm10 / (pm25 + 1)
+    return np.where(ratio > 1.5, pm10 * 0.5 * np.minimum(ratio, 3), pm10 * 0.1)
+
+
+def signature_scores(readings):
+    """(n, n_pollutants) readings -> (n, len(SIGNATURE_SOURCES)) raw fingerprint scores."""
+    values = _as_values(readings)
+    scores = values @ SIGNATURES.T
+    scores[:, _DUST] = _dust_scores(values)
+    return scores
+
+
+def to_percentages(scores, default=None, min_total=1.0):
+    """
+    Integer percentages per row summing to 100, by largest-remainder rounding, so
+    every share stays within 0..100. Rows totalling less than `min_total` get
+    `default` (zeros if None).
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    total = scores.sum(axis=1, keepdims=True)
+    share = np.divide(scores, total, out=np.zeros_like(scores), where=total > 0) * 100
+    percent = np.floor(share).astype(np.int64)
+    # The points lost to flooring go to the largest fractional parts, one each
+    missing = np.where(total[:, 0] > 0, 100 - percent.sum(axis=1), 0)
+    order = np.argsort(percent - share, axis=1, kind="stable")
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(scores.shape[1])[None, :].repeat(len(scores), axis=0), axis=1)
+    percent += rank < missing[:, None]
+    clean = total[:, 0] < min_total
+    percent[clean] = 0 if default is None else default
+    return percent
+
+
+def attribute(readings):
+    """Signature attribution: (n, n_pollutants) -> (n, len(SIGNATURE_SOURCES)) integer percentages."""
+    return to_percentages(signature_scores(readings), CLEAN_AIR_DEFAULT)
+
+
+def _active_sets(n_sources):
+    """Every non-empty subset of source indices (candidate NNLS supports)."""
+    for size in range(1, n_sources + 1):
+        for subset in itertools.combinations(range(n_sources), size):
+            yield list(subset)
+
+
+def unmix(readings, matrix=IMPACT_MATRIX, reference=REFERENCE_LEVELS):
+    """
+    Non-negative least squares: per row, activity >= 0 minimizing
+    ||activity @ matrix - reading / reference|| over the measured pollutants.
+    Returns ((n, n_sources) activity, (n,) residual norm).
+
+    The optimum is the unconstrained least-squares solution on its own support,
+    so it is the best feasible one among all supports; each support costs one
+    (n, p) @ (p, k) product for all rows at once.
+    """
+    raw = np.atleast_2d(np.asarray(readings, dtype=np.float64))
+    n, n_sources = len(raw), len(matrix)
+    activity = np.zeros((n, n_sources))
+    residual = np.zeros(n)
+    measured = ~np.isnan(raw)
+    x = np.nan_to_num(raw, nan=0.0) / reference
+    # Rows with the same missing pollutants share their per-support pseudo-inverses
+    masks, groups = np.unique(measured, axis=0, return_inverse=True)
+    for g, mask in enumerate(masks):
+        rows = np.flatnonzero(groups.ravel() == g)
+        xg = x[rows][:, mask]
+        A = matrix[:, mask]
+        best = np.sum(xg * xg, axis=1)  # all-zero activity
+        best_activity = np.zeros((len(rows), n_sources))
+        for subset in _active_sets(n_sources):
+            sub = A[subset]
+            if not sub.any():
+                continue
+            coef = xg @ np.linalg.pinv(sub)
+            feasible = (coef >= 0).all(axis=1)
+            r = xg - coef @ sub
+            error = np.sum(r * r, axis=1)
+            better = feasible & (error < best - 1e-12)
+            if better.any():
+                best[better] = error[better]
+                best_activity[better] = 0.0
+                best_activity[np.ix_(better, subset)] = coef[better]
+        activity[rows] = best_activity
+        residual[rows] = np.sqrt(best)
+    return activity, residual
+
+
+def unmix_percentages(readings, matrix=IMPACT_MATRIX, reference=REFERENCE_LEVELS):
+    """NNLS attribution as (n, n_sources) integer percentages of the explained (reference-scaled) load."""
+    activity, _ = unmix(readings, matrix, reference)
+    contribution = activity * matrix.sum(axis=1)
+    return to_percentages(contribution, min_total=1e-9)
+
+
+SOURCES_BY_MODE = {"signature": SIGNATURE_SOURCES, "nnls": IMPACT_SOURCES}
+
+
+def attribute_columns(readings, mode="signature"):
+    """(source names, (n, n_sources) integer percentages) for an (n, n_pollutants) array."""
+    if mode == "nnls":
+        return IMPACT_SOURCES, unmix_percentages(readings)
+    return SIGNATURE_SOURCES, attribute(readings)
+
+
+def attribute_many(readings, mode="signature"):
+    """[{source: percent}] for each row of an (n, n_pollutants) array."""
+    sources, percent = attribute_columns(readings, mode)
+    return [dict(zip(sources, row)) for row in percent.tolist()]
@@ -0,0 +1,77 @@
+"""
+Benchmark the alert engine: an hourly refresh of every subscribed cell against
+1M subscriptions, compared with scanning every subscription of the cell.
+
+Usage (from backend/):  python benchmarks/bench_alerts.py [n_subscriptions] [n_cells]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from alerts import AlertEngine
+
+
+def legacy_scan(subs, state, cells, aqis):
+    # What a straightforward implementation does: every subscription of each updated cell
+    notified = 0
+    for cell, aqi in zip(cells, aqis):
+        for sub_id, threshold, hysteresis in subs.get(cell, ()):
+            if not state[sub_id] and aqi >= threshold:
+                state[sub_id] = True
+                notified += 1
+            elif state[sub_id] and aqi < threshold - hysteresis:
+                state[sub_id] = False
+                notified += 1
+    return notified
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_cells = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    rng = np.random.default_rng(42)
+    cell_of = rng.integers(0, n_cells, n)
+    thresholds = rng.choice([50, 100, 150, 200, 300], n) + rng.integers(-10, 11, n)
+    hysteresis = rng.choice([0, 5, 10, 20], n)
+    cells = [(round(i * 0.05, 6), 0.0) for i in range(n_cells)]
+
+    print("=" * 50)
+    print(f"Alert engine benchmark: {n:,} subscriptions, {n_cells:,} cells")
+    print("=" * 50)
+
+    engine = AlertEngine(lambda batch: None)
+    start = time.perf_counter()
+    engine.load([(i + 1, cells[c], float(t), float(h), f"user-{i}")
+                 for i, (c, t, h) in enumerate(zip(cell_of.tolist(), thresholds.tolist(), hysteresis.tolist()))])
+    print(f"load:                {time.perf_counter() - start:8.3f} s")
+
+    aqi = rng.uniform(20, 250, n_cells)
+    start = time.perf_counter()
+    engine.observe(cells, aqi.tolist())
+    print(f"first refresh:       {time.perf_counter() - start:8.3f} s  (incl. index build, {engine.fired:,} fired)")
+
+    subs = {}
+    for i, (c, t, h) in enumerate(zip(cell_of.tolist(), thresholds.tolist(), hysteresis.tolist())):
+        subs.setdefault(cells[c], []).append((i + 1, t, h))
+    state = engine._alerting.copy()
+
+    for hour in range(3):
+        # Hour-to-hour drift
+        aqi = np.clip(aqi + rng.normal(0, 15, n_cells), 0, 500)
+        values = aqi.tolist()
+        start = time.perf_counter()
+        batch = engine.observe(cells, values)
+        engine_s = time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = legacy_scan(subs, state, cells, values)
+        scan_s = time.perf_counter() - start
+        notified = len(batch) if batch is not None else 0
+        assert notified == scanned, (notified, scanned)
+        print(f"hour {hour + 1}: engine {engine_s * 1000:7.1f} ms, scan {scan_s * 1000:7.1f} ms,"
+              f" {notified:,} notifications ({scan_s / engine_s:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
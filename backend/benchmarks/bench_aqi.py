@@ -0,0 +1,87 @@
+"""
+Benchmark the vectorized AQI engine against the old per-row breakpoint loop.
+
+Usage (from backend/):  python benchmarks/bench_aqi.py [n_samples]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ml"))
+import aqi_engine
+
+
+def legacy_sub_aqi(concentration, breakpoints):
+    # The loop train_model.py used before the shared engine
+    for (c_low, c_high, aqi_low, aqi_high) in breakpoints:
+        if c_low <= concentration <= c_high:
+            return ((aqi_high - aqi_low) / (c_high - c_low)) * (concentration - c_low) + aqi_low
+    return 500
+
+
+def legacy_aqi(columns):
+    names = list(columns)
+    n = len(columns[names[0]])
+    out = np.empty(n)
+    for i in range(n):
+        out[i] = max(legacy_sub_aqi(columns[name][i], aqi_engine.BREAKPOINTS[name]) for name in names)
+    return out
+
+
+def random_readings(n, seed=42):
+    rng = np.random.default_rng(seed)
+    return {
+        "PM2.5": rng.uniform(1, 400, n), "PM10": rng.uniform(2, 500, n),
+        "NO2": rng.uniform(1, 180, n), "SO2": rng.uniform(1, 150, n),
+        "CO": rng.uniform(0.05, 5, n), "O3": rng.uniform(5, 150, n),
+    }
+
+
+def timed(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_legacy = min(n, 20_000)
+    columns = random_readings(n)
+    sample = {name: values[:n_legacy] for name, values in columns.items()}
+
+    print("=" * 50)
+    print("AQI engine benchmark")
+    print("=" * 50)
+
+    legacy_s, legacy = timed(legacy_aqi, sample, repeat=1)
+    vector_s, vector = timed(aqi_engine.aqi, columns)
+    legacy_rate = n_legacy / legacy_s
+    vector_rate = n / vector_s
+    print(f"\nLegacy loop:   {n_legacy:>9,} rows in {legacy_s:.3f}s  ({legacy_rate:,.0f} rows/s)")
+    print(f"Vectorized:    {n:>9,} rows in {vector_s:.3f}s  ({vector_rate:,.0f} rows/s)")
+    print(f"Speedup:       {vector_rate / legacy_rate:,.0f}x")
+
+    # On EPA-truncated inputs the loop and the engine must agree exactly; on raw
+    # inputs the loop also returns 500 for values that fall between two bands
+    truncated = {
+        name: np.floor(values * aqi_engine.TABLES[name].scale + 1e-9) / aqi_engine.TABLES[name].scale
+        for name, values in sample.items()
+    }
+    _, legacy_truncated = timed(legacy_aqi, truncated, repeat=1)
+    max_diff = np.abs(vector[:n_legacy] - legacy_truncated).max()
+    gaps = ((legacy == 500) & (vector[:n_legacy] < 500)).sum()
+    print(f"Max difference vs loop on truncated inputs: {max_diff:.2e}")
+    print(f"Rows the loop scored 500 from a band gap:   {gaps} of {n_legacy}")
+
+    rows = [{name: float(values[i]) for name, values in columns.items()} for i in range(10_000)]
+    scalar_s, _ = timed(lambda: [aqi_engine.aqi_scalar(r) for r in rows])
+    print(f"Scalar path:   {scalar_s / len(rows) * 1e6:.2f} us per reading")
+
+
+if __name__ == "__main__":
+    main()
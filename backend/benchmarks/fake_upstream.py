@@ -0,0 +1,187 @@
+"""
+Local stand-in for the Open-Meteo Air Quality and Nominatim APIs, for load tests.
+
+Responses have the shape of the real ones (same keys, units, local-time hourly
+arrays, a list for multi-location requests) with values derived
+deterministically from the coordinates, so repeated runs see the same data.
+Latency and failures are injected per request and can be changed while it
+runs with POST /_control {"latency_ms": .., "jitter_ms": .., "failure_rate": ..,
+"hang_rate": ..}; GET /_stats returns request counters.
+
+Usage (from backend/):
+    python benchmarks/fake_upstream.py --port 8901 --latency-ms 80 --failure-rate 0.02
+    AIRZEN_OPEN_METEO_URL=http://127.0.0.1:8901 AIRZEN_NOMINATIM_URL=http://127.0.0.1:8901 uvicorn main:app
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+from datetime import datetime, timedelta, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+CURRENT_UNITS = {
+    "time": "iso8601", "interval": "seconds", "us_aqi": "USAQI", "pm10": "μg/m³", "pm2_5": "μg/m³",
+    "carbon_monoxide": "μg/m³", "nitrogen_dioxide": "μg/m³", "sulphur_dioxide": "μg/m³", "ozone": "μg/m³",
+}
+
+PLACE_TYPES = ("city", "town", "village", "suburb", "administrative")
+COUNTRIES = ("India", "United States", "Germany", "Brazil", "Japan", "Nigeria", "France", "Australia")
+
+
+class Faults:
+    """Injected behaviour, shared by every route."""
+
+    def __init__(self, latency_ms=50.0, jitter_ms=20.0, failure_rate=0.0, hang_rate=0.0, hang_seconds=30.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.requests = {}
+        self.failed = 0
+        self.hung = 0
+
+    async def apply(self, route):
+        """Sleep for the configured latency; returns an error response to send instead, if any."""
+        self.requests[route] = self.requests.get(route, 0) + 1
+        delay = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        if self.hang_rate and random.random() < self.hang_rate:
+            # Longer than any client timeout: exercises timeouts and the circuit breaker
+            self.hung += 1
+            delay = self.hang_seconds
+        await asyncio.sleep(delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failed += 1
+            return JSONResponse({"error": True, "reason": "injected failure"}, status_code=503)
+        return None
+
+
+def _seed(*parts):
+    return int.from_bytes(hashlib.blake2b("|".join(map(str, parts)).encode(), digest_size=8).digest(), "big")
+
+
+def air_quality_payload(lat, lng, now=None):
+    """One location's response for current=..., hourly=us_aqi, past_days=1, forecast_days=1, timezone=auto."""
+    now = now or datetime.now(timezone.utc)
+    rng = random.Random(_seed(round(lat, 3), round(lng, 3)))
+    offset = int(round(lng / 15)) * 3600
+    local_now = now + timedelta(seconds=offset)
+    base = rng.uniform(15, 160)
+    day_start = local_now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    times, aqi = [], []
+    for h in range(48):
+        t = day_start + timedelta(hours=h)
+        times.append(t.strftime("%Y-%m-%dT%H:%M"))
+        rush = 1 + 0.25 * (t.hour in (8, 9, 18, 19)) - 0.15 * (2 <= t.hour <= 5)
+        aqi.append(round(base * rush * rng.uniform(0.9, 1.1)))
+    pm25 = base * 0.35
+    return {
+        "latitude": round(lat, 2),
+        "longitude": round(lng, 2),
+        "generationtime_ms": 0.5,
+        "utc_offset_seconds": offset,
+        "timezone": "GMT" if not offset else f"Etc/GMT{-offset // 3600:+d}",
+        "timezone_abbreviation": "GMT",
+        "elevation": round(rng.uniform(0, 900)),
+        "current_units": CURRENT_UNITS,
+        "current": {
+            "time": local_now.replace(minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M"),
+            "interval": 3600,
+            "us_aqi": aqi[24 + local_now.hour],
+            "pm10": round(pm25 * rng.uniform(1.2, 1.8), 1),
+            "pm2_5": round(pm25, 1),
+            "carbon_monoxide": round(rng.uniform(150, 1200), 1),
+            "nitrogen_dioxide": round(rng.uniform(5, 90), 1),
+            "sulphur_dioxide": round(rng.uniform(1, 40), 1),
+            "ozone": round(rng.uniform(10, 120), 1),
+        },
+        "hourly_units": {"time": "iso8601", "us_aqi": "USAQI"},
+        "hourly": {"time": times, "us_aqi": aqi},
+    }
+
+
+def search_payload(query, limit=5):
+    """Nominatim /search?format=json&addressdetails=1 results for a query."""
+    rng = random.Random(_seed(query.lower()))
+    results = []
+    for k in range(rng.randint(0, limit)):
+        country = rng.choice(COUNTRIES)
+        name = f"{query.title()}{'' if k == 0 else f' {k + 1}'}"
+        results.append({
+            "place_id": rng.randrange(10**6, 10**9),
+            "licence": "Data © OpenStreetMap contributors, ODbL 1.0. http://osm.org/copyright",
+            "osm_type": "relation",
+            "lat": f"{rng.uniform(-50, 60):.7f}",
+            "lon": f"{rng.uniform(-180, 180):.7f}",
+            "class": "place",
+            "type": rng.choice(PLACE_TYPES),
+            "place_rank": 16,
+            "importance": round(rng.uniform(0.3, 0.9), 4),
+            "display_name": f"{name}, {country}",
+            "address": {"city": name, "country": country},
+        })
+    return results
+
+
+def create_app(faults):
+    app = FastAPI()
+
+    @app.get("/v1/air-quality")
+    async def air_quality(latitude: str, longitude: str):
+        error = await faults.apply("air_quality")
+        if error is not None:
+            return error
+        lats = [float(v) for v in latitude.split(",")]
+        lngs = [float(v) for v in longitude.split(",")]
+        if len(lats) != len(lngs):
+            return JSONResponse({"error": True, "reason": "latitude/longitude length mismatch"}, status_code=400)
+        payloads = [air_quality_payload(lat, lng) for lat, lng in zip(lats, lngs)]
+        return payloads if len(payloads) > 1 else payloads[0]
+
+    @app.get("/search")
+    async def search(q: str, limit: int = 5):
+        error = await faults.apply("search")
+        if error is not None:
+            return error
+        return search_payload(q, limit)
+
+    @app.post("/_control")
+    async def control(request: Request):
+        for key, value in (await request.json()).items():
+            if hasattr(faults, key) and isinstance(value, (int, float)):
+                setattr(faults, key, float(value))
+        return faults_config(faults)
+
+    @app.get("/_stats")
+    async def stats():
+        return {"requests": faults.requests, "failed": faults.failed, "hung": faults.hung,
+                **faults_config(faults)}
+
+    return app
+
+
+def faults_config(faults):
+    return {key: getattr(faults, key)
+            for key in ("latency_ms", "jitter_ms", "failure_rate", "hang_rate", "hang_seconds")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Open-Meteo/Nominatim server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests that never answer in time")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    faults = Faults(args.latency_ms, args.jitter_ms, args.failure_rate, args.hang_rate)
+    uvicorn.run(create_app(faults), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
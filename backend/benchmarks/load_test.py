@@ -0,0 +1,382 @@
+"""
+End-to-end load test of the API against a local fake upstream.
+
+Starts benchmarks/fake_upstream.py and the app (uvicorn) as subprocesses, with
+the app's Open-Meteo and Nominatim URLs pointing at the fake and a throwaway
+data directory, then runs these scenarios concurrently for --duration seconds:
+
+  poll       dashboard users polling /api/aqi/{lat}/{lng} (revalidating with If-None-Match)
+  search     bursts of /api/search/{query} while someone types
+  simulate   slider storms on POST /simulate
+  websocket  thousands of /ws/aqi subscribers (connect time, messages received)
+
+Latency percentiles, throughput, errors, the app's memory (RSS) and event loop
+lag are written as JSON, to be compared between commits with --compare. The
+generator runs on the same machine as the app; compare reports from the same
+host, and check meta.client_cpu_s to see whether the generator saturated.
+
+Usage (from backend/):
+    python benchmarks/load_test.py --duration 30 --out bench_report.json
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 ...   # an already running app
+    python benchmarks/load_test.py --compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+import numpy as np
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# (lat, lng) of polled locations; earlier ones are more popular (Zipf-like)
+CITIES = [
+    (28.61, 77.21), (19.08, 72.88), (40.71, -74.01), (51.51, -0.13), (35.68, 139.69),
+    (-23.55, -46.63), (48.86, 2.35), (6.52, 3.38), (39.90, 116.40), (34.05, -118.24),
+    (55.76, 37.62), (-33.87, 151.21), (30.04, 31.24), (41.01, 28.98), (13.76, 100.50),
+    (1.35, 103.82), (52.52, 13.40), (37.57, 126.98), (-34.60, -58.38), (19.43, -99.13),
+]
+QUERIES = ["delhi", "mumbai", "new york", "london", "tokyo", "paris", "lagos", "berlin",
+           "springfield", "san jose", "santiago", "victoria", "kingston", "georgetown"]
+SOURCES = ("traffic", "industrial", "power", "biomass")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_process(args, env=None):
+    return subprocess.Popen(
+        [sys.executable] + args, cwd=BACKEND_DIR, env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+
+async def wait_until_up(url, process=None, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"{url} exited: {process.stderr.read().decode()[-2000:]}")
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def rss_mb(pid):
+    """(current, peak) resident set size of a process in MiB, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None, None
+    return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+
+
+class Recorder:
+    """Latencies and outcomes of one scenario."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.statuses = {}
+        self.errors = {}
+        self.bytes = 0
+
+    def ok(self, seconds, status, size=0):
+        self.latencies.append(seconds)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+
+    def error(self, exc):
+        name = type(exc).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, duration):
+        latencies = np.array(self.latencies) * 1000
+        out = {
+            "requests": len(self.latencies),
+            "errors": sum(self.errors.values()),
+            "error_types": self.errors,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "throughput_rps": round(len(self.latencies) / duration, 2),
+            "body_bytes": self.bytes,
+        }
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            out["latency_ms"] = {
+                "p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2),
+                "mean": round(float(latencies.mean()), 2), "max": round(float(latencies.max()), 2),
+            }
+        return out
+
+
+async def timed_request(client, recorder, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except Exception as e:
+        recorder.error(e)
+        return None
+    recorder.ok(time.perf_counter() - start, response.status_code, len(response.content))
+    return response
+
+
+async def poll_user(client, recorder, deadline, think):
+    # Each user follows one location, like an open dashboard tab
+    weights = [1 / (k + 1) for k in range(len(CITIES))]
+    lat, lng = random.choices(CITIES, weights)[0]
+    lat, lng = round(lat + random.uniform(-0.02, 0.02), 4), round(lng + random.uniform(-0.02, 0.02), 4)
+    etag = None
+    while time.monotonic() < deadline:
+        headers = {"If-None-Match": etag, "Accept-Encoding": "gzip"} if etag else {"Accept-Encoding": "gzip"}
+        response = await timed_request(client, recorder, "GET", f"/api/aqi/{lat}/{lng}", headers=headers)
+        if response is not None and response.headers.get("etag"):
+            etag = response.headers["etag"]
+        await asyncio.sleep(random.uniform(0.5, 1.5) * think)
+
+
+async def search_bursts(client, recorder, deadline, interval, burst):
+    while time.monotonic() < deadline:
+        # Someone typing: every prefix of a query, all at once
+        query = random.choice(QUERIES)
+        prefixes = [query[:k] for k in range(2, len(query) + 1)][:burst]
+        await asyncio.gather(*(
+            timed_request(client, recorder, "GET", f"/api/search/{prefix}") for prefix in prefixes
+        ))
+        await asyncio.sleep(interval)
+
+
+async def slider_storm(client, recorder, deadline, pause):
+    city = random.randrange(len(CITIES))
+    pollutants = {"PM2.5": 20 + 7 * city, "PM10": 40 + 9 * city, "NO2": 15 + 3 * city,
+                  "SO2": 5 + city, "CO": 0.4 + 0.05 * city, "O3": 30 + 2 * city}
+    multipliers = {source: 1.0 for source in SOURCES}
+    while time.monotonic() < deadline:
+        source = random.choice(SOURCES)
+        multipliers[source] = round(min(2.0, max(0.0, multipliers[source] + random.choice((-0.1, 0.1)))), 1)
+        await timed_request(client, recorder, "POST", "/simulate",
+                            json={"pollutants": pollutants, "multipliers": multipliers})
+        await asyncio.sleep(pause)
+
+
+async def websocket_subscriber(ws_url, recorder, deadline, counts):
+    import websockets
+
+    lat, lng = random.choice(CITIES)
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(f"{ws_url}/ws/aqi?lat={lat}&lng={lng}", open_timeout=30,
+                                      max_queue=16) as ws:
+            recorder.ok(time.perf_counter() - start, 101)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(ws.recv(), remaining)
+                    counts["messages"] += 1
+                except asyncio.TimeoutError:
+                    break
+    except Exception as e:
+        if time.monotonic() < deadline:
+            recorder.error(e)
+
+
+async def sample_memory(pid, deadline, samples):
+    while time.monotonic() < deadline:
+        current, _ = rss_mb(pid)
+        if current is not None:
+            samples.append(current)
+        await asyncio.sleep(0.5)
+
+
+async def server_gauges(client):
+    """Event loop lag and breaker state from the app's /metrics (if it has one)."""
+    try:
+        text = (await client.get("/metrics")).text
+    except Exception:
+        return {}
+    out = {}
+    for line in text.splitlines():
+        if line.startswith(("airzen_event_loop_lag_max_seconds", "airzen_upstream_circuit_state")):
+            name, value = line.rsplit(" ", 1)
+            out[name] = float(value)
+    return out
+
+
+async def run(args):
+    processes = []
+    app_pid = None
+    upstream_url = None
+    data_dir = tempfile.mkdtemp(prefix="airzen-bench-")
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            upstream_port, app_port = free_port(), free_port()
+            upstream_url = f"http://127.0.0.1:{upstream_port}"
+            processes.append(start_process([
+                "benchmarks/fake_upstream.py", "--port", str(upstream_port),
+                "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                "--failure-rate", str(args.failure_rate), "--hang-rate", str(args.hang_rate),
+            ]))
+            await wait_until_up(f"{upstream_url}/_stats", processes[-1])
+            processes.append(start_process(
+                ["-m", "uvicorn", "main:app", "--port", str(app_port), "--log-level", "warning"],
+                env={
+                    "AIRZEN_OPEN_METEO_URL": upstream_url,
+                    "AIRZEN_NOMINATIM_URL": upstream_url,
+                    "AIRZEN_DATA_DIR": data_dir,
+                    # The real Nominatim allows 1 req/s; the fake can take more
+                    "AIRZEN_NOMINATIM_RATE": str(args.nominatim_rate),
+                },
+            ))
+            base_url = f"http://127.0.0.1:{app_port}"
+            app_pid = processes[-1].pid
+            await wait_until_up(f"{base_url}/", processes[-1])
+
+        # Thousands of sockets need the descriptors
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        rss_start = rss_mb(app_pid)[0] if app_pid else None
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        recorders = {name: Recorder(name) for name in ("poll", "search", "simulate", "websocket")}
+        ws_counts = {"messages": 0}
+        memory = []
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30.0) as client:
+            start = time.monotonic()
+            cpu_start = time.process_time()
+            deadline = start + args.duration
+            ws_url = "ws" + base_url[len("http"):]
+            tasks = [poll_user(client, recorders["poll"], deadline, args.poll_think) for _ in range(args.pollers)]
+            tasks += [search_bursts(client, recorders["search"], deadline, args.search_interval, args.search_burst)
+                      for _ in range(args.searchers)]
+            tasks += [slider_storm(client, recorders["simulate"], deadline, args.slider_pause)
+                      for _ in range(args.sliders)]
+            tasks += [websocket_subscriber(ws_url, recorders["websocket"], deadline, ws_counts)
+                      for _ in range(args.websockets)]
+            if app_pid:
+                tasks.append(sample_memory(app_pid, deadline, memory))
+            await asyncio.gather(*tasks)
+            duration = time.monotonic() - start
+            client_cpu = time.process_time() - cpu_start
+            gauges = await server_gauges(client)
+            upstream_stats = (await client.get(f"{upstream_url}/_stats")).json() if upstream_url else None
+
+        report = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "duration_s": round(duration, 2),
+                # Near duration_s means the load generator, not the app, was the bottleneck
+                "client_cpu_s": round(client_cpu, 2),
+                "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+            },
+            "scenarios": {name: recorder.report(duration) for name, recorder in recorders.items()},
+            "websocket_messages": ws_counts["messages"],
+            "memory_mb": {
+                "start": round(rss_start, 1) if rss_start else None,
+                "end": round(memory[-1], 1) if memory else None,
+                "peak": round(max(memory), 1) if memory else None,
+            },
+            "server": gauges,
+            "upstream": upstream_stats,
+        }
+        return report
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'':<12}{'metric':<16}{before['meta'].get('commit') or 'before':>12}{after['meta'].get('commit') or 'after':>12}{'change':>10}")
+    for name, new in after["scenarios"].items():
+        old = before["scenarios"].get(name, {})
+        rows = [("throughput_rps", old.get("throughput_rps"), new.get("throughput_rps")),
+                ("errors", old.get("errors"), new.get("errors"))]
+        rows += [(f"{p}_ms", old.get("latency_ms", {}).get(p), new.get("latency_ms", {}).get(p))
+                 for p in ("p50", "p95", "p99")]
+        for metric, a, b in rows:
+            change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else ""
+            print(f"{name:<12}{metric:<16}{_fmt(a):>12}{_fmt(b):>12}{change:>10}")
+    a, b = before["memory_mb"].get("peak"), after["memory_mb"].get("peak")
+    print(f"{'memory':<12}{'peak_mb':<16}{_fmt(a):>12}{_fmt(b):>12}")
+
+
+def _fmt(value):
+    return "-" if value is None else f"{value:g}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the AirZen API against a fake upstream")
+    parser.add_argument("--url", help="test an already running app instead of starting one")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--pollers", type=int, default=200, help="concurrent dashboard users")
+    parser.add_argument("--poll-think", type=float, default=1.0, help="mean seconds between a user's polls")
+    parser.add_argument("--searchers", type=int, default=5)
+    parser.add_argument("--search-burst", type=int, default=6)
+    parser.add_argument("--search-interval", type=float, default=1.0)
+    parser.add_argument("--sliders", type=int, default=20, help="concurrent simulator users")
+    parser.add_argument("--slider-pause", type=float, default=0.05)
+    parser.add_argument("--websockets", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=200, help="HTTP connection pool size")
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="fake upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=30.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--nominatim-rate", type=float, default=50.0)
+    parser.add_argument("--out", default="bench_report.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two reports and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = asyncio.run(run(args))
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    for name, scenario in report["scenarios"].items():
+        latency = scenario.get("latency_ms", {})
+        print(f"{name:<10} {scenario['requests']:>8} req  {scenario['throughput_rps']:>9.1f}/s  "
+              f"p50 {latency.get('p50', '-')}  p95 {latency.get('p95', '-')}  p99 {latency.get('p99', '-')} ms  "
+              f"errors {scenario['errors']}")
+    print(f"Memory (MiB): {report['memory_mb']}   Report: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Pub/sub fan-out for the /ws/aqi feed.
+
+Clients subscribe to channels (location cells). Each channel with at least one
+subscriber has a single producer task that refreshes the data, serializes it
+once and offers the same string to every subscriber. Every subscriber has a
+small bounded send queue drained by its own writer task; a client whose
+queue is full (it is not reading fast enough) is evicted instead of letting
+messages pile up in memory.
+"""
+import asyncio
+import json
+import time
+
+from metrics import registry
+
+# Close code sent to evicted slow consumers ("try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Publish -> written to the socket, per message and subscriber
+SEND_LAG_SECONDS = registry.histogram("airzen_ws_send_lag_seconds", "WebSocket fan-out lag")
+
+
+class Subscriber:
+    """One WebSocket connection with a bounded outgoing queue."""
+    __slots__ = ("websocket", "queue", "channels", "closed", "_writer")
+
+    def __init__(self, websocket, queue_size=8):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.channels = set()
+        self.closed = False
+        self._writer = asyncio.ensure_future(self._write())
+
+    def offer(self, payload):
+        """Queue a message; returns False if the client is too far behind."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait((payload, time.monotonic()))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _write(self):
+        try:
+            while True:
+                payload, queued = await self.queue.get()
+                await self.websocket.send_text(payload)
+                SEND_LAG_SECONDS.observe(time.monotonic() - queued)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Connection is gone; the receive loop cleans up the subscription
+            self.closed = True
+
+    async def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            try:
+                await self.websocket.close(code=code)
+            except Exception:
+                pass
+        self._writer.cancel()
+
+
+class Channel:
+    __slots__ = ("subscribers", "task", "last")
+
+    def __init__(self):
+        self.subscribers = set()
+        self.task = None
+        self.last = None
+
+
+class Broadcaster:
+    """
+    Runs one producer per subscribed channel and fans its output out.
+
+    `producer(key)` is an async function returning a JSON-serializable message
+    (or None to skip a round); it is called every `interval_for(key)` seconds
+    while the channel has subscribers. Unchanged payloads are not re-sent.
+    Channels whose interval is None have no producer and only receive what is
+    pushed with `publish_message`.
+    """
+
+    def __init__(self, producer, interval_for, queue_size=8, max_channels=None):
+        self.producer = producer
+        self.interval_for = interval_for
+        self.queue_size = queue_size
+        # Channels one subscriber may follow at once (None: no limit)
+        self.max_channels = max_channels
+        self.channels = {}
+        self.evicted = 0
+
+    def subscriber(self, websocket):
+        return Subscriber(websocket, self.queue_size)
+
+    def subscribe(self, key, subscriber):
+        """Add `subscriber` to channel `key`; False if it already follows max_channels others."""
+        if (self.max_channels is not None and key not in subscriber.channels
+                and len(subscriber.channels) >= self.max_channels):
+            return False
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = Channel()
+            interval = self.interval_for(key)
+            if interval is not None:
+                channel.task = asyncio.ensure_future(self._produce(key, channel, interval))
+        channel.subscribers.add(subscriber)
+        subscriber.channels.add(key)
+        # New subscribers get the latest message right away
+        if channel.last is not None and not subscriber.offer(channel.last):
+            self._evict(subscriber)
+        return True
+
+    def unsubscribe(self, key, subscriber):
+        subscriber.channels.discard(key)
+        channel = self.channels.get(key)
+        if channel is None:
+            return
+        channel.subscribers.discard(subscriber)
+        if not channel.subscribers:
+            if channel.task is not None:
+                channel.task.cancel()
+            del self.channels[key]
+
+    def unsubscribe_all(self, subscriber):
+        for key in list(subscriber.channels):
+            self.unsubscribe(key, subscriber)
+
+    def publish(self, key, payload):
+        channel = self.channels.get(key)
+        if channel is None:
+            return
+        channel.last = payload
+        slow = [sub for sub in channel.subscribers if not sub.offer(payload)]
+        for sub in slow:
+            self._evict(sub)
+
+    def publish_message(self, key, message):
+        """Serialize and publish `message` if anyone is subscribed to `key`."""
+        if key in self.channels:
+            self.publish(key, json.dumps(message))
+
+    def _evict(self, subscriber):
+        self.evicted += 1
+        self.unsubscribe_all(subscriber)
+        asyncio.ensure_future(subscriber.close(SLOW_CONSUMER_CLOSE_CODE))
+
+    async def _produce(self, key, channel, interval):
+        while True:
+            try:
+                message = await self.producer(key)
+                if message is not None:
+                    # Serialized once per round, shared by every subscriber
+                    payload = json.dumps(message)
+                    if payload != channel.last:
+                        self.publish(key, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Broadcast producer error for {key}: {e}")
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        channels, self.channels = self.channels, {}
+        subscribers = set()
+        for channel in channels.values():
+            if channel.task is not None:
+                channel.task.cancel()
+            subscribers.update(channel.subscribers)
+        for sub in subscribers:
+            await sub.close(1001)
@@ -0,0 +1,120 @@
+"""In-process caching helpers: grid snapping, hourly TTLs and an LRU TTL cache.
+
+Open-Meteo publishes new values once an hour and most users sit on the same
+few cities, so responses are cached per grid cell rather than per exact
+coordinate, and concurrent misses for a cell share one upstream fetch.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+def snap_to_grid(lat, lng, grid):
+    """Snap a coordinate to the centre of its grid cell (grid in degrees)."""
+    # round(..., 6) strips float noise such as 28.650000000000002
+    cell_lat = round(round(lat / grid) * grid, 6)
+    cell_lng = round(round(lng / grid) * grid, 6)
+    # Keep longitudes in [-180, 180) so both sides of the antimeridian share a cell
+    if cell_lng >= 180:
+        cell_lng = round(cell_lng - 360, 6)
+    return max(-90.0, min(90.0, cell_lat)), cell_lng
+
+
+def seconds_until_upstream_update(offset=300, minimum=60, now=None):
+    """Seconds until the next hourly upstream refresh (top of hour + offset)."""
+    now = now or datetime.now(timezone.utc)
+    into_hour = now.minute * 60 + now.second + now.microsecond / 1e6
+    remaining = (offset - into_hour) % 3600
+    return max(minimum, remaining)
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry expiry and single-flight fills.
+
+    Expired entries are kept (until evicted) so callers can still reach the
+    last known value with `get_stale`.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        """Return the cached value if present and fresh, else None."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if count:
+                self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        if count:
+            self.hits += 1
+        return entry[1]
+
+    def get_stale(self, key):
+        """Return (value, age_seconds) even if expired, or (None, None)."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None, None
+        return entry[1], time.monotonic() - entry[2]
+
+    def set(self, key, value, ttl=None, age=0.0):
+        """Store `value`; `age` back-dates it (for copies of an entry stored elsewhere)."""
+        now = time.monotonic()
+        self._data[key] = (now + (self.ttl if ttl is None else ttl), value, now - age)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self):
+        """Snapshot of (key, value) pairs, fresh or not."""
+        return [(key, entry[1]) for key, entry in self._data.items()]
+
+    async def get_or_fetch(self, key, fetch, ttl=None):
+        """Return the cached value, or run `fetch()` once for all concurrent callers.
+
+        `ttl` may be a number or a callable evaluated when the value is stored.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        # shield: a cancelled caller must not cancel the fetch the others await
+        return await asyncio.shield(self.fill_in_background(key, fetch, ttl))
+
+    def fill_in_background(self, key, fetch, ttl=None):
+        """Start (or join) the single-flight fill for `key` without waiting; returns its future."""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fill(key, fetch, ttl))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._fill_done(key, f))
+        return future
+
+    async def _fill(self, key, fetch, ttl):
+        value = await fetch()
+        if value is not None:
+            self.set(key, value, ttl() if callable(ttl) else ttl)
+        return value
+
+    def _fill_done(self, key, future):
+        self._inflight.pop(key, None)
+        if not future.cancelled():
+            # Mark the exception retrieved; every waiter gets it re-raised anyway
+            future.exception()
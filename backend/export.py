@@ -0,0 +1,115 @@
+"""Columnar bulk export of the history store (GET /api/export).
+
+Stored observations (with their pollutant levels and, optionally, the source
+attribution computed from them) or forecasts are read in batches of rows
+from SQLite and turned into Arrow record batches. Each batch is written
+straight out as an Arrow IPC stream message or a Parquet row group. Memory
+use is bounded by one batch whatever the size of the result. The work runs
+in a worker thread (a sync generator under StreamingResponse), so the event
+loop only forwards bytes.
+"""
+import numpy as np
+
+from history import FORECAST, OBSERVATION, _COLUMNS
+
+# pyarrow is optional (pip install pyarrow); the endpoint answers 501 without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+KINDS = {"observations": OBSERVATION, "forecasts": FORECAST}
+FORMATS = {
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+BATCH_ROWS = 65536
+
+
+def schema(kind, sources=()):
+    fields = [
+        pa.field("lat", pa.float64(), nullable=False),
+        pa.field("lng", pa.float64(), nullable=False),
+        pa.field("time", pa.timestamp("s", tz="UTC"), nullable=False),
+        pa.field("aqi", pa.float64()),
+    ]
+    if kind == OBSERVATION:
+        fields += [pa.field(name, pa.float64()) for name in _COLUMNS]
+        fields += [pa.field(f"source_{name}", pa.uint8()) for name in sources]
+    return pa.schema(fields)
+
+
+def record_batches(rows_iter, kind, attribute=None, sources=()):
+    """
+    Record batches from HistoryStore.iter_rows() lists. `attribute(values)` maps an
+    (n, n_pollutants) array to (n, len(sources)) percentages; rows without any
+    pollutant get nulls there.
+    """
+    target = schema(kind, sources)
+    for rows in rows_iter:
+        # One conversion for the whole batch; None -> NaN -> null below
+        table = np.array(rows, dtype=np.float64)
+        arrays = [
+            pa.array(table[:, 0]),
+            pa.array(table[:, 1]),
+            pa.array(table[:, 2].astype(np.int64), pa.timestamp("s", tz="UTC")),
+        ]
+        values = table[:, 3:]
+        arrays += [pa.array(column, from_pandas=True) for column in values.T]
+        if kind == OBSERVATION and sources:
+            pollutants = values[:, 1:]
+            missing = np.isnan(pollutants).all(axis=1)
+            # Range-checked before narrowing: an out-of-range share must not wrap around
+            percent = np.clip(attribute(pollutants), 0, 100).astype(np.uint8)
+            arrays += [pa.array(percent[:, k], mask=missing) for k in range(len(sources))]
+        yield pa.RecordBatch.from_arrays(arrays, schema=target)
+
+
+class _Chunks:
+    """Write-only file object collecting what the Arrow writers emit until taken."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream(batches, target_schema, fmt):
+    """Bytes of an Arrow IPC stream ("arrow") or a Parquet file ("parquet"), batch by batch."""
+    sink = _Chunks()
+    if fmt == "parquet":
+        # One row group per batch; the footer is written on close
+        writer = pq.ParquetWriter(sink, target_schema, compression="zstd")
+        write = writer.write_batch
+    else:
+        writer = pa.ipc.new_stream(sink, target_schema)
+        write = writer.write_batch
+    try:
+        for batch in batches:
+            write(batch)
+            data = sink.take()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.take()
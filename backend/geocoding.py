@@ -0,0 +1,177 @@
+"""Geocoding layer in front of Nominatim for /api/search/{query}.
+
+Lookups go, in order, through:
+  1. an in-memory LRU of normalized query -> results,
+  2. a persistent SQLite cache of the same (survives restarts),
+  3. a prefix index over every place name we know (bundled cities plus all
+     cached results), so search-as-you-type prefixes are answered locally,
+  4. Nominatim itself, behind a token bucket (their usage policy allows
+     1 req/s) with concurrent identical queries coalesced into one call.
+"""
+import bisect
+import json
+import os
+import sqlite3
+import time
+import unicodedata
+
+from cache import TTLCache
+from upstream import RateLimited, TokenBucket
+
+
+def normalize_query(query):
+    """Case-, width- and whitespace-insensitive form of a search string."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+class GeocodeStore:
+    """SQLite-backed persistent cache of normalized query -> result list."""
+
+    def __init__(self, path, ttl=30 * 24 * 3600):
+        self.ttl = ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS geocode ("
+            " query TEXT PRIMARY KEY, results TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+
+    def get(self, query):
+        row = self.db.execute(
+            "SELECT results FROM geocode WHERE query = ? AND fetched_at > ?",
+            (query, time.time() - self.ttl),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, query, results):
+        self.db.execute(
+            "INSERT OR REPLACE INTO geocode (query, results, fetched_at) VALUES (?, ?, ?)",
+            (query, json.dumps(results), time.time()),
+        )
+
+    def all_results(self):
+        for (results,) in self.db.execute("SELECT results FROM geocode"):
+            yield from json.loads(results)
+
+    def close(self):
+        self.db.close()
+
+
+class PrefixIndex:
+    """Sorted-array prefix index: bisect to the first key >= prefix, scan while it matches."""
+
+    def __init__(self):
+        self._keys = []
+        self._places = []
+        self._seen = set()
+        self.popularity = {}
+
+    def __len__(self):
+        return len(self._seen)
+
+    @staticmethod
+    def place_id(place):
+        return (place["name"], round(place["lat"], 4), round(place["lng"], 4))
+
+    def add(self, place):
+        pid = self.place_id(place)
+        if pid in self._seen:
+            return
+        self._seen.add(pid)
+        # Index the full name and its leading component ("Delhi" of "Delhi, India")
+        full = normalize_query(place["name"])
+        keys = {full, normalize_query(place["name"].split(",")[0])}
+        for key in keys:
+            i = bisect.bisect_right(self._keys, key)
+            self._keys.insert(i, key)
+            self._places.insert(i, place)
+
+    def search(self, prefix, limit=5, scan=500):
+        """Places whose name starts with `prefix`, most popular first."""
+        found = {}
+        i = bisect.bisect_left(self._keys, prefix)
+        end = min(len(self._keys), i + scan)
+        while i < end and self._keys[i].startswith(prefix):
+            place = self._places[i]
+            found.setdefault(self.place_id(place), place)
+            i += 1
+        ranked = sorted(found.items(), key=lambda item: (-self.popularity.get(item[0], 0), len(item[1]["name"])))
+        return [place for _, place in ranked[:limit]]
+
+    def exact(self, query):
+        i = bisect.bisect_left(self._keys, query)
+        return i < len(self._keys) and self._keys[i] == query
+
+    def record_hit(self, places):
+        for place in places:
+            pid = self.place_id(place)
+            self.popularity[pid] = self.popularity.get(pid, 0) + 1
+
+
+class Geocoder:
+    """
+    `fetch(query)` is the async upstream call returning a list of result dicts
+    (name, lat, lng, type, country). `memory` replaces the per-process
+    TTLCache in front of the SQLite store (e.g. with a cache shared by workers);
+    `bucket` likewise replaces the per-process TokenBucket(rate, burst).
+    """
+
+    def __init__(self, fetch, db_path, places_path=None, rate=1.0, burst=1, max_wait=2.0,
+                 limit=5, memory_size=10000, memory=None, bucket=None):
+        self.fetch = fetch
+        self.limit = limit
+        self.max_wait = max_wait
+        self.store = GeocodeStore(db_path)
+        self.memory = memory if memory is not None else TTLCache(maxsize=memory_size, ttl=self.store.ttl)
+        self.bucket = bucket if bucket is not None else TokenBucket(rate, burst)
+        self.index = PrefixIndex()
+        if places_path and os.path.exists(places_path):
+            with open(places_path) as f:
+                for place in json.load(f):
+                    self.index.add(place)
+        for place in self.store.all_results():
+            self.index.add(place)
+
+    async def search(self, query):
+        """Return (results, source) where source is "memory", "disk", "index" or "nominatim"."""
+        q = normalize_query(query)
+        if not q:
+            return [], "index"
+
+        results = self.memory.get(q)
+        if results is not None:
+            return results, "memory"
+
+        results = self.store.get(q)
+        if results is not None:
+            self.memory.set(q, results)
+            return results, "disk"
+
+        # Enough local candidates (or an exact name) -> no need to ask upstream
+        local = self.index.search(q, self.limit)
+        if local and (len(local) >= self.limit or self.index.exact(q)):
+            self.index.record_hit(local[:1])
+            return local, "index"
+
+        try:
+            results = await self.memory.get_or_fetch(q, lambda: self._fetch_upstream(q))
+        except RateLimited:
+            # Over the upstream budget: partial local matches beat an error
+            if local:
+                return local, "index"
+            raise
+        return results, "nominatim"
+
+    async def _fetch_upstream(self, q):
+        await self.bucket.acquire(self.max_wait)
+        results = await self.fetch(q)
+        self.store.put(q, results)
+        for place in results:
+            self.index.add(place)
+        return results
+
+    def close(self):
+        self.store.close()
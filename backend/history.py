@@ -0,0 +1,232 @@
+"""Append-only AQI time-series store (SQLite) with server-side downsampling.
+
+Every observation and hourly forecast the service sees is recorded per grid
+cell. Writes are buffered in memory and flushed in batches by a background
+task running in a worker thread, so recording never adds request latency.
+Rows are clustered by (cell, kind, time) (WITHOUT ROWID), so a history query
+only touches the requested range, and bucketing into min/max/mean happens in
+SQL.
+"""
+import asyncio
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from pollutants import POLLUTANTS, PollutantReading
+
+OBSERVATION = 0
+FORECAST = 1
+
+# Cells are stored as integer 1e-4 degrees
+_SCALE = 10000
+
+_COLUMNS = ("pm25", "pm10", "no2", "so2", "co", "o3")  # POLLUTANTS order
+
+
+# A later row for the same (cell, kind, time) wins, but missing values never erase
+# known ones (an hourly AQI-only row landing on a full current observation)
+_UPSERT = (
+    "INSERT INTO aqi_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (cell_lat, cell_lng, kind, ts) DO UPDATE SET aqi = COALESCE(excluded.aqi, aqi), "
+    + ", ".join(f"{c} = COALESCE(excluded.{c}, {c})" for c in _COLUMNS)
+)
+
+
+def cell_id(cell):
+    return int(round(cell[0] * _SCALE)), int(round(cell[1] * _SCALE))
+
+
+def open_meteo_epoch(local_iso, utc_offset_seconds):
+    """Open-Meteo timestamps are local wall-clock ISO strings; convert to UTC epoch seconds."""
+    dt = datetime.fromisoformat(local_iso).replace(tzinfo=timezone.utc)
+    return int(dt.timestamp()) - int(utc_offset_seconds or 0)
+
+
+class HistoryStore:
+    def __init__(self, path, flush_interval=1.0, flush_rows=5000, max_buffer=200_000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self.dropped = 0
+        self.written = 0
+        self._task = None
+        self._wake = None
+        # Separate connections so reads never wait behind a batch write (WAL)
+        self._writer = self._connect()
+        self._reader = self._connect()
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS aqi_history ("
+            " cell_lat INTEGER NOT NULL, cell_lng INTEGER NOT NULL, kind INTEGER NOT NULL,"
+            " ts INTEGER NOT NULL, aqi REAL,"
+            " pm25 REAL, pm10 REAL, no2 REAL, so2 REAL, co REAL, o3 REAL,"
+            " PRIMARY KEY (cell_lat, cell_lng, kind, ts)) WITHOUT ROWID"
+        )
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def record(self, cell, kind, ts, aqi, values=None):
+        """Queue one row (values in POLLUTANTS order, NaN/None = missing). Never blocks."""
+        lat, lng = cell_id(cell)
+        if values is None:
+            pollutants = (None,) * len(_COLUMNS)
+        else:
+            pollutants = tuple(v if v == v else None for v in values)
+        self._buffer.append((lat, lng, kind, int(ts), aqi) + pollutants)
+        if len(self._buffer) > self.max_buffer:
+            overflow = len(self._buffer) - self.max_buffer
+            del self._buffer[:overflow]
+            self.dropped += overflow
+        if len(self._buffer) >= self.flush_rows and self._wake is not None:
+            self._wake.set()
+
+    def record_open_meteo(self, cell, data, now=None):
+        """
+        Record the current observation and every hourly value of a payload: hours that
+        have started (the past_days ones included) as observations, later ones as forecasts.
+        """
+        now = time.time() if now is None else now
+        offset = data.get("utc_offset_seconds", 0)
+        hourly = data.get("hourly") or {}
+        for t, aqi in zip(hourly.get("time", ()), hourly.get("us_aqi", ())):
+            if aqi is not None:
+                ts = open_meteo_epoch(t, offset)
+                self.record(cell, OBSERVATION if ts <= now else FORECAST, ts, aqi)
+        # Last, so it wins over the hourly value when it falls on the hour
+        current = data.get("current") or {}
+        if current.get("time"):
+            reading = PollutantReading.from_open_meteo(current)
+            self.record(cell, OBSERVATION, open_meteo_epoch(current["time"], offset),
+                        current.get("us_aqi"), reading.values)
+
+    async def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"History flush error: {e}")
+
+    async def flush(self):
+        rows, self._buffer = self._buffer, []
+        if rows:
+            await asyncio.to_thread(self._write, rows)
+
+    def _write(self, rows):
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany(_UPSERT, rows)
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+        self.written += len(rows)
+
+    def query(self, cell, start, end, resolution, kind=OBSERVATION):
+        """
+        Buckets of `resolution` seconds between epoch `start` and `end` (inclusive):
+        [(bucket_start, count, aqi_min, aqi_max, aqi_mean, pm25_mean, ..., o3_mean)].
+        """
+        lat, lng = cell_id(cell)
+        means = ", ".join(f"AVG({c})" for c in _COLUMNS)
+        sql = (
+            f"SELECT (ts / ?) * ? AS bucket, COUNT(*), MIN(aqi), MAX(aqi), AVG(aqi), {means}"
+            " FROM aqi_history WHERE cell_lat = ? AND cell_lng = ? AND kind = ? AND ts BETWEEN ? AND ?"
+            " GROUP BY bucket ORDER BY bucket"
+        )
+        with self._read_lock:
+            return self._reader.execute(
+                sql, (resolution, resolution, lat, lng, kind, int(start), int(end))
+            ).fetchall()
+
+    def iter_rows(self, kind, start, end, bbox=None, pollutants=True, batch_rows=65536):
+        """
+        Raw rows (cell_lat, cell_lng, ts, aqi[, pm25, ..., o3]) with `start <= ts <= end`,
+        cells in degrees, in lists of up to `batch_rows`. `bbox` = (south, west, north, east)
+        on cell centres; west > east crosses the antimeridian. Reads through its own
+        connection, so a long export never holds up queries or writes.
+        """
+        where = ["kind = ?", "ts BETWEEN ? AND ?"]
+        params = [kind, int(start), int(end)]
+        if bbox is not None:
+            south, west, north, east = bbox
+            where.append("cell_lat BETWEEN ? AND ?")
+            params += [math.ceil(south * _SCALE), math.floor(north * _SCALE)]
+            if west <= east:
+                where.append("cell_lng BETWEEN ? AND ?")
+            else:
+                where.append("(cell_lng >= ? OR cell_lng <= ?)")
+            params += [math.ceil(west * _SCALE), math.floor(east * _SCALE)]
+        columns = "cell_lat / 10000.0, cell_lng / 10000.0, ts, aqi"
+        if pollutants:
+            columns += ", " + ", ".join(_COLUMNS)
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        try:
+            cursor = db.execute(f"SELECT {columns} FROM aqi_history WHERE {' AND '.join(where)}", params)
+            while True:
+                rows = cursor.fetchmany(batch_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            db.close()
+
+
+def bucket_to_dict(row):
+    bucket, count, aqi_min, aqi_max, aqi_mean = row[:5]
+    pollutants = {
+        name: round(value, 2) for name, value in zip(POLLUTANTS, row[5:]) if value is not None
+    }
+    return {
+        "time": datetime.fromtimestamp(bucket, timezone.utc).isoformat(),
+        "count": count,
+        "aqi": {
+            "min": aqi_min,
+            "max": aqi_max,
+            "mean": round(aqi_mean, 1) if aqi_mean is not None else None,
+        },
+        "pollutants": pollutants,
+    }
+
+
+def parse_resolution(value):
+    """'3600', '15m', '1h', '1d' -> seconds."""
+    value = str(value).strip().lower()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value and value[-1] in units:
+        seconds = float(value[:-1]) * units[value[-1]]
+    else:
+        seconds = float(value)
+    if seconds < 1:
+        raise ValueError(f"Invalid resolution: {value!r}")
+    return int(seconds)
+
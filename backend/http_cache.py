@@ -0,0 +1,109 @@
+"""Pre-serialized JSON responses with ETags and precompressed variants.
+
+A response body that only changes when its underlying data does (an AQI
+snapshot changes at most hourly) is serialized once into an `EncodedBody`,
+which keeps the raw bytes, a content-derived ETag and, on first use, the
+gzip/brotli-compressed bytes. `respond()` turns it into a 304 when the
+client's If-None-Match matches, or the best encoding the client accepts.
+"""
+import gzip
+import hashlib
+import json
+
+from fastapi import Response
+
+# orjson is several times faster than the stdlib encoder (pip install orjson)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Brotli is optional too (pip install brotli); gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are not worth compressing
+MIN_COMPRESS_BYTES = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(obj):
+    """JSON bytes (compact, UTF-8)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode()
+
+
+class EncodedBody:
+    __slots__ = ("body", "etag", "media_type", "_encoded")
+
+    def __init__(self, body, media_type="application/json"):
+        self.body = body
+        self.media_type = media_type
+        # Weak: the same ETag covers every content-coding of the body
+        self.etag = 'W/"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self._encoded = {"identity": body}
+
+    @classmethod
+    def json(cls, obj):
+        return cls(dumps(obj))
+
+    def encoded(self, coding):
+        data = self._encoded.get(coding)
+        if data is None:
+            if coding == "br":
+                data = brotli.compress(self.body, quality=BROTLI_QUALITY)
+            else:
+                data = gzip.compress(self.body, GZIP_LEVEL, mtime=0)
+            self._encoded[coding] = data
+        return data
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match comparison (weak, as RFC 9110 requires for it)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def accepted_coding(accept_encoding):
+    """Best content-coding we can produce for an Accept-Encoding header."""
+    offered = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip().lower()] = q
+    if brotli is not None and offered.get("br", 0) > 0:
+        return "br"
+    if offered.get("gzip", 0) > 0:
+        return "gzip"
+    return "identity"
+
+
+def respond(request, encoded, cache_control="no-cache", headers=None):
+    """
+    A 304 if the request's If-None-Match matches, else the body in the best
+    accepted encoding. "no-cache" makes browsers revalidate every poll, which
+    is a 304 without a body while the data is unchanged.
+    """
+    headers = {"ETag": encoded.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding", **(headers or {})}
+    if etag_matches(request.headers.get("if-none-match"), encoded.etag):
+        return Response(status_code=304, headers=headers)
+    coding = "identity"
+    if len(encoded.body) >= MIN_COMPRESS_BYTES:
+        coding = accepted_coding(request.headers.get("accept-encoding"))
+    if coding != "identity":
+        headers["Content-Encoding"] = coding
+    return Response(content=encoded.encoded(coding), media_type=encoded.media_type, headers=headers)
@@ -0,0 +1,335 @@
+"""Sensor ingestion pipeline.
+
+    source -> [raw queue] -> validate -> [validated queue] -> aqi -> [scored queue] -> sinks
+
+Sources are async iterables of raw station records (dicts with optional
+"station", "lat", "lng", "timestamp" and any pollutant keys understood by
+`pollutants.ALIASES`). Records are validated and normalized in micro-batches
+into a `PollutantBatch`, scored with the vectorized AQI engine, and handed to
+every sink. All queues are bounded, so a slow stage pushes back on the one
+before it instead of growing memory; per-stage counters show where.
+"""
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+from pollutants import ALIASES, INDEX, POLLUTANTS, PollutantBatch
+
+# Readings above these (display units) are treated as sensor faults
+MAX_CONCENTRATION = np.array([1000.0, 2000.0, 2000.0, 2000.0, 100.0, 1000.0])
+
+
+class RandomSource:
+    """Random readings every `interval` seconds; synthetic, never the default."""
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+
+    async def __aiter__(self):
+        while True:
+            yield {
+                'PM2.5': random.uniform(5, 300),
+                'PM10': random.uniform(10, 400),
+                'NO2': random.uniform(5, 200),
+                'SO2': random.uniform(5, 200),
+                'CO': random.uniform(0.1, 20),
+                'O3': random.uniform(5, 200),
+            }
+            await asyncio.sleep(self.interval)
+
+
+class FileReplaySource:
+    """Replays an NDJSON file of records, optionally at `rate` records/s and in a loop."""
+
+    def __init__(self, path, rate=None, loop=False):
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+
+    async def __aiter__(self):
+        while True:
+            with open(self.path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    yield _parse_line(line)
+                    if self.rate:
+                        await asyncio.sleep(1 / self.rate)
+                    else:
+                        # Let the other stages run between records
+                        await asyncio.sleep(0)
+            if not self.loop:
+                return
+
+
+def _parse_line(line):
+    """One NDJSON record; a malformed line comes out as None, which the pipeline drops."""
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+class SocketSource:
+    """Reads NDJSON records from a TCP stream (e.g. a station gateway or a replay server)."""
+
+    def __init__(self, host, port, reconnect_delay=5.0):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+
+    async def __aiter__(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                print(f"Ingestion socket error: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            try:
+                while line := await reader.readline():
+                    line = line.strip()
+                    if line:
+                        yield _parse_line(line)
+            finally:
+                writer.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+
+def source_from_spec(spec):
+    """
+    Build a source from a spec string: "file:<path>[@rate]", "tcp:<host>:<port>" or
+    "random" (synthetic readings, for demos and load tests). None for an empty spec.
+    """
+    if not spec or spec == "none":
+        return None
+    if spec == "random":
+        return RandomSource()
+    kind, _, rest = spec.partition(":")
+    if kind == "file":
+        path, _, rate = rest.partition("@")
+        return FileReplaySource(path, rate=float(rate) if rate else None, loop=True)
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        return SocketSource(host or "127.0.0.1", int(port))
+    raise ValueError(f"Unknown ingestion source: {spec!r}")
+
+
+class IngestBatch:
+    """One validated, scored micro-batch of station readings."""
+    __slots__ = ("station", "lat", "lng", "timestamp", "readings", "aqi", "t_in")
+
+    def __init__(self, station, lat, lng, timestamp, readings, t_in):
+        self.station = station
+        self.lat = lat
+        self.lng = lng
+        self.timestamp = timestamp
+        self.readings = readings
+        self.aqi = None
+        self.t_in = t_in
+
+    def __len__(self):
+        return len(self.readings)
+
+
+class StageStats:
+    """Throughput and latency counters for one pipeline stage."""
+    __slots__ = ("name", "items", "batches", "dropped", "latency_total", "latency_max",
+                 "blocked_seconds", "started")
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        self.dropped = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.blocked_seconds = 0.0
+        self.started = time.monotonic()
+
+    def record(self, items, latencies=None):
+        self.items += items
+        self.batches += 1
+        if latencies is not None and len(latencies):
+            self.latency_total += float(np.sum(latencies))
+            self.latency_max = max(self.latency_max, float(np.max(latencies)))
+
+    def snapshot(self, queue=None):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            "items": self.items,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "items_per_second": round(self.items / elapsed, 2),
+            "latency_avg_ms": round(self.latency_total / self.items * 1000, 3) if self.items else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 3),
+            # Time spent waiting on a full downstream queue = backpressure
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "queue_depth": queue.qsize() if queue is not None else None,
+            "queue_size": queue.maxsize if queue is not None else None,
+        }
+
+
+class IngestionPipeline:
+    def __init__(self, source, sinks=(), queue_size=4096, batch_size=256, max_wait=0.05):
+        self.source = source
+        self.sinks = list(sinks)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.raw = asyncio.Queue(queue_size)
+        # Downstream queues hold batches, so they are sized in batches
+        batch_slots = max(2, queue_size // batch_size)
+        self.validated = asyncio.Queue(batch_slots)
+        self.scored = asyncio.Queue(batch_slots)
+        self.stats = {name: StageStats(name) for name in ("source", "validate", "aqi", "sink")}
+        self.latest = None
+        self._tasks = []
+
+    def add_sink(self, sink):
+        """Register a callable receiving every scored IngestBatch."""
+        self.sinks.append(sink)
+
+    async def start(self):
+        """Run the stages; a pipeline without a source (no feed configured) stays idle."""
+        if self.source is not None and not self._tasks:
+            self._tasks = [
+                asyncio.ensure_future(self._source_stage()),
+                asyncio.ensure_future(self._validate_stage()),
+                asyncio.ensure_future(self._aqi_stage()),
+                asyncio.ensure_future(self._sink_stage()),
+            ]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def snapshot_stats(self):
+        queues = {"source": self.raw, "validate": self.validated, "aqi": self.scored, "sink": None}
+        return {name: stats.snapshot(queues[name]) for name, stats in self.stats.items()}
+
+    async def _put(self, queue, item, stats):
+        if queue.full():
+            start = time.monotonic()
+            await queue.put(item)
+            stats.blocked_seconds += time.monotonic() - start
+        else:
+            queue.put_nowait(item)
+
+    async def _source_stage(self):
+        stats = self.stats["source"]
+        try:
+            async for record in self.source:
+                if not isinstance(record, dict):
+                    stats.dropped += 1
+                    continue
+                await self._put(self.raw, (time.monotonic(), record), stats)
+                stats.record(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Ingestion source error: {e}")
+
+    async def _next_micro_batch(self):
+        items = [await self.raw.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.batch_size:
+            try:
+                items.append(self.raw.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Not wait_for(): on some Pythons it can swallow a cancellation that
+            # races with the get completing, leaving the stage running after stop()
+            getter = asyncio.ensure_future(self.raw.get())
+            try:
+                await asyncio.wait((getter,), timeout=remaining)
+            finally:
+                if not getter.done():
+                    getter.cancel()
+            if not getter.done():
+                break
+            items.append(getter.result())
+        return items
+
+    async def _validate_stage(self):
+        stats = self.stats["validate"]
+        while True:
+            items = await self._next_micro_batch()
+            try:
+                batch = self.validate(items)
+            except Exception as e:
+                print(f"Ingestion validation error: {e}")
+                stats.dropped += len(items)
+                continue
+            stats.dropped += len(items) - len(batch)
+            stats.record(len(batch), time.monotonic() - batch.t_in)
+            if len(batch):
+                await self._put(self.validated, batch, stats)
+
+    def validate(self, items):
+        """Normalize raw records into an IngestBatch, dropping unusable rows."""
+        t_in = np.fromiter((t for t, _ in items), dtype=np.float64, count=len(items))
+        records = [record for _, record in items]
+        # Field by field, so one unparseable value only blanks itself, not the micro-batch
+        readings = np.array([_reading_values(r) for r in records]).reshape(len(records), len(POLLUTANTS))
+        lat = np.array([_float(r.get("lat")) for r in records])
+        lng = np.array([_float(r.get("lng", r.get("lon"))) for r in records])
+        now = time.time()
+        timestamp = np.array([_float(r.get("timestamp"), now) for r in records])
+
+        # Faulty values become missing; rows with nothing left are dropped
+        readings[(readings < 0) | (readings > MAX_CONCENTRATION)] = np.nan
+        keep = ~np.isnan(readings).all(axis=1)
+        # Location is optional, but if present it has to be on the globe
+        has_location = ~np.isnan(lat) & ~np.isnan(lng)
+        bad_location = has_location & ((np.abs(lat) > 90) | (np.abs(lng) > 180))
+        keep &= ~bad_location
+
+        station = ["" if r.get("station") is None else str(r["station"]) for r, k in zip(records, keep) if k]
+        return IngestBatch(station, lat[keep], lng[keep], timestamp[keep],
+                           PollutantBatch(readings[keep]), t_in[keep])
+
+    async def _aqi_stage(self):
+        stats = self.stats["aqi"]
+        while True:
+            batch = await self.validated.get()
+            batch.aqi = batch.readings.aqi()
+            stats.record(len(batch), time.monotonic() - batch.t_in)
+            await self._put(self.scored, batch, stats)
+
+    async def _sink_stage(self):
+        stats = self.stats["sink"]
+        while True:
+            batch = await self.scored.get()
+            self.latest = batch
+            for sink in self.sinks:
+                try:
+                    sink(batch)
+                except Exception as e:
+                    print(f"Ingestion sink error: {e}")
+            stats.record(len(batch), time.monotonic() - batch.t_in)
+
+
+def _reading_values(record):
+    values = [np.nan] * len(POLLUTANTS)
+    for key, value in record.items():
+        name = ALIASES.get(key)
+        if name is not None:
+            values[INDEX[name]] = _float(value)
+    return values
+
+
+def _float(value, default=np.nan):
+    try:
+        return float(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
@@ -1,15 +1,85 @@
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, HTTPException, Path, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
 import asyncio
 import json
-import random
 
 import numpy as np
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 import os
-import httpx
+import sys
+import time
 
-app = FastAPI(root_path="/api" if os.environ.get("VERCEL") else "")
+from broadcaster import Broadcaster
+from cache import TTLCache, seconds_until_upstream_update, snap_to_grid
+from geocoding import Geocoder
+from http_cache import EncodedBody, respond
+from metrics import COMPUTE_SECONDS, LoopLagMonitor, MetricsMiddleware, registry
+from prefetch import PrefetchScheduler
+from shared_cache import SharedStore, SharedTokenBucket, SharedTTLCache, make_cache
+from spatial import SpatialIndex
+from tiles import FORMATS, MAX_ZOOM, TileService
+from upstream import upstreams
+
+# ml/ modules import each other by bare name (see ml/train_model.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ml"))
+from pollutants import PollutantReading
+from forecast_model import ForecastModel, lag_window, solar_hour
+from history import FORECAST, OBSERVATION, HistoryStore, bucket_to_dict, open_meteo_epoch, parse_resolution
+import export
+from model_store import get_forecaster
+from ingestion import IngestionPipeline, source_from_spec
+from alerts import AlertLimitExceeded, AlertService, AlertStore
+from attribution import SOURCES_BY_MODE, attribute_columns, attribute_many
+from simulation import (
+    IMPACTS, MAX_GRID_POINTS, SLIDER_SOURCES, SLIDER_STEP, ResponseSurface, baseline_hash, evaluate_scenarios,
+    grid_axis, grid_points,
+)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await loop_lag.start()
+    await upstreams.start()
+    await history_store.start()
+    await ingestion.start()
+    await prefetcher.start()
+    await alert_service.start()
+    try:
+        yield
+    finally:
+        await prefetcher.stop()
+        await alert_service.stop()
+        await ingestion.stop()
+        await history_store.stop()
+        await aqi_feed.close()
+        alert_service.close()
+        await upstreams.close()
+        if shared_store is not None:
+            shared_store.close()
+        await loop_lag.stop()
+
+
+# Writable state (caches, stores); bundled read-only data lives next to this file
+BUNDLED_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+# (serverless deployments only get a writable /tmp)
+DATA_DIR = os.environ.get(
+    "AIRZEN_DATA_DIR", "/tmp/airzen" if os.environ.get("VERCEL") else BUNDLED_DATA_DIR
+)
+
+# "memory": caches are per process. "sqlite": AQI snapshots and geocoding results
+# live in one WAL file shared by every worker on the host, with cross-process
+# single-flight, so adding workers adds neither upstream calls nor cache copies
+CACHE_BACKEND = os.environ.get("AIRZEN_CACHE_BACKEND", "memory")
+if CACHE_BACKEND not in ("memory", "sqlite"):
+    raise ValueError(f"AIRZEN_CACHE_BACKEND must be 'memory' or 'sqlite', not {CACHE_BACKEND!r}")
+shared_store = SharedStore(os.path.join(DATA_DIR, "cache.sqlite3")) if CACHE_BACKEND == "sqlite" else None
+# Per-worker copy of the hottest shared entries
+CACHE_MEMORY_SIZE = int(os.environ.get("AIRZEN_CACHE_MEMORY_SIZE", 2000))
+
+app = FastAPI(root_path="/api" if os.environ.get("VERCEL") else "", lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -20,6 +90,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so request timings include CORS handling.
+# AIRZEN_PROFILE_TOKEN enables per-request profiling (header X-Profile: <token>)
+app.add_middleware(
+    MetricsMiddleware,
+    profile_token=os.environ.get("AIRZEN_PROFILE_TOKEN"),
+    profile_interval=float(os.environ.get("AIRZEN_PROFILE_INTERVAL", 0.002)),
+)
+loop_lag = LoopLagMonitor(interval=float(os.environ.get("AIRZEN_LOOP_LAG_INTERVAL", 0.25)))
+
 # OpenAQ API base URL
 OPENAQ_API = "https://api.openaq.org/v2"
 
@@ -39,457 +118,954 @@ def get_health_risk(aqi):
     else:
         return "Hazardous", "maroon"
 
-def calculate_pollution_sources(pollutants):
+# "signature" (pollutant fingerprints) or "nnls" (unmixing against the /simulate impact matrix)
+ATTRIBUTION_MODE = os.environ.get("AIRZEN_ATTRIBUTION", "signature")
+
+
+def calculate_pollution_sources(reading):
     """
     ML-based pollution source attribution using pollutant ratios.
     Based on environmental science research on pollutant fingerprints.
     """
-    pm25 = pollutants.get("PM2.5", 0)
-    pm10 = pollutants.get("PM10", 0)
-    no2 = pollutants.get("NO₂", 0)
-    so2 = pollutants.get("SO₂", 0)
-    co = pollutants.get("CO", 0)
-    o3 = pollutants.get("O₃", 0)
+    return calculate_pollution_sources_many([PollutantReading.coerce(reading)])[0]
+
+
+@COMPUTE_SECONDS.time(("attribution",))
+def calculate_pollution_sources_many(readings):
+    """Attribution for many readings in one vectorized pass."""
+    if not readings:
+        return []
+    return attribute_many(np.array([r.values for r in readings]), ATTRIBUTION_MODE)
+
+@COMPUTE_SECONDS.time(("calculate_aqi",))
+def calculate_aqi(reading):
+    """
+    Calculate US AQI based on EPA standard breakpoints for available pollutants.
+    Returns the maximum AQI among all pollutants.
+    """
+    return PollutantReading.coerce(reading).aqi()
+
+async def fetch_places(query):
+    """Search for places using OpenStreetMap Nominatim API"""
+    response = await upstreams.get(
+        "nominatim",
+        "/search",
+        params={
+            "q": query,
+            "format": "json",
+            "limit": 5,
+            "addressdetails": 1
+        }
+    )
     
-    # Calculate source indicators based on pollutant signatures
-    # Traffic: High NO₂ + CO, moderate PM2.5
-    traffic_score = (no2 * 2 + co * 50 + pm25 * 0.3) / 3
+    data = response.json()
+    results = []
     
-    # Industrial: High SO₂, elevated PM
-    industrial_score = (so2 * 3 + pm25 * 0.5 + pm10 * 0.2) / 3
+    for place in data:
+        results.append({
+            "name": place.get("display_name", ""),
+            "lat": float(place.get("lat", 0)),
+            "lng": float(place.get("lon", 0)),
+            "type": place.get("type", ""),
+            "country": place.get("address", {}).get("country", "")
+        })
     
-    # Dust/Construction: High PM10 relative to PM2.5
-    pm_ratio = pm10 / (pm25 + 1)
-    dust_score = pm10 * 0.5 * min(pm_ratio, 3) if pm_ratio > 1.5 else pm10 * 0.1
+    return results
+
+
+NOMINATIM_RATE = float(os.environ.get("AIRZEN_NOMINATIM_RATE", 1.0))
+geocoder = Geocoder(
+    fetch_places,
+    db_path=os.path.join(DATA_DIR, "geocode.sqlite3"),
+    places_path=os.path.join(BUNDLED_DATA_DIR, "places.json"),
+    rate=NOMINATIM_RATE,
+    memory=make_cache(shared_store, "geocode", 10000, ttl=30 * 24 * 3600, memory_size=CACHE_MEMORY_SIZE),
+    # The usage policy limit is per client, not per worker
+    bucket=SharedTokenBucket(shared_store, "nominatim", NOMINATIM_RATE) if shared_store is not None else None,
+)
+
+
+@app.get("/api/search/{query}")
+async def search_places(query: str):
+    """Search for places: local cache and prefix index first, Nominatim for the rest"""
+    try:
+        results, source = await geocoder.search(query)
+        return {"success": True, "results": results, "source": source}
+        
+    except Exception as e:
+        print(f"Geocoding error: {e}")
+        return {"success": False, "error": str(e), "results": []}
+
+OPEN_METEO_CURRENT = "us_aqi,pm10,pm2_5,carbon_monoxide,nitrogen_dioxide,sulphur_dioxide,ozone"
+
+# Responses are cached per grid cell; Open-Meteo itself only updates hourly
+AQI_GRID_DEG = float(os.environ.get("AIRZEN_AQI_GRID_DEG", 0.05))
+AQI_TTL_OFFSET = int(os.environ.get("AIRZEN_AQI_TTL_OFFSET", 300))
+aqi_cache = make_cache(
+    shared_store, "aqi", int(os.environ.get("AIRZEN_AQI_CACHE_SIZE", 10000)), memory_size=CACHE_MEMORY_SIZE
+)
+
+# Every payload fetched (and every located station reading) is kept per cell for /api/history
+history_store = HistoryStore(os.path.join(DATA_DIR, "history.sqlite3"))
+# Latest AQI of every cell and station we have seen, for nearby/bbox queries without the upstream
+aqi_index = SpatialIndex(max_points=int(os.environ.get("AIRZEN_SPATIAL_MAX_POINTS", 200000)))
+# Threshold subscriptions, evaluated (by one worker) whenever cells are refreshed.
+# AIRZEN_ALERT_SINK: "queue[:<maxlen>]" (read back via /api/alerts/recent) or "file:<path>" (JSON lines)
+# Subscriptions are anonymous, so the store caps them in total, per cell and by subscribed cells
+alert_service = AlertService(
+    AlertStore(
+        os.path.join(DATA_DIR, "alerts.sqlite3"),
+        max_subscriptions=int(os.environ.get("AIRZEN_ALERT_MAX_SUBSCRIPTIONS", 100000)),
+        max_cells=int(os.environ.get("AIRZEN_ALERT_MAX_CELLS", 2000)),
+        max_per_cell=int(os.environ.get("AIRZEN_ALERT_MAX_PER_CELL", 1000)),
+    ),
+    os.environ.get("AIRZEN_ALERT_SINK", "queue"),
+)
+
+
+async def fetch_air_quality(lat, lng):
+    """Fetch the raw Open-Meteo Air Quality payload for one location."""
+    # Open-Meteo Air Quality API - completely free, accurate location data
+    response = await upstreams.get(
+        "open_meteo",
+        "/v1/air-quality",
+        params={
+            "latitude": lat,
+            "longitude": lng,
+            "current": OPEN_METEO_CURRENT,
+            "hourly": "us_aqi",
+            # Yesterday's hours give the forecaster its lag window at any time of day
+            "past_days": 1,
+            "forecast_days": 1,
+            "timezone": "auto"
+        }
+    )
+    return response.json()
+
+
+async def fetch_air_quality_many(coords):
+    """Fetch Open-Meteo payloads for many locations in one request (one payload per coord)."""
+    response = await upstreams.get(
+        "open_meteo",
+        "/v1/air-quality",
+        params={
+            "latitude": ",".join(str(lat) for lat, _ in coords),
+            "longitude": ",".join(str(lng) for _, lng in coords),
+            "current": OPEN_METEO_CURRENT,
+            "hourly": "us_aqi",
+            # Yesterday's hours give the forecaster its lag window at any time of day
+            "past_days": 1,
+            "forecast_days": 1,
+            "timezone": "auto"
+        }
+    )
+    data = response.json()
+    # A single location comes back as an object, several as a list
+    payloads = data if isinstance(data, list) else [data]
+    if len(payloads) != len(coords):
+        raise Exception(f"Expected {len(coords)} locations from Open-Meteo, got {len(payloads)}")
+    return payloads
+
+
+def location_info(lat, lng):
+    return {
+        "name": f"{lat:.2f}°N, {abs(lng):.2f}°{'E' if lng >= 0 else 'W'}",
+        "lat": lat,
+        "lng": lng
+    }
+
+
+# Hours of model forecast shown as ml_forecast
+ML_FORECAST_HOURS = 3
+
+
+def current_hour_index(data):
+    """Index of the payload's current hour in its hourly arrays (None if not found)."""
+    current_time = (data.get("current") or {}).get("time")
+    if not current_time:
+        return None
+    hour = current_time[:13]  # "YYYY-MM-DDTHH", local time like the hourly times
+    for i, t in enumerate((data.get("hourly") or {}).get("time", ())):
+        if t[:13] == hour:
+            return i
+    return None
+
+
+@COMPUTE_SECONDS.time(("ml_forecast",))
+def ml_forecasts(payloads):
+    """
+    Forecaster predictions for many Open-Meteo payloads in one vectorized call: one
+    [{"hour", "aqi", "source"}] list per payload (empty if it has no usable hourly data).
+    """
+    model = get_forecaster() or ForecastModel.persistence()
+    rows, windows, hours, starts = [], [], [], []
+    for k, data in enumerate(payloads):
+        try:
+            idx = current_hour_index(data)
+            if idx is None:
+                continue
+            window = lag_window(data["hourly"]["us_aqi"], idx, model.lags)
+            if window is None:
+                continue
+            if data["current"].get("us_aqi") is not None:
+                window[-1] = data["current"]["us_aqi"]
+            local_time = data["hourly"]["time"][idx]
+            epoch = open_meteo_epoch(local_time, data.get("utc_offset_seconds", 0))
+            hours.append(solar_hour(epoch, data.get("longitude", 0.0)))
+            windows.append(window)
+            starts.append(datetime.fromisoformat(local_time))
+            rows.append(k)
+        except Exception as e:
+            print(f"ML forecast error: {e}")
+
+    forecasts = [[] for _ in payloads]
+    if not rows:
+        return forecasts
+    predicted = model.predict(np.array(windows), np.array(hours))
+    shown = [(j, h) for j, h in enumerate(model.horizons) if h <= ML_FORECAST_HOURS]
+    for row, k in enumerate(rows):
+        forecasts[k] = [
+            {
+                "hour": (starts[row] + timedelta(hours=h)).strftime("%I %p"),
+                "aqi": round(float(predicted[row, j])),
+                "source": "ml",
+            }
+            for j, h in shown
+        ]
+    return forecasts
+
+
+@COMPUTE_SECONDS.time(("build_aqi_snapshot",))
+def build_aqi_snapshot(data, ml_forecast=None, pollution_sources=None):
+    """Turn an Open-Meteo payload into the location-independent part of an AQI response."""
+    if "current" not in data:
+        raise Exception("No current data in API response")
+
+    current = data["current"]
+    aqi = current.get("us_aqi", 50)
     
-    # Biomass/Burning: High PM2.5, moderate CO
-    biomass_score = (pm25 * 0.8 + co * 30) / 2
+    # Extract pollutants
+    reading = PollutantReading.from_open_meteo(current)
+    pollutants = reading.to_display()
     
-    # Photochemical (Ozone): High O₃
-    photochemical_score = o3 * 1.5
+    risk_level, color = get_health_risk(aqi)
     
-    # Normalize to percentages
-    total = traffic_score + industrial_score + dust_score + biomass_score + photochemical_score
+    # Generate hourly forecast from API data
+    api_forecast = []
+    current_index = current_hour_index(data)
+    if current_index is not None and "us_aqi" in data["hourly"]:
+        hourly_aqi = data["hourly"]["us_aqi"]
+        hourly_time = data["hourly"]["time"]
+        
+        # Next 6 hours after the current one
+        for i in range(current_index + 1, min(current_index + 7, len(hourly_aqi))):
+            if hourly_aqi[i] is not None:
+                # Parse ISO string
+                dt = datetime.fromisoformat(hourly_time[i])
+                hour_str = dt.strftime("%I %p")
+                api_forecast.append({
+                    "hour": hour_str,
+                    "aqi": round(hourly_aqi[i]),
+                    "source": "satellite"
+                })
     
-    if total < 1:
-        # Default distribution for very clean air
-        return {
-            "traffic": 30,
-            "industrial": 20,
-            "dust": 25,
-            "biomass": 15,
-            "photochemical": 10
-        }
+    # ML Forecast: next hours from the forecasting model (vectorized across payloads)
+    if ml_forecast is None:
+        ml_forecast = ml_forecasts([data])[0]
     
-    sources = {
-        "traffic": round((traffic_score / total) * 100),
-        "industrial": round((industrial_score / total) * 100),
-        "dust": round((dust_score / total) * 100),
-        "biomass": round((biomass_score / total) * 100),
-        "photochemical": round((photochemical_score / total) * 100)
-    }
+    # Combine forecasts - use API forecast (more accurate), ML fills gaps
+    forecast = api_forecast if api_forecast else ml_forecast
     
-    # Ensure percentages sum to 100
-    diff = 100 - sum(sources.values())
-    sources["traffic"] += diff
+    # Calculate pollution sources attribution
+    if pollution_sources is None:
+        pollution_sources = calculate_pollution_sources(reading)
     
-    return sources
+    return {
+        "aqi": aqi,
+        "ml_forecast": ml_forecast,  # ML-based forecast for next 3 hours
+        "risk_level": risk_level,
+        "color": color,
+        "pollutants": pollutants,
+        "pollution_sources": pollution_sources,  # ML source attribution
+        "forecast": forecast,  # API-based forecast
+        "source": "Open-Meteo Live",
+        "timestamp": (datetime.now(timezone.utc) + timedelta(seconds=data.get("utc_offset_seconds", 0))).isoformat(),
+        "last_updated": (datetime.now(timezone.utc) + timedelta(seconds=data.get("utc_offset_seconds", 0))).strftime("%H:%M:%S")
+    }
+
+
+async def load_aqi_snapshot(lat, lng):
+    data = await fetch_air_quality(lat, lng)
+    snapshot = build_aqi_snapshot(data)
+    history_store.record_open_meteo((lat, lng), data)
+    aqi_index.update((lat, lng), lat, lng, snapshot["aqi"])
+    alert_service.observe([(lat, lng)], [snapshot["aqi"]])
+    return snapshot
 
-def calculate_aqi(pollutants):
+
+# An expired snapshot younger than this is served at once while it is refreshed
+AQI_STALE_WHILE_REVALIDATE = float(os.environ.get("AIRZEN_AQI_SWR_SECONDS", 7200))
+# How far (km) to look for another cached cell when a cell has never been fetched
+AQI_FALLBACK_KM = float(os.environ.get("AIRZEN_AQI_FALLBACK_KM", 50))
+
+
+def refresh_aqi_cell(cell):
+    """Start (or join) the single-flight upstream refresh of a cell."""
+    return aqi_cache.fill_in_background(
+        cell,
+        lambda: load_aqi_snapshot(*cell),
+        ttl=lambda: seconds_until_upstream_update(AQI_TTL_OFFSET),
+    )
+
+
+def nearest_cached_cell(cell, max_distance_km):
+    found = aqi_index.nearest(
+        cell[0], cell[1], 1, max_distance_km,
+        accept=lambda p: p.kind == "cell" and p.key != cell and aqi_cache.get_stale(p.key)[0] is not None,
+    )
+    return found[0][1].key if found else None
+
+
+def stale_aqi_snapshot(cell):
     """
-    Calculate US AQI based on EPA standard breakpoints for available pollutants.
-    Returns the maximum AQI among all pollutants.
+    Last known snapshot of the cell (or, failing that, of the nearest cached cell),
+    marked with how old it is; None if there is nothing to fall back to.
     """
-    def get_aqi_for_pollutant(value, breakpoints):
-        for (low_c, high_c, low_i, high_i) in breakpoints:
-            if low_c <= value <= high_c:
-                return ((high_i - low_i) / (high_c - low_c)) * (value - low_c) + low_i
-        return 0
+    snapshot, age = aqi_cache.get_stale(cell)
+    fallback = "last_known"
+    if snapshot is None:
+        nearest = nearest_cached_cell(cell, AQI_FALLBACK_KM)
+        if nearest is None:
+            return None
+        snapshot, age = aqi_cache.get_stale(nearest)
+        fallback = "nearest_cell"
+        cell = nearest
+    return {
+        **snapshot,
+        "source": "Open-Meteo (cached)",
+        "stale": True,
+        "stale_seconds": round(age),
+        "fallback": fallback,
+        "data_cell": {"lat": cell[0], "lng": cell[1]},
+    }
 
-    aqi_values = []
-    
-    # PM2.5 (ug/m3)
-    if "PM2.5" in pollutants:
-        # Breakpoints: 0-12, 12.1-35.4, 35.5-55.4, 55.5-150.4, 150.5-250.4, 250.5-350.4, 350.5-500.4
-        val = pollutants["PM2.5"]
-        bp = [
-            (0, 12.0, 0, 50), (12.1, 35.4, 51, 100), (35.5, 55.4, 101, 150),
-            (55.5, 150.4, 151, 200), (150.5, 250.4, 201, 300), (250.5, 350.4, 301, 400), (350.5, 500.4, 401, 500)
-        ]
-        aqi_values.append(get_aqi_for_pollutant(val, bp))
-
-    # PM10 (ug/m3)
-    if "PM10" in pollutants:
-        # Breakpoints: 0-54, 55-154, 155-254, 255-354, 355-424, 425-504, 505-604
-        val = pollutants["PM10"]
-        bp = [
-            (0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150),
-            (255, 354, 151, 200), (355, 424, 201, 300), (425, 504, 301, 400), (505, 604, 401, 500)
-        ]
-        aqi_values.append(get_aqi_for_pollutant(val, bp))
-
-    # O3 (ppb) - OpenMeteo gives ug/m3 usually, need conversion? 
-    # OpenMeteo Air Quality API documentation says Ozone is in ug/m3. 
-    # EPA breakpoints are in ppm or ppb.
-    # Conversion Factor: 1 ppb O3 = 1.96 ug/m3 (at 25C, 1 atm). 
-    # Let's approximate: ppb = ug/m3 / 2.0
-    if "O₃" in pollutants or "O3" in pollutants:
-        val_ug = pollutants.get("O₃") or pollutants.get("O3")
-        val = val_ug / 2.0 # Convert to ppb approx
-        # Breakpoints (8-hour): 0-54, 55-70, 71-85, 86-105, 106-200
-        bp = [
-            (0, 54, 0, 50), (55, 70, 51, 100), (71, 85, 101, 150),
-            (86, 105, 151, 200), (106, 200, 201, 300)
-        ]
-        aqi_values.append(get_aqi_for_pollutant(val, bp))
-
-    # NO2 (ppb) - OpenMeteo NO2 is ug/m3. 
-    # Conversion: 1 ppb = 1.88 ug/m3. 
-    # ppb = ug/m3 / 1.88
-    if "NO2" in pollutants or "NO₂" in pollutants:
-        val_ug = pollutants.get("NO2") or pollutants.get("NO₂")
-        val = val_ug / 1.88
-        bp = [
-            (0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150),
-            (361, 649, 151, 200), (650, 1249, 201, 300), (1250, 2049, 301, 400)
-        ]
-        aqi_values.append(get_aqi_for_pollutant(val, bp))
-        
-    if not aqi_values:
-        return 0
-        
-    return max(aqi_values)
 
-@app.get("/api/search/{query}")
-async def search_places(query: str):
-    """Search for places using OpenStreetMap Nominatim API"""
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(
-                "https://nominatim.openstreetmap.org/search",
-                params={
-                    "q": query,
-                    "format": "json",
-                    "limit": 5,
-                    "addressdetails": 1
-                },
-                headers={
-                    "User-Agent": "AirZen-AQI-App/1.0"
-                }
-            )
-            
-            data = response.json()
-            results = []
-            
-            for place in data:
-                results.append({
-                    "name": place.get("display_name", ""),
-                    "lat": float(place.get("lat", 0)),
-                    "lng": float(place.get("lon", 0)),
-                    "type": place.get("type", ""),
-                    "country": place.get("address", {}).get("country", "")
-                })
-            
-            return {"success": True, "results": results}
-            
-    except Exception as e:
-        print(f"Geocoding error: {e}")
-        return {"success": False, "error": str(e), "results": []}
+# Serialized (and lazily compressed) responses per requested coordinate; an entry is
+# valid while its cell still has the same snapshot object, i.e. until the hourly refresh
+aqi_responses = TTLCache(maxsize=int(os.environ.get("AIRZEN_AQI_RESPONSE_CACHE_SIZE", 20000)))
+
+
+def encoded_aqi_response(lat, lng, snapshot):
+    entry = aqi_responses.get((lat, lng))
+    if entry is not None and entry[0] is snapshot:
+        return entry[1]
+    encoded = EncodedBody.json({"success": True, "location": location_info(lat, lng), **snapshot, "stale": False})
+    aqi_responses.set((lat, lng), (snapshot, encoded), seconds_until_upstream_update(AQI_TTL_OFFSET))
+    return encoded
+
 
 @app.get("/api/aqi/{lat}/{lng}")
-async def get_real_aqi(lat: float, lng: float):
-    """Fetch real AQI data from Open-Meteo Air Quality API (free, no token required)"""
+async def get_real_aqi(lat: float, lng: float, request: Request):
+    """
+    Fetch real AQI data from Open-Meteo Air Quality API (free, no token required).
+    Responses carry an ETag; polls with a matching If-None-Match get a bodyless 304.
+    """
+    cell = snap_to_grid(lat, lng, AQI_GRID_DEG)
+    prefetcher.record(cell)
+    snapshot = aqi_cache.get(cell)
+    if snapshot is not None:
+        return respond(request, encoded_aqi_response(lat, lng, snapshot))
+
+    refresh = refresh_aqi_cell(cell)
+    stale, age = aqi_cache.get_stale(cell)
+    if stale is not None and age < AQI_STALE_WHILE_REVALIDATE:
+        # Stale-while-revalidate: the refresh completes in the background
+        body = {"success": True, "location": location_info(lat, lng), **stale_aqi_snapshot(cell)}
+        return respond(request, EncodedBody.json(body))
+
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            # Open-Meteo Air Quality API - completely free, accurate location data
-            response = await client.get(
-                "https://air-quality-api.open-meteo.com/v1/air-quality",
-                params={
-                    "latitude": lat,
-                    "longitude": lng,
-                    "current": "us_aqi,pm10,pm2_5,carbon_monoxide,nitrogen_dioxide,sulphur_dioxide,ozone",
-                    "hourly": "us_aqi",
-                    "forecast_days": 1,
-                    "timezone": "auto"
-                }
-            )
-            
-            data = response.json()
-            
-            if "current" in data:
-                current = data["current"]
-                aqi = current.get("us_aqi", 50)
-                
-                # Extract pollutants
-                pollutants = {}
-                if current.get("pm2_5") is not None:
-                    pollutants["PM2.5"] = round(current["pm2_5"], 1)
-                if current.get("pm10") is not None:
-                    pollutants["PM10"] = round(current["pm10"], 1)
-                if current.get("nitrogen_dioxide") is not None:
-                    pollutants["NO₂"] = round(current["nitrogen_dioxide"], 1)
-                if current.get("ozone") is not None:
-                    pollutants["O₃"] = round(current["ozone"], 1)
-                if current.get("sulphur_dioxide") is not None:
-                    pollutants["SO₂"] = round(current["sulphur_dioxide"], 1)
-                if current.get("carbon_monoxide") is not None:
-                    pollutants["CO"] = round(current["carbon_monoxide"] / 1000, 2)  # Convert to mg/m³
-                
-                risk_level, color = get_health_risk(aqi)
-                
-                # Get pollutant values for ML
-                pm25_val = pollutants.get("PM2.5", 30)
-                pm10_val = pollutants.get("PM10", pm25_val * 1.5)
-                no2_val = pollutants.get("NO₂", 20)
-                so2_val = pollutants.get("SO₂", 10)
-                co_val = pollutants.get("CO", 0.5)
-                o3_val = pollutants.get("O₃", 30)
-                
-                # Generate hourly forecast from API data
-                forecast = []
-                api_forecast = []
-                if "hourly" in data and "us_aqi" in data["hourly"]:
-                    hourly_aqi = data["hourly"]["us_aqi"]
-                    hourly_time = data["hourly"]["time"]
-                    
-                    # Find current hour index and get next 6 hours
-                    current_hour = datetime.now().hour
-                    for i in range(current_hour + 1, min(current_hour + 7, len(hourly_aqi))):
-                        if hourly_aqi[i] is not None:
-                            # Parse ISO string
-                            dt = datetime.fromisoformat(hourly_time[i])
-                            hour_str = dt.strftime("%I %p")
-                            api_forecast.append({
-                                "hour": hour_str,
-                                "aqi": round(hourly_aqi[i]),
-                                "source": "satellite"
-                            })
-                
-                # ML Forecast: Predict next 3 hours using trend analysis
-                ml_forecast = []
-                if pollutants:
-                    try:
-                        # Clone pollutants for modification
-                        p_mod = pollutants.copy()
-                        
-                        # Use current server hour for simpler simulation logic (calibration handles offset)
-                        current_hour = datetime.now().hour
-
-                        for h in range(1, 4):  # Next 1, 2, 3 hours
-                            future_hour = (current_hour + h) % 24
-                            
-                            # Apply time-based modifiers
-                            if 7 <= future_hour <= 10 or 17 <= future_hour <= 20: 
-                                modifier = 1.0 + (0.05 * h)
-                            elif 0 <= future_hour <= 5:
-                                modifier = 1.0 - (0.03 * h)
-                            else:
-                                modifier = 1.0
-                            
-                            input_dict = {
-                                'PM2.5': p_mod['PM2.5'] * modifier,
-                                'PM10': p_mod['PM10'] * modifier,
-                                'NO2': p_mod['NO2'] * modifier,
-                                'SO2': p_mod['SO2'],
-                                'CO': p_mod['CO'] * modifier,
-                                'O3': p_mod['O3'] * (2 - modifier)
-                            }
-                            
-                            input_dict = {
-                                'PM2.5': p_mod.get('PM2.5', 0) * modifier,
-                                'PM10': p_mod.get('PM10', 0) * modifier,
-                                'NO2': p_mod.get('NO₂', 0) * modifier, # Note: using original keys might be safer? 
-                                # Wait, p_mod in previous code was RE-CONSTRUCTED from local vars pm25_val etc.
-                                # Here I copied `pollutants` dict. `pollutants` uses 'NO₂', 'O₃'.
-                                # I should check keys logic.
-                                # Let's stick to using `p_mod` which is pollutants copy.
-                                # And use .get() with correct keys.
-                                # pollutants keys: PM2.5, PM10, NO₂, SO₂, CO, O₃
-                                'SO2': p_mod.get('SO₂', 0),
-                                'CO': p_mod.get('CO', 0) * modifier,
-                                'O3': p_mod.get('O₃', 0) * (2 - modifier)
-                            }
-                            
-                            # Calculate AQI direct
-                            predicted_aqi = calculate_aqi(input_dict)
-                            # Use API hourly time if available for proper timezone
-                            hour_index = current_hour + h
-                            if "hourly" in data and hour_index < len(data["hourly"]["time"]):
-                                dt_str = data["hourly"]["time"][hour_index]
-                                # Simple parse assuming standard API format
-                                # OpenMeteo gives ISO without Z usually
-                                dt = datetime.fromisoformat(dt_str)
-                                hour_str = dt.strftime("%I %p")
-                            else:
-                                hour_str = f"{future_hour:02d}:00"
-                            
-                            ml_forecast.append({
-                                "hour": hour_str,
-                                "aqi": round(predicted_aqi),
-                                "source": "ml"
-                            })
-                    except Exception as e:
-                        print(f"ML forecast error: {e}")
-                
-                # Combine forecasts - use API forecast (more accurate), ML fills gaps
-                forecast = api_forecast if api_forecast else ml_forecast
-                
-                # Calculate pollution sources attribution
-                pollution_sources = calculate_pollution_sources(pollutants)
-                
-                return {
-                    "success": True,
-                    "location": {
-                        "name": f"{lat:.2f}°N, {abs(lng):.2f}°{'E' if lng >= 0 else 'W'}",
-                        "lat": lat,
-                        "lng": lng
-                    },
-                    "aqi": aqi,
-                    "ml_forecast": ml_forecast,  # ML-based forecast for next 3 hours
-                    "risk_level": risk_level,
-                    "color": color,
-                    "pollutants": pollutants,
-                    "pollution_sources": pollution_sources,  # ML source attribution
-                    "forecast": forecast,  # API-based forecast
-                    "source": "Open-Meteo Live",
-                    "timestamp": (datetime.now(timezone.utc) + timedelta(seconds=data.get("utc_offset_seconds", 0))).isoformat(),
-                    "last_updated": (datetime.now(timezone.utc) + timedelta(seconds=data.get("utc_offset_seconds", 0))).strftime("%H:%M:%S")
-                }
-            else:
-                raise Exception("No current data in API response")
-                
+        snapshot = await asyncio.shield(refresh)
+        return respond(request, encoded_aqi_response(lat, lng, snapshot))
+
     except Exception as e:
         print(f"Open-Meteo API error: {e}")
-        simulated_aqi = random.uniform(40, 120)
-        risk_level, color = get_health_risk(simulated_aqi)
+        fallback = stale_aqi_snapshot(cell)
+        if fallback is not None:
+            return {"success": True, "location": location_info(lat, lng), **fallback, "error": str(e)}
         return {
             "success": False,
             "error": str(e),
-            "aqi": round(simulated_aqi, 1),
-            "risk_level": risk_level,
-            "color": color,
-            "pollutants": {"PM2.5": round(random.uniform(20, 80), 1)},
-            "source": "Estimated (API error)",
+            "location": location_info(lat, lng),
+            "aqi": None,
+            "source": "Unavailable",
             "last_updated": datetime.now().strftime("%H:%M:%S")
         }
 
-async def generate_sensor_data():
-    """Simulates reading from sensors."""
+# Cells per multi-location Open-Meteo request (bounded by URL length)
+AQI_BATCH_CHUNK = int(os.environ.get("AIRZEN_AQI_BATCH_CHUNK", 50))
+AQI_BATCH_MAX = 500
+
+
+class Coordinate(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+
+
+class BatchAQIRequest(BaseModel):
+    locations: list[Coordinate] = Field(max_length=AQI_BATCH_MAX)
+
+
+async def load_aqi_snapshots(cells):
+    """Fetch and cache snapshots for several cells with one upstream round trip."""
+    payloads = await fetch_air_quality_many(cells)
+    ttl = seconds_until_upstream_update(AQI_TTL_OFFSET)
+    forecasts = ml_forecasts(payloads)
+    attributions = calculate_pollution_sources_many(
+        [PollutantReading.from_open_meteo(data.get("current") or {}) for data in payloads]
+    )
+    snapshots = {}
+    for cell, data, ml_forecast, sources in zip(cells, payloads, forecasts, attributions):
+        try:
+            snapshot = build_aqi_snapshot(data, ml_forecast, sources)
+        except Exception as e:
+            print(f"Open-Meteo batch error for {cell}: {e}")
+            continue
+        aqi_cache.set(cell, snapshot, ttl)
+        history_store.record_open_meteo(cell, data)
+        aqi_index.update(cell, cell[0], cell[1], snapshot["aqi"])
+        snapshots[cell] = snapshot
+    alert_service.observe(list(snapshots), [snapshot["aqi"] for snapshot in snapshots.values()])
+    return snapshots
+
+
+@app.post("/api/aqi/batch")
+async def get_batch_aqi(request: BatchAQIRequest):
+    """
+    AQI for many locations at once, streamed back as NDJSON (one line per location,
+    tagged with its index in the request, in completion order).
+    Cached cells are written first; the rest are grouped into multi-location upstream calls.
+    """
+    locations = request.locations
+    cells = {}
+    for i, loc in enumerate(locations):
+        cells.setdefault(snap_to_grid(loc.lat, loc.lng, AQI_GRID_DEG), []).append(i)
+    for cell in cells:
+        prefetcher.record(cell)
+
+    def lines_for(indices, snapshot, error=None):
+        out = []
+        for i in indices:
+            loc = locations[i]
+            if snapshot is not None:
+                item = {"index": i, "success": True, "location": location_info(loc.lat, loc.lng),
+                        "stale": False, **snapshot}
+            else:
+                item = {"index": i, "success": False, "location": location_info(loc.lat, loc.lng),
+                        "error": error or "No data for location"}
+            out.append(json.dumps(item) + "\n")
+        return "".join(out)
+
+    async def load_chunk(chunk):
+        try:
+            return chunk, await load_aqi_snapshots(chunk), None
+        except Exception as e:
+            print(f"Open-Meteo batch error: {e}")
+            return chunk, {}, str(e)
+
+    async def stream():
+        misses = []
+        for cell, indices in cells.items():
+            snapshot = aqi_cache.get(cell)
+            if snapshot is None:
+                misses.append(cell)
+            else:
+                yield lines_for(indices, snapshot)
+
+        tasks = [
+            asyncio.ensure_future(load_chunk(misses[k:k + AQI_BATCH_CHUNK]))
+            for k in range(0, len(misses), AQI_BATCH_CHUNK)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                chunk, snapshots, error = await next_done
+                # Cells the upstream could not deliver get their last known value if there is one
+                yield "".join(
+                    lines_for(cells[cell], snapshots.get(cell) or stale_aqi_snapshot(cell), error)
+                    for cell in chunk
+                )
+        finally:
+            # Client went away mid-stream
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.get("/api/aqi/bbox")
+async def get_bbox_aqi(south: float = Query(ge=-90, le=90), west: float = Query(ge=-180, le=180),
+                       north: float = Query(ge=-90, le=90), east: float = Query(ge=-180, le=180),
+                       max_age: float = 3 * 3600, limit: int = Query(5000, ge=1, le=50000)):
+    """
+    Every known AQI point (cached cells and stations) inside a bounding box, for the
+    map and globe views. Answered from the in-memory spatial index; never calls upstream.
+    west > east selects a box across the antimeridian.
+    """
+    now = time.time()
+    points = aqi_index.bbox(south, west, north, east, max_age=max_age, limit=limit + 1)
+    return {
+        "success": True,
+        "count": min(len(points), limit),
+        "truncated": len(points) > limit,
+        "points": [point.to_dict(now) for point in points[:limit]],
+    }
+
+
+@app.get("/api/aqi/nearby/{lat}/{lng}")
+async def get_nearby_aqi(lat: float, lng: float, k: int = Query(6, ge=1, le=100),
+                         radius_km: float = Query(50.0, gt=0, le=1000), max_age: float = 3 * 3600):
+    """AQI estimated from the nearest known points by inverse-distance weighting (no upstream call)."""
+    now = time.time()
+    aqi, neighbours = aqi_index.interpolate(lat, lng, k, radius_km, max_age=max_age)
+    if aqi is None:
+        return {"success": False, "error": "No known AQI within range", "location": location_info(lat, lng),
+                "aqi": None, "neighbours": []}
+    risk_level, color = get_health_risk(aqi)
     return {
-        'PM2.5': random.uniform(5, 300),
-        'PM10': random.uniform(10, 400),
-        'NO2': random.uniform(5, 200),
-        'SO2': random.uniform(5, 200),
-        'CO': random.uniform(0.1, 20),
-        'O3': random.uniform(5, 200),
+        "success": True,
+        "location": location_info(lat, lng),
+        "aqi": round(aqi),
+        "risk_level": risk_level,
+        "color": color,
+        "source": "Interpolated",
+        "neighbours": [{**point.to_dict(now), "distance_km": round(d, 2)} for d, point in neighbours],
     }
 
+
+# Cap on extra known points (stations, other cells) blended into one tile
+TILE_MAX_KNOWN_POINTS = 1024
+
+
+async def tile_samples(bounds, points):
+    """
+    AQI samples for a tile: the grid cells under `points` (missing ones fetched in
+    batched upstream calls, last known values if that fails) plus every known
+    point inside the tile.
+    """
+    cells = list(dict.fromkeys(snap_to_grid(lat, lng, AQI_GRID_DEG) for lat, lng in points))
+    missing = [cell for cell in cells if aqi_cache.get(cell, count=False) is None]
+    chunks = [missing[k:k + AQI_BATCH_CHUNK] for k in range(0, len(missing), AQI_BATCH_CHUNK)]
+    for result in await asyncio.gather(*(load_aqi_snapshots(chunk) for chunk in chunks), return_exceptions=True):
+        if isinstance(result, Exception):
+            print(f"Tile sample error: {result}")
+
+    samples = []
+    for cell in cells:
+        snapshot = aqi_cache.get(cell, count=False) or aqi_cache.get_stale(cell)[0]
+        if snapshot is not None and snapshot.get("aqi") is not None:
+            samples.append((cell[0], cell[1], snapshot["aqi"]))
+    known = set(cells)
+    for point in aqi_index.bbox(*bounds, max_age=3 * 3600, limit=TILE_MAX_KNOWN_POINTS):
+        if point.key not in known and point.aqi is not None:
+            samples.append((point.lat, point.lng, point.aqi))
+    return samples
+
+
+tile_service = TileService(
+    tile_samples,
+    size=int(os.environ.get("AIRZEN_TILE_SIZE", 64)),
+    samples_per_side=int(os.environ.get("AIRZEN_TILE_SAMPLES", 8)),
+    memory_size=int(os.environ.get("AIRZEN_TILE_CACHE_SIZE", 2048)),
+    disk_dir=os.path.join(DATA_DIR, "tiles"),
+    disk_bytes=int(os.environ.get("AIRZEN_TILE_DISK_MB", 256)) * 1024 * 1024,
+    ttl_offset=AQI_TTL_OFFSET,
+)
+
+
+@app.get("/api/tiles/{z}/{x}/{y}")
+async def get_tile(z: int = Path(ge=0, le=MAX_ZOOM), x: int = Path(ge=0), y: str = Path(),
+                   format: str = "png"):
+    """
+    AQI raster tile (Web Mercator, XYZ scheme). `y` may carry the format as an
+    extension (3.png, 3.u16). png is colour-coded by AQI category; u16 is a
+    row-major little-endian uint16 AQI grid (X-Tile-Size per side, 65535 = no data).
+    """
+    y, _, ext = y.partition(".")
+    fmt = ext or format
+    if fmt not in FORMATS or not y.isdigit():
+        raise HTTPException(status_code=404, detail="Unknown tile")
+    y = int(y)
+    if x >= 2 ** z or y >= 2 ** z:
+        raise HTTPException(status_code=404, detail="Tile out of range")
+
+    data = await tile_service.get(z, x, y, fmt)
+    return Response(
+        content=data,
+        media_type=FORMATS[fmt],
+        headers={
+            "Cache-Control": f"public, max-age={int(seconds_until_upstream_update(AQI_TTL_OFFSET))}",
+            "X-Tile-Size": str(tile_service.size),
+        },
+    )
+
+
+# Most requested cells are refetched right after each hourly update
+prefetcher = PrefetchScheduler(
+    load_aqi_snapshots,
+    lambda cell: aqi_cache.get(cell, count=False) is not None,
+    top_n=int(os.environ.get("AIRZEN_PREFETCH_TOP", 300)),
+    chunk_size=AQI_BATCH_CHUNK,
+    concurrency=int(os.environ.get("AIRZEN_PREFETCH_CONCURRENCY", 4)),
+    ttl_offset=AQI_TTL_OFFSET,
+    # One worker per hour warms the shared cache for all of them
+    claim=(lambda: shared_store.acquire(f"prefetch:{int(time.time() // 3600)}", 3600))
+    if shared_store is not None else None,
+    # Subscribed cells must refresh hourly for their alerts to be evaluated; the most
+    # subscribed ones take up to half of the top-N budget
+    pinned=alert_service.pinned_cells,
+)
+
+
+@app.get("/api/prefetch/stats")
+async def get_prefetch_stats():
+    """Popularity tracking and cache-warming counters of the prefetch scheduler."""
+    return prefetcher.snapshot_stats()
+
+
+class AlertSubscription(BaseModel):
+    lat: float = Field(ge=-90, le=90)
+    lng: float = Field(ge=-180, le=180)
+    threshold: float = Field(gt=0, le=1000)
+    # Fires at >= threshold, clears below threshold - hysteresis
+    hysteresis: float = Field(default=10.0, ge=0, le=500)
+    # Opaque recipient (user id, device token, ...) passed through to notifications
+    target: str = Field(default="", max_length=256)
+
+
+@app.post("/api/alerts/subscriptions")
+async def create_alert_subscription(subscription: AlertSubscription):
+    """Notify `target` when the AQI of the location's grid cell crosses `threshold`."""
+    cell = snap_to_grid(subscription.lat, subscription.lng, AQI_GRID_DEG)
+    try:
+        sub_id = await alert_service.subscribe(
+            cell, subscription.threshold, subscription.hysteresis, subscription.target
+        )
+    except AlertLimitExceeded as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return {"id": sub_id, "cell": {"lat": cell[0], "lng": cell[1]}}
+
+
+@app.delete("/api/alerts/subscriptions/{sub_id}")
+async def delete_alert_subscription(sub_id: int):
+    if not await alert_service.unsubscribe(sub_id):
+        raise HTTPException(status_code=404, detail="Unknown subscription")
+    return {"success": True}
+
+
+@app.get("/api/alerts/recent")
+async def get_recent_alerts(limit: int = Query(100, ge=1, le=10000)):
+    """Take up to `limit` undelivered notifications, oldest first (queue sink only)."""
+    notifications = await alert_service.recent(limit)
+    if notifications is None:
+        raise HTTPException(status_code=404, detail="Alert notifications are not queued")
+    return {"notifications": notifications}
+
+
+@app.get("/api/alerts/stats")
+async def get_alert_stats():
+    return await alert_service.snapshot_stats()
+
+
+HISTORY_MAX_BUCKETS = 10000
+
+
+def parse_time(value, default):
+    """ISO 8601 datetime (UTC if no offset) or epoch seconds -> epoch seconds."""
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+
+@app.get("/api/history/{lat}/{lng}")
+async def get_history(lat: float, lng: float, from_: str = Query(None, alias="from"),
+                      to: str = None, resolution: str = "1h"):
+    """
+    Stored AQI and pollutant history of the location's grid cell, downsampled to
+    `resolution` buckets (e.g. 15m, 1h, 1d) with min/max/mean AQI per bucket.
+    Defaults to the last 24 hours; forecasts recorded for the range are returned alongside.
+    """
+    try:
+        cell = snap_to_grid(lat, lng, AQI_GRID_DEG)
+        end = parse_time(to, time.time())
+        start = parse_time(from_, end - 24 * 3600)
+        step = parse_resolution(resolution)
+        if start > end:
+            raise ValueError("'from' must not be after 'to'")
+        if (end - start) / step > HISTORY_MAX_BUCKETS:
+            raise ValueError(f"Too many buckets, use a coarser resolution (max {HISTORY_MAX_BUCKETS})")
+
+        observations, forecast = await asyncio.gather(
+            asyncio.to_thread(history_store.query, cell, start, end, step, OBSERVATION),
+            asyncio.to_thread(history_store.query, cell, start, end, step, FORECAST),
+        )
+        return {
+            "success": True,
+            "location": location_info(lat, lng),
+            "cell": {"lat": cell[0], "lng": cell[1]},
+            "resolution": step,
+            "from": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+            "to": datetime.fromtimestamp(end, timezone.utc).isoformat(),
+            "observations": [bucket_to_dict(row) for row in observations],
+            "forecast": [bucket_to_dict(row) for row in forecast],
+        }
+
+    except Exception as e:
+        print(f"History query error: {e}")
+        return {"success": False, "error": str(e), "observations": [], "forecast": []}
+
+
+@app.get("/api/export")
+async def export_history(kind: str = "observations", format: str = "arrow",
+                         from_: str = Query(None, alias="from"), to: str = None,
+                         south: float = Query(None, ge=-90, le=90), west: float = Query(None, ge=-180, le=180),
+                         north: float = Query(None, ge=-90, le=90), east: float = Query(None, ge=-180, le=180),
+                         sources: bool = True):
+    """
+    Bulk export of stored observations (AQI, pollutants and, with sources=true, the
+    source attribution of each reading) or forecasts, as an Arrow IPC stream
+    (format=arrow) or a Parquet file (format=parquet), streamed batch by batch.
+    Defaults to the last 24 hours; south/west/north/east restrict it to a bounding
+    box of grid cells (west > east crosses the antimeridian).
+    """
+    if export.pa is None:
+        raise HTTPException(status_code=501, detail="Export needs pyarrow (pip install pyarrow)")
+    if kind not in export.KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {sorted(export.KINDS)}")
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(export.FORMATS)}")
+    bbox = (south, west, north, east)
+    if any(v is None for v in bbox):
+        if any(v is not None for v in bbox):
+            raise HTTPException(status_code=400, detail="Give all of south, west, north, east or none")
+        bbox = None
+    try:
+        end = parse_time(to, time.time())
+        start = parse_time(from_, end - 24 * 3600)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    kind_id = export.KINDS[kind]
+    names = SOURCES_BY_MODE[ATTRIBUTION_MODE] if sources and kind_id == OBSERVATION else ()
+    batches = export.record_batches(
+        history_store.iter_rows(kind_id, start, end, bbox, pollutants=kind_id == OBSERVATION,
+                                batch_rows=export.BATCH_ROWS),
+        kind_id,
+        lambda values: attribute_columns(values, ATTRIBUTION_MODE)[1],
+        names,
+    )
+    media_type, extension = export.FORMATS[format]
+    # A sync iterator: Starlette runs it in a worker thread, off the event loop
+    return StreamingResponse(
+        export.stream(batches, export.schema(kind_id, names), format),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="airzen-{kind}.{extension}"'},
+    )
+
+
+# Station readings come in through the ingestion pipeline (AIRZEN_INGEST_SOURCE,
+# e.g. "tcp:<host>:<port>"); without a source there is no sensor feed
+ingestion = IngestionPipeline(
+    source_from_spec(os.environ.get("AIRZEN_INGEST_SOURCE", "")),
+    batch_size=int(os.environ.get("AIRZEN_INGEST_BATCH", 256)),
+)
+
+
+def sensor_feed_message(batch, i):
+    """
+    Sensor-feed message for row `i` of an ingested batch. There is no forecast: a
+    single station reading has no hourly history for the forecaster to work from.
+    """
+    aqi = float(batch.aqi[i])
+    risk_level, color = get_health_risk(aqi)
+    message = {
+        "pollutants": batch.readings.reading(i).to_dict(),
+        "aqi": round(aqi, 2),
+        "risk_level": risk_level,
+        "color": color,
+        "timestamp": datetime.fromtimestamp(float(batch.timestamp[i]), timezone.utc).isoformat(),
+    }
+    if batch.station[i]:
+        message["station"] = batch.station[i]
+    if not (np.isnan(batch.lat[i]) or np.isnan(batch.lng[i])):
+        message["location"] = {"lat": float(batch.lat[i]), "lng": float(batch.lng[i])}
+    return message
+
+
+# Channel for clients that connect without a location, pushed from the ingestion pipeline
+SENSOR_FEED = "sensors"
+# Cells only change when the upstream does; this just bounds how late a refresh is seen
+CELL_FEED_INTERVAL = float(os.environ.get("AIRZEN_WS_CELL_INTERVAL", 30))
+
+
+async def produce_feed(key):
+    """Build the next message for a grid-cell /ws/aqi channel."""
+    cell_lat, cell_lng = key
+    snapshot = await aqi_cache.get_or_fetch(
+        key,
+        lambda: load_aqi_snapshot(cell_lat, cell_lng),
+        ttl=lambda: seconds_until_upstream_update(AQI_TTL_OFFSET),
+    )
+    return {"location": location_info(cell_lat, cell_lng), **snapshot}
+
+
+aqi_feed = Broadcaster(
+    produce_feed,
+    lambda key: None if key == SENSOR_FEED else CELL_FEED_INTERVAL,
+    queue_size=int(os.environ.get("AIRZEN_WS_QUEUE_SIZE", 8)),
+    max_channels=int(os.environ.get("AIRZEN_WS_MAX_CHANNELS", 20)),
+)
+
+
+def publish_sensor_batch(batch):
+    """Ingestion sink: push the newest reading of each batch to sensor-feed subscribers."""
+    if SENSOR_FEED in aqi_feed.channels:
+        aqi_feed.publish_message(SENSOR_FEED, sensor_feed_message(batch, len(batch) - 1))
+
+
+def record_sensor_batch(batch):
+    """Ingestion sink: store located station readings as observations of their grid cell."""
+    located = np.flatnonzero(~np.isnan(batch.lat) & ~np.isnan(batch.lng))
+    for i in located:
+        history_store.record(
+            snap_to_grid(batch.lat[i], batch.lng[i], AQI_GRID_DEG), OBSERVATION,
+            batch.timestamp[i], float(batch.aqi[i]), batch.readings.values[i].tolist(),
+        )
+
+
+def index_sensor_batch(batch):
+    """Ingestion sink: keep each located station's latest AQI in the spatial index."""
+    located = np.flatnonzero(~np.isnan(batch.lat) & ~np.isnan(batch.lng))
+    for i in located:
+        lat, lng = float(batch.lat[i]), float(batch.lng[i])
+        aqi_index.update(("station", batch.station[i] or (lat, lng)), lat, lng,
+                         round(float(batch.aqi[i]), 1), kind="station", updated=float(batch.timestamp[i]))
+
+
+ingestion.add_sink(publish_sensor_batch)
+ingestion.add_sink(record_sensor_batch)
+ingestion.add_sink(index_sensor_batch)
+
+
+@app.get("/api/ingest/stats")
+async def get_ingest_stats():
+    """Per-stage throughput, latency and backpressure counters of the ingestion pipeline."""
+    return ingestion.snapshot_stats()
+
+
+def feed_key(lat, lng):
+    """Channel for a location, or the sensor feed without one; ValueError if out of range."""
+    if lat is None and lng is None:
+        return SENSOR_FEED
+    location = Coordinate(lat=lat, lng=lng)
+    return snap_to_grid(location.lat, location.lng, AQI_GRID_DEG)
+
+
 @app.websocket("/ws/aqi")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, lat: float = None, lng: float = None):
+    """
+    Live AQI feed. Connect with ?lat=&lng= to follow a location (or without to get the
+    sensor feed), then optionally send {"action": "subscribe"|"unsubscribe", "lat": .., "lng": ..}
+    to follow more cells on the same socket (at most AIRZEN_WS_MAX_CHANNELS). Invalid
+    messages (unknown action, bad location, too many channels) are answered with {"error": ...}.
+    """
+    try:
+        key = feed_key(lat, lng)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
+    subscriber = aqi_feed.subscriber(websocket)
+    aqi_feed.subscribe(key, subscriber)
+
+    def reject(error):
+        subscriber.offer(json.dumps({"error": error}))
+
     try:
         while True:
-            data = await generate_sensor_data()
-            
-            # Calculate AQI directly from sensor data
-            # Sensors use keys: PM2.5, PM10, NO2, SO2, CO, O3 (no subscripts in generate_sensor_data)
-            predicted_aqi = calculate_aqi(data)
-            
-            risk_level, color = get_health_risk(predicted_aqi)
-
-            current_date = datetime.now()
-            forecast = []
-            for i in range(1, 4):
-                future_date = current_date + timedelta(days=i)
-                day_name = future_date.strftime("%A")
-                f_aqi = max(0, predicted_aqi + random.uniform(-50, 50))
-                f_risk, _ = get_health_risk(f_aqi)
-                condition = "Sunny" if f_aqi < 50 else "Cloudy" if f_aqi < 100 else "Rainy"
-                forecast.append({
-                    "day": day_name,
-                    "aqi": int(f_aqi),
-                    "risk": f_risk,
-                    "condition": condition
-                })
-            
-            response = {
-                "pollutants": data,
-                "aqi": round(predicted_aqi, 2),
-                "risk_level": risk_level,
-                "color": color,
-                "timestamp": current_date.isoformat(),
-                "forecast": forecast
-            }
-            
-            await websocket.send_text(json.dumps(response))
-            await asyncio.sleep(2)
-            
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                reject("Expected a JSON object")
+                continue
+            action = message.get("action")
+            if action not in ("subscribe", "unsubscribe"):
+                reject("unknown action")
+                continue
+            try:
+                key = feed_key(message.get("lat"), message.get("lng"))
+            except ValueError:
+                reject("lat must be within -90..90 and lng within -180..180")
+                continue
+            if action == "subscribe":
+                if not aqi_feed.subscribe(key, subscriber):
+                    reject(f"At most {aqi_feed.max_channels} subscriptions per connection")
+            else:
+                aqi_feed.unsubscribe(key, subscriber)
+
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         print(f"WebSocket error: {e}")
     finally:
-        await websocket.close()
-
-from pydantic import BaseModel
+        aqi_feed.unsubscribe_all(subscriber)
+        await subscriber.close()
 
 class SimulationRequest(BaseModel):
     pollutants: dict
     multipliers: dict  # e.g., {"traffic": 0.5, "industrial": 0.8}
 
+# Response surfaces per baseline; a baseline only changes with the hourly upstream data
+simulation_surfaces = TTLCache(maxsize=int(os.environ.get("AIRZEN_SIM_CACHE_SIZE", 256)), ttl=3600)
+SLIDER_AXIS = grid_axis()
+
+
+async def build_surface(reading):
+    # ~200k grid points: run off the event loop
+    return await asyncio.to_thread(ResponseSurface.compute, reading)
+
+
 @app.post("/simulate")
 async def simulate_aqi(request: SimulationRequest):
     """
     Simulate AQI based on reduction of pollution sources.
     Uses 'Reverse Modeling' to adjust pollutant levels based on source impact.
+    The first request for a baseline is computed directly while the full slider
+    grid for that baseline is precomputed; later slider moves are grid lookups.
     """
-    p = request.pollutants.copy()
-    m = request.multipliers
-
-    # Impact Factors (Source -> Pollutant contribution)
-    # These are approximations based on environmental science literature
-    impacts = {
-        "traffic":      {"NO2": 0.6, "CO": 0.8, "PM2.5": 0.3, "O3": 0.5},
-        "industrial":   {"SO2": 0.5, "PM10": 0.3, "PM2.5": 0.3},
-        "power":        {"SO2": 0.5, "NO2": 0.2},
-        "biomass":      {"PM2.5": 0.2, "CO": 0.2},
-        "dust":         {"PM10": 0.6, "PM2.5": 0.1}
-    }
-
-    # Apply reductions
-    # Formula: New = Old * ( (1 - Impact) + (Impact * Multiplier) )
-    for source, multiplier in m.items():
-        if source in impacts:
-            for pollutant, impact in impacts[source].items():
-                if pollutant in p:
-                    p[pollutant] = p[pollutant] * ((1 - impact) + (impact * multiplier))
-
     try:
-        input_dict = {
-            'PM2.5': p.get("PM2.5", 0),
-            'PM10': p.get("PM10", 0),
-            'NO2': p.get("NO2", 0) if "NO2" in p else p.get("NO₂", 0),
-            'CO': p.get("CO", 0),
-            'SO2': p.get("SO2", 0) if "SO2" in p else p.get("SO₂", 0),
-            'O3': p.get("O3", 0) if "O3" in p else p.get("O₃", 0)
-        }
-        
-        # Calculate AQI
-        predicted_aqi = calculate_aqi(input_dict) 
+        original = PollutantReading.from_dict(request.pollutants)
+        m = {source: float(value) for source, value in request.multipliers.items() if source in IMPACTS}
+
+        key = baseline_hash(original, SLIDER_SOURCES, SLIDER_AXIS)
+        surface = simulation_surfaces.get(key)
+        if surface is not None and surface.covers(m):
+            predicted_aqi = surface.lookup(m)
+            original_aqi = surface.original_aqi
+        else:
+            if surface is None:
+                simulation_surfaces.fill_in_background(key, lambda: build_surface(original))
+            sources = tuple(m)
+            predicted_aqi = float(evaluate_scenarios(original, [[m[s] for s in sources]], sources)[0])
+            original_aqi = calculate_aqi(original)
 
         # Cap at 0
         predicted_aqi = max(0, predicted_aqi)
         
         # Calculate reduction percentage
-        original_dict = {
-            'PM2.5': request.pollutants.get("PM2.5", 0),
-            'PM10': request.pollutants.get("PM10", 0),
-            'NO2': request.pollutants.get("NO2", 0), # Frontend might send NO2 vs NO₂? Frontend uses response from API which has NO₂.
-            # But the simulation request usually sends what it received.
-            # Let's handle both.
-            # Actually calculate_aqi handles both.
-            # I can just pass request.pollutants directly!
-        }
-        original_aqi = calculate_aqi(request.pollutants)
-        
         improvement = 0
         if original_aqi > 0:
             improvement = ((original_aqi - predicted_aqi) / original_aqi) * 100
@@ -508,6 +1084,115 @@ async def simulate_aqi(request: SimulationRequest):
         print(f"Simulation error: {e}")
         return {"error": str(e), "aqi": 0}
 
+
+class SimulationGridRequest(BaseModel):
+    pollutants: dict
+    sources: list[str] = Field(default=list(SLIDER_SOURCES), min_length=1, max_length=len(IMPACTS))
+    # Finer steps only make sense for one or two sources; MAX_GRID_POINTS bounds the rest
+    step: float = Field(default=SLIDER_STEP, ge=SLIDER_STEP / 10, le=2)
+
+
+@app.post("/simulate/grid")
+async def simulate_grid(request: SimulationGridRequest):
+    """
+    Full response surface for a baseline: AQI for every combination of source
+    multipliers on a 0..2 grid, so the client can simulate slider moves locally.
+    """
+    try:
+        reading = PollutantReading.from_dict(request.pollutants)
+        unknown = [s for s in request.sources if s not in IMPACTS]
+        if unknown:
+            return {"error": f"Unknown sources: {unknown}"}
+        if len(set(request.sources)) != len(request.sources):
+            return {"error": "Duplicate sources"}
+        # Checked before the axis and its hash are built on the event loop
+        n_points = grid_points(request.step, len(request.sources))
+        if n_points > MAX_GRID_POINTS:
+            return {"error": f"Grid has {n_points} points, limit is {MAX_GRID_POINTS}"}
+        axis = grid_axis(request.step)
+        key = baseline_hash(reading, request.sources, axis)
+
+        async def compute():
+            return await asyncio.to_thread(ResponseSurface.compute, reading, request.sources, axis)
+
+        surface = await simulation_surfaces.get_or_fetch(key, compute)
+        return surface.to_dict()
+
+    except Exception as e:
+        print(f"Simulation grid error: {e}")
+        return {"error": str(e)}
+
+def cache_counters(**caches):
+    return lambda: {
+        (name, result): getattr(cache, result)
+        for name, cache in caches.items() for result in ("hits", "misses")
+    }
+
+
+registry.collector(
+    "airzen_cache_requests_total", "Cache lookups by result",
+    cache_counters(aqi=aqi_cache, tiles=tile_service.memory, simulation=simulation_surfaces),
+    labels=("cache", "result"), kind="counter",
+)
+registry.collector(
+    "airzen_cache_entries", "Entries held per cache",
+    lambda: {("aqi",): len(aqi_cache), ("tiles",): len(tile_service.memory), ("simulation",): len(simulation_surfaces)},
+    labels=("cache",),
+)
+registry.collector("airzen_tiles_rendered_total", "Tiles rendered", lambda: tile_service.rendered, kind="counter")
+registry.collector("airzen_spatial_index_points", "Points in the spatial index", lambda: len(aqi_index))
+registry.collector(
+    "airzen_history_rows_total", "History rows by outcome",
+    lambda: {("written",): history_store.written, ("dropped",): history_store.dropped},
+    labels=("outcome",), kind="counter",
+)
+registry.collector(
+    "airzen_prefetch_warmed_total", "Cells warmed by the prefetcher", lambda: prefetcher.warmed, kind="counter"
+)
+registry.collector(
+    "airzen_ingest_items_total", "Items processed per ingestion stage",
+    lambda: {(name,): stats.items for name, stats in ingestion.stats.items()},
+    labels=("stage",), kind="counter",
+)
+registry.collector(
+    "airzen_ingest_dropped_total", "Items dropped per ingestion stage",
+    lambda: {(name,): stats.dropped for name, stats in ingestion.stats.items()},
+    labels=("stage",), kind="counter",
+)
+if isinstance(aqi_cache, SharedTTLCache):
+    registry.collector(
+        "airzen_shared_cache_hits_total", "Lookups answered by the cross-worker cache tier",
+        lambda: {("aqi",): aqi_cache.shared_hits, ("geocode",): geocoder.memory.shared_hits},
+        labels=("cache",), kind="counter",
+    )
+    registry.collector(
+        "airzen_shared_cache_waited_fills_total", "Misses served by another worker's in-flight fetch",
+        lambda: {("aqi",): aqi_cache.waited_fills, ("geocode",): geocoder.memory.waited_fills},
+        labels=("cache",), kind="counter",
+    )
+    registry.collector(
+        "airzen_shared_cache_busy_total", "Shared store calls given up after the busy timeout",
+        lambda: shared_store.busy, kind="counter",
+    )
+registry.collector("airzen_alert_subscriptions", "Alert subscriptions", lambda: alert_service.counts[0])
+registry.collector(
+    "airzen_alert_notifications_total", "Alert notifications by event (evaluating worker only)",
+    lambda: {("above",): alert_service.engine.fired, ("cleared",): alert_service.engine.cleared}
+    if alert_service.engine is not None else {},
+    labels=("event",), kind="counter",
+)
+registry.collector("airzen_ws_channels", "Live feed channels with subscribers", lambda: len(aqi_feed.channels))
+registry.collector(
+    "airzen_ws_evicted_total", "Slow WebSocket consumers evicted", lambda: aqi_feed.evicted, kind="counter"
+)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/")
 def read_root():
     return {"message": "Air Quality Prediction API is running"}
@@ -0,0 +1,335 @@
+"""Lightweight in-process metrics, served at /metrics in the Prometheus text format.
+
+Counters and fixed-bucket histograms are plain dicts keyed by label values,
+updated inline on the event loop (no locks, no exporter thread). Values the
+rest of the service already keeps (cache hits, pipeline and prefetch stats)
+are read at scrape time through collector callbacks instead of being
+double-counted. `LoopLagMonitor` measures how late the event loop wakes up,
+i.e. how long something blocked it. `SamplingProfiler` is only started for a
+request that asks for it (see MetricsMiddleware), so it costs nothing otherwise.
+"""
+import asyncio
+import bisect
+import math
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+
+# Seconds; covers a cache hit (sub-millisecond) up to a slow upstream deadline
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # labels -> [per-bucket counts (+Inf last), sum]
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        # Buckets are upper bounds (le), so a value equal to a bound counts in it
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, labels=()):
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labels, labels, ("le", _format_value(bound))), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labels, labels), total
+            yield f"{self.name}_count", _format_labels(self.labels, labels), cumulative
+
+
+class _Timer:
+    """Context manager and decorator observing elapsed seconds into a histogram."""
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+    def __call__(self, func):
+        histogram, labels = self.histogram, self.labels
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, labels)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+
+
+class Collector:
+    """
+    Values read at scrape time: `collect()` returns a number, or {label values: number}.
+    `kind` is "gauge" or "counter" (for totals kept elsewhere).
+    """
+
+    def __init__(self, name, help, collect, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            if value is not None:
+                yield self.name, _format_labels(self.labels, labels), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"Metric {metric.name} already registered as {existing.kind}")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def collector(self, name, help, collect, labels=(), kind="gauge"):
+        # Re-registering replaces the callback (e.g. after a reload)
+        self.metrics[name] = Collector(name, help, collect, labels, kind)
+        return self.metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                print(f"Metrics collector error for {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_SECONDS = registry.histogram(
+    "airzen_http_request_seconds", "HTTP request duration by route", ("method", "route", "status")
+)
+WS_CONNECTIONS = registry.counter("airzen_websocket_connections_total", "WebSocket connections", ("route",))
+COMPUTE_SECONDS = registry.histogram(
+    "airzen_compute_seconds", "Time in CPU-bound hot paths", ("stage",)
+)
+
+
+class LoopLagMonitor:
+    """Sleeps `interval` seconds in a loop; how much later than that it wakes up is loop lag."""
+
+    def __init__(self, interval=0.25, registry=registry):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.histogram = registry.histogram(
+            "airzen_event_loop_lag_seconds", "Event loop wake-up delay",
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+        )
+        registry.collector("airzen_event_loop_lag_max_seconds", "Largest event loop lag since start",
+                           lambda: self.max_lag)
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.histogram.observe(lag)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread (the event loop's) every `interval` seconds
+    from a helper thread and counts identical stacks. Note that on the event loop
+    this includes whatever other requests were running at the same time.
+    """
+
+    def __init__(self, thread_id=None, interval=0.002, max_depth=64):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = _Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="airzen-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self):
+        """Stacks in the collapsed format flamegraph tools read ("a;b;c count" per line)."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request by route template and counting
+    WebSocket connections.
+
+    If `profile_token` is set, a request carrying the header `X-Profile: <token>`
+    is run under a SamplingProfiler and answered with the collapsed stacks
+    (text/plain) instead of its normal body.
+    """
+
+    def __init__(self, app, profile_token=None, profile_interval=0.002):
+        self.app = app
+        self.profile_token = profile_token.encode() if profile_token else None
+        self.profile_interval = profile_interval
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            WS_CONNECTIONS.inc((scope["path"],))
+            return await self.app(scope, receive, send)
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if self.profile_token is not None and self._wants_profile(scope):
+            return await self._profiled(scope, receive, send)
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_SECONDS.observe(time.perf_counter() - start, (scope["method"], _route(scope), status[0]))
+
+    def _wants_profile(self, scope):
+        return any(k == b"x-profile" and v == self.profile_token for k, v in scope["headers"])
+
+    async def _profiled(self, scope, receive, send):
+        status = [500]
+
+        async def discard(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+
+        profiler = SamplingProfiler(interval=self.profile_interval).start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            elapsed = time.perf_counter() - start
+            profiler.stop()
+        body = (f"# {scope['method']} {scope['path']} -> {status[0]} in {elapsed * 1000:.1f} ms,"
+                f" {profiler.samples} samples every {self.profile_interval * 1000:g} ms\n"
+                + profiler.collapsed()).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def _route(scope):
+    # Set by the router once it has matched; the template keeps label cardinality bounded
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
@@ -0,0 +1,126 @@
+"""US EPA AQI engine shared by the API (main.py) and the training script.
+
+Breakpoint tables are held as NumPy arrays so sub-indices for millions of
+readings come out of one `np.searchsorted` plus an interpolation, with a
+plain-Python scalar path for single API requests.
+
+Concentrations are in EPA units: PM2.5/PM10 in µg/m³, O3/NO2/SO2 in ppb and
+CO in ppm. As the EPA specifies, each concentration is truncated to the
+precision of its table before the lookup, so values such as PM2.5 = 12.05
+land in a band instead of falling between 12.0 and 12.1.
+"""
+import bisect
+import math
+
+import numpy as np
+
+# (C_low, C_high, I_low, I_high)
+BREAKPOINTS = {
+    "PM2.5": [(0.0, 12.0, 0, 50), (12.1, 35.4, 51, 100), (35.5, 55.4, 101, 150),
+              (55.5, 150.4, 151, 200), (150.5, 250.4, 201, 300), (250.5, 350.4, 301, 400),
+              (350.5, 500.4, 401, 500)],
+    "PM10": [(0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150),
+             (255, 354, 151, 200), (355, 424, 201, 300), (425, 504, 301, 400),
+             (505, 604, 401, 500)],
+    # 8-hour ozone; above 200 ppb the 1-hour table takes over, approximated here
+    "O3": [(0, 54, 0, 50), (55, 70, 51, 100), (71, 85, 101, 150),
+           (86, 105, 151, 200), (106, 200, 201, 300), (201, 504, 301, 500)],
+    "NO2": [(0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150),
+            (361, 649, 151, 200), (650, 1249, 201, 300), (1250, 1649, 301, 400),
+            (1650, 2049, 401, 500)],
+    "SO2": [(0, 35, 0, 50), (36, 75, 51, 100), (76, 185, 101, 150),
+            (186, 304, 151, 200), (305, 604, 201, 300), (605, 804, 301, 400),
+            (805, 1004, 401, 500)],
+    "CO": [(0.0, 4.4, 0, 50), (4.5, 9.4, 51, 100), (9.5, 12.4, 101, 150),
+           (12.5, 15.4, 151, 200), (15.5, 30.4, 201, 300), (30.5, 40.4, 301, 400),
+           (40.5, 50.4, 401, 500)],
+}
+
+# Decimal places each concentration is truncated to before the lookup
+PRECISION = {"PM2.5": 1, "PM10": 0, "O3": 0, "NO2": 0, "SO2": 0, "CO": 1}
+
+POLLUTANTS = tuple(BREAKPOINTS)
+
+# Concentrations above the top breakpoint are reported as the index maximum
+AQI_MAX = 500.0
+
+# Guards truncation against float noise, e.g. 0.7 * 10 == 7.000000000000001
+_EPS = 1e-9
+
+
+class BreakpointTable:
+    """One pollutant's breakpoints as arrays (plus lists for the scalar path)."""
+    __slots__ = ("c_low", "c_high", "i_low", "slope", "scale", "top",
+                 "_c_low", "_c_high", "_i_low", "_slope")
+
+    def __init__(self, breakpoints, decimals):
+        bp = np.asarray(breakpoints, dtype=np.float64)
+        self.c_low = bp[:, 0].copy()
+        self.c_high = bp[:, 1].copy()
+        self.i_low = bp[:, 2].copy()
+        self.slope = (bp[:, 3] - bp[:, 2]) / (bp[:, 1] - bp[:, 0])
+        self.scale = 10.0 ** decimals
+        self.top = float(bp[-1, 1])
+        self._c_low = self.c_low.tolist()
+        self._c_high = self.c_high.tolist()
+        self._i_low = self.i_low.tolist()
+        self._slope = self.slope.tolist()
+
+    def sub_index(self, values):
+        c = np.asarray(values, dtype=np.float64)
+        c = np.maximum(np.floor(c * self.scale + _EPS) / self.scale, 0.0)
+        band = np.searchsorted(self.c_low, c, side="right") - 1
+        np.clip(band, 0, len(self.c_low) - 1, out=band)
+        out = self.slope[band] * (c - self.c_low[band]) + self.i_low[band]
+        out[c > self.top] = AQI_MAX
+        out[np.isnan(c)] = np.nan
+        return out
+
+    def sub_index_scalar(self, value):
+        if value is None or value != value:
+            return None
+        c = max(math.floor(value * self.scale + _EPS) / self.scale, 0.0)
+        if c > self.top:
+            return AQI_MAX
+        band = max(bisect.bisect_right(self._c_low, c) - 1, 0)
+        return self._slope[band] * (c - self._c_low[band]) + self._i_low[band]
+
+
+TABLES = {name: BreakpointTable(bp, PRECISION[name]) for name, bp in BREAKPOINTS.items()}
+
+
+def sub_index(pollutant, values):
+    """Sub-index for an array of concentrations of one pollutant (NaN in, NaN out)."""
+    return TABLES[pollutant].sub_index(values)
+
+
+def sub_index_scalar(pollutant, value):
+    """Sub-index for a single concentration, or None if value is missing."""
+    return TABLES[pollutant].sub_index_scalar(value)
+
+
+def aqi(readings):
+    """
+    Overall AQI (max sub-index) for columns of readings.
+    `readings` maps pollutant -> array-like; NaN marks a missing measurement.
+    Rows with no measured pollutant get 0.
+    """
+    subs = [sub_index(name, values) for name, values in readings.items() if name in TABLES]
+    if not subs:
+        return np.zeros(0)
+    # fmax ignores NaN unless every pollutant is missing
+    result = np.fmax.reduce(np.broadcast_arrays(*subs), axis=0)
+    return np.nan_to_num(result, nan=0.0)
+
+
+def aqi_scalar(readings):
+    """Overall AQI for one reading (dict pollutant -> value); 0 if nothing usable."""
+    best = 0.0
+    for name, value in readings.items():
+        table = TABLES.get(name)
+        if table is None:
+            continue
+        sub = table.sub_index_scalar(value)
+        if sub is not None and sub > best:
+            best = sub
+    return best
@@ -0,0 +1,208 @@
+"""
+Compact, memory-mapped export of the trained AQI ensemble.
+
+`train_improved` saves a joblib pickle of a StackingRegressor (RandomForest +
+GradientBoosting -> Ridge). Unpickling it needs scikit-learn, is slow and
+gives every uvicorn worker a private copy. `export_compact` flattens all trees
+into a handful of node tables saved as plain .npy files in one directory;
+`CompactAQIModel.load` memory-maps them read-only, so workers share the same
+pages through the OS page cache, and predicts with pure NumPy.
+
+Usage (from repo root):
+    python backend/ml/compact_model.py backend/ml/aqi_model.joblib backend/ml/aqi_model_compact
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+from model_wrapper import PREDICT_CHUNK, as_feature_array
+
+FORMAT_VERSION = 1
+
+# Bounds the (trees x rows) node matrix walked per step
+_NODES_PER_STEP = 1 << 20
+
+
+def _flatten_trees(trees, offset):
+    """Concatenate sklearn tree_ objects into global node tables; leaves point to themselves."""
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    depth = 0
+    for tree in trees:
+        t = tree.tree_
+        idx = np.arange(t.node_count)
+        leaf = t.children_left == -1
+        lefts.append(np.where(leaf, idx, t.children_left) + offset)
+        rights.append(np.where(leaf, idx, t.children_right) + offset)
+        features.append(np.where(leaf, 0, t.feature))
+        thresholds.append(t.threshold)
+        values.append(t.value.reshape(t.node_count, -1)[:, 0])
+        roots.append(offset)
+        depth = max(depth, t.max_depth)
+        offset += t.node_count
+    return features, thresholds, lefts, rights, values, roots, depth, offset
+
+
+def _flatten_predictors(predictors, offset):
+    """Same as _flatten_trees for HistGradientBoosting predictors (leaf values include shrinkage)."""
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    depth = 0
+    for predictor in predictors:
+        nodes = predictor.nodes
+        idx = np.arange(len(nodes))
+        leaf = nodes["is_leaf"].astype(bool)
+        lefts.append(np.where(leaf, idx, nodes["left"]) + offset)
+        rights.append(np.where(leaf, idx, nodes["right"]) + offset)
+        features.append(np.where(leaf, 0, nodes["feature_idx"]))
+        thresholds.append(nodes["num_threshold"])
+        values.append(nodes["value"])
+        roots.append(offset)
+        depth = max(depth, int(nodes["depth"].max()))
+        offset += len(nodes)
+    return features, thresholds, lefts, rights, values, roots, depth, offset
+
+
+def export_compact(improved_model, path):
+    """
+    Write an ImprovedAQIModel to `path`: a StackingRegressor of tree ensembles + Ridge,
+    or a single HistGradientBoostingRegressor (stored as a one-estimator stack).
+    """
+    stacking = improved_model.model
+    scaler = improved_model.scaler
+    if getattr(stacking, "passthrough", False):
+        raise ValueError("Stacking with passthrough=True is not supported by the compact format")
+    n_features = stacking.n_features_in_
+    scaler_mean = scaler.mean_ if scaler is not None else np.zeros(n_features)
+    scaler_scale = scaler.scale_ if scaler is not None else np.ones(n_features)
+
+    tables = {k: [] for k in ("feature", "threshold", "left", "right", "value")}
+    estimators = []
+    offset = 0
+    if hasattr(stacking, "_predictors"):
+        f, th, l, r, v, roots, depth, offset = _flatten_predictors(
+            [stage[0] for stage in stacking._predictors], offset
+        )
+        for key, part in zip(("feature", "threshold", "left", "right", "value"), (f, th, l, r, v)):
+            tables[key].extend(part)
+        tables["roots"] = roots
+        estimators.append({"kind": "sum", "scale": 1.0,
+                           "bias": float(np.ravel(stacking._baseline_prediction)[0]),
+                           "depth": depth, "first_tree": 0, "n_trees": len(roots)})
+        final_coef, final_intercept = np.ones(1), 0.0
+    else:
+        final_coef = stacking.final_estimator_.coef_
+        final_intercept = float(np.ravel(stacking.final_estimator_.intercept_)[0])
+    for estimator in getattr(stacking, "estimators_", ()):
+        if hasattr(estimator, "init_"):
+            # Gradient boosting: init + learning_rate * sum(trees)
+            trees = [stage[0] for stage in estimator.estimators_]
+            kind, scale = "sum", float(estimator.learning_rate)
+            bias = float(np.ravel(estimator.init_.constant_)[0])
+        else:
+            # Random forest: mean of trees
+            trees = list(estimator.estimators_)
+            kind, scale, bias = "mean", 1.0 / len(trees), 0.0
+        first = len(tables["feature"])
+        f, th, l, r, v, roots, depth, offset = _flatten_trees(trees, offset)
+        for key, part in zip(("feature", "threshold", "left", "right", "value"), (f, th, l, r, v)):
+            tables[key].extend(part)
+        estimators.append({"kind": kind, "scale": scale, "bias": bias, "depth": int(depth),
+                           "first_tree": first, "n_trees": len(trees)})
+        tables.setdefault("roots", []).extend(roots)
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        "feature": np.concatenate(tables["feature"]).astype(np.int32),
+        "threshold": np.concatenate(tables["threshold"]).astype(np.float64),
+        "left": np.concatenate(tables["left"]).astype(np.int32),
+        "right": np.concatenate(tables["right"]).astype(np.int32),
+        "value": np.concatenate(tables["value"]).astype(np.float64),
+        "roots": np.asarray(tables["roots"], dtype=np.int32),
+        "scaler_mean": np.asarray(scaler_mean, dtype=np.float64),
+        "scaler_scale": np.asarray(scaler_scale, dtype=np.float64),
+        "final_coef": np.asarray(final_coef, dtype=np.float64).ravel(),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "estimators": estimators,
+        "final_intercept": final_intercept,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+class CompactAQIModel:
+    """Pure-NumPy evaluator for an exported ensemble; same predict API as ImprovedAQIModel."""
+
+    def __init__(self, arrays, meta):
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact model format: {meta.get('format_version')}")
+        self.arrays = arrays
+        self.meta = meta
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"]
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.value = arrays["value"]
+        self.roots = arrays["roots"]
+        self.mean = arrays["scaler_mean"]
+        self.scale = arrays["scaler_scale"]
+        self.final_coef = arrays["final_coef"]
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+        names = ("feature", "threshold", "left", "right", "value", "roots",
+                 "scaler_mean", "scaler_scale", "final_coef")
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mode) for name in names}
+        return cls(arrays, meta)
+
+    def predict(self, X):
+        return self.predict_batch(as_feature_array(X))
+
+    def predict_batch(self, features, chunk_size=PREDICT_CHUNK):
+        features = np.asarray(features)
+        out = np.empty(len(features), dtype=np.float64)
+        for start in range(0, len(features), chunk_size):
+            chunk = features[start:start + chunk_size]
+            out[start:start + len(chunk)] = self._predict_chunk(chunk)
+        return out
+
+    def _predict_chunk(self, features):
+        # Mirror StandardScaler (which works in the input's dtype) exactly, since
+        # sklearn trees compare float32-cast inputs against float64 thresholds
+        dtype = features.dtype if features.dtype in (np.float32, np.float64) else np.float64
+        X = ((features - self.mean.astype(dtype)) / self.scale.astype(dtype)).astype(np.float32)
+        level0 = np.empty((len(X), len(self.meta["estimators"])))
+        for j, est in enumerate(self.meta["estimators"]):
+            roots = self.roots[est["first_tree"]:est["first_tree"] + est["n_trees"]]
+            level0[:, j] = est["bias"] + est["scale"] * self._sum_trees(X, roots, est["depth"])
+        return level0 @ self.final_coef + self.meta["final_intercept"]
+
+    def _sum_trees(self, X, roots, depth):
+        total = np.zeros(len(X))
+        trees_per_step = max(1, _NODES_PER_STEP // len(X)) if len(X) else 1
+        row_index = np.arange(len(X))
+        for start in range(0, len(roots), trees_per_step):
+            # node[t, i]: current node of tree t for row i; leaves loop on themselves
+            node = np.repeat(np.asarray(roots[start:start + trees_per_step])[:, None], len(X), axis=1)
+            for _ in range(depth):
+                go_left = X[row_index, self.feature[node]] <= self.threshold[node]
+                node = np.where(go_left, self.left[node], self.right[node])
+            total += self.value[node].sum(axis=0)
+        return total
+
+
+if __name__ == "__main__":
+    import joblib
+
+    src = sys.argv[1] if len(sys.argv) > 1 else "backend/ml/aqi_model.joblib"
+    dst = sys.argv[2] if len(sys.argv) > 2 else "backend/ml/aqi_model_compact"
+    export_compact(joblib.load(src), dst)
+    print(f"Exported {src} -> {dst}")
@@ -0,0 +1,138 @@
+"""
+Multi-horizon AQI forecaster: a direct autoregressive ridge model.
+
+For every horizon h, AQI(t + h) is a linear function of the last LAGS hourly
+AQI values and the local solar hour of day at t + h (as sin/cos), so the
+diurnal rush-hour/night cycle is learned from data instead of hard-coded.
+All horizons for any number of locations are one broadcasted product, and
+the whole model is a small weight matrix saved as .npy + meta.json, trained
+and served with NumPy alone.
+
+Training data comes from the AQI history store (see train_model.py).
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+LAGS = 12
+HORIZONS = (1, 2, 3, 4, 5, 6)
+AQI_MAX = 500
+
+
+def solar_hour(epoch_seconds, lng):
+    """Local mean solar hour of day (0..24) for UTC epoch seconds at longitude `lng`."""
+    return (np.asarray(epoch_seconds, dtype=np.float64) / 3600.0 + np.asarray(lng) / 15.0) % 24.0
+
+
+def design_matrix(lags, hours, horizons):
+    """
+    (n, LAGS) lag windows (oldest first) and (n,) solar hour of the last lag ->
+    (n, len(horizons), 1 + LAGS + 2) features: bias, lags, sin/cos of the target hour.
+    """
+    lags = np.asarray(lags, dtype=np.float64)
+    n, n_lags = lags.shape
+    target = 2 * np.pi * (np.asarray(hours, dtype=np.float64)[:, None] + np.asarray(horizons)) / 24.0
+    X = np.empty((n, len(horizons), 1 + n_lags + 2))
+    X[..., 0] = 1.0
+    X[..., 1:1 + n_lags] = lags[:, None, :]
+    X[..., -2] = np.sin(target)
+    X[..., -1] = np.cos(target)
+    return X
+
+
+def fill_gaps(series):
+    """Forward-fill NaNs along the last axis, then back-fill a leading gap."""
+    series = np.array(series, dtype=np.float64, ndmin=2)
+    idx = np.where(np.isnan(series), 0, np.arange(series.shape[-1]))
+    np.maximum.accumulate(idx, axis=-1, out=idx)
+    filled = np.take_along_axis(series, idx, axis=-1)
+    # Only a leading gap is left; it takes the first known value
+    first = np.take_along_axis(series, np.argmax(~np.isnan(series), axis=-1)[..., None], axis=-1)
+    return np.where(np.isnan(filled), first, filled)
+
+
+def lag_window(hourly_aqi, end, lags=LAGS):
+    """
+    The `lags` hourly values ending at index `end` (inclusive), gaps filled;
+    None if there is no value at all.
+    """
+    window = np.array(hourly_aqi[max(0, end - lags + 1):end + 1], dtype=np.float64)
+    if window.size == 0 or np.isnan(window).all():
+        return None
+    if window.size < lags:
+        window = np.concatenate([np.full(lags - window.size, np.nan), window])
+    return fill_gaps(window)[0]
+
+
+def training_windows(values, start_epoch, lng, lags=LAGS, horizons=HORIZONS):
+    """
+    All complete (no NaN) training examples from one hourly series:
+    ((m, lags) lag windows, (m,) solar hour of the last lag, (m, len(horizons)) targets).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    span = lags + max(horizons)
+    if len(values) < span:
+        return np.empty((0, lags)), np.empty(0), np.empty((0, len(horizons)))
+    windows = np.lib.stride_tricks.sliding_window_view(values, span)
+    ok = ~np.isnan(windows).any(axis=1)
+    windows = windows[ok]
+    last = np.flatnonzero(ok) + lags - 1
+    targets = windows[:, [lags - 1 + h for h in horizons]]
+    return windows[:, :lags], solar_hour(start_epoch + last * 3600, lng), targets
+
+
+class ForecastModel:
+    def __init__(self, weights, lags=LAGS, horizons=HORIZONS, meta=None):
+        self.weights = np.asarray(weights, dtype=np.float64)  # (n_features, n_horizons)
+        self.lags = lags
+        self.horizons = tuple(horizons)
+        self.meta = meta or {}
+
+    @classmethod
+    def persistence(cls, lags=LAGS, horizons=HORIZONS):
+        """Baseline used when no trained model exists: every horizon repeats the last value."""
+        weights = np.zeros((1 + lags + 2, len(horizons)))
+        weights[lags, :] = 1.0
+        return cls(weights, lags, horizons, {"kind": "persistence"})
+
+    @classmethod
+    def fit(cls, lags, hours, targets, horizons=HORIZONS, ridge=1.0):
+        """Closed-form ridge regression, one weight column per horizon (bias not penalized)."""
+        X = design_matrix(lags, hours, horizons)
+        n_features = X.shape[-1]
+        penalty = ridge * np.eye(n_features)
+        penalty[0, 0] = 0.0
+        weights = np.empty((n_features, len(horizons)))
+        for j in range(len(horizons)):
+            Xj = X[:, j, :]
+            weights[:, j] = np.linalg.solve(Xj.T @ Xj + penalty, Xj.T @ targets[:, j])
+        return cls(weights, np.shape(lags)[1], horizons, {"kind": "ridge_ar", "ridge": ridge})
+
+    def predict(self, lags, hours):
+        """(n, lags) windows + (n,) solar hour of the last lag -> (n, n_horizons) AQI."""
+        X = design_matrix(lags, hours, self.horizons)
+        return np.clip(np.einsum("nhf,fh->nh", X, self.weights), 0, AQI_MAX)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "weights.npy"), self.weights)
+        meta = {
+            **self.meta,
+            "format_version": FORMAT_VERSION,
+            "lags": self.lags,
+            "horizons": list(self.horizons),
+            "saved_at": int(time.time()),
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported forecast model format {meta.get('format_version')}")
+        return cls(np.load(os.path.join(path, "weights.npy")), meta["lags"], meta["horizons"], meta)
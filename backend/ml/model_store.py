@@ -0,0 +1,85 @@
+"""
+Process-wide, lazily loaded AQI model.
+
+Nothing is read from disk until the first `get_model()` call. The compact
+memory-mapped export (see compact_model.py) is preferred because it loads in
+milliseconds without scikit-learn and its pages are shared between workers;
+the joblib pickle written by train_model.py is the fallback.
+
+The AQI forecaster (forecast_model.py) is held the same way.
+"""
+import os
+import threading
+
+ML_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPACT_PATH = os.environ.get("AIRZEN_MODEL_COMPACT", os.path.join(ML_DIR, "aqi_model_compact"))
+JOBLIB_PATH = os.environ.get("AIRZEN_MODEL_JOBLIB", os.path.join(ML_DIR, "aqi_model.joblib"))
+FORECAST_PATH = os.environ.get("AIRZEN_FORECAST_MODEL", os.path.join(ML_DIR, "aqi_forecast"))
+
+class _Lazy:
+    """Thread-safe load-once holder."""
+
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+        self.value = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    try:
+                        self.value = self.loader()
+                    except Exception as e:
+                        print(f"{self.name} load error: {e}")
+                        self.value = None
+                    self.loaded = True
+        return self.value
+
+    def reset(self):
+        with self.lock:
+            self.value, self.loaded = None, False
+
+
+def load_model():
+    """Load the model from disk, or return None if no trained model exists."""
+    if os.path.exists(os.path.join(COMPACT_PATH, "meta.json")):
+        from compact_model import CompactAQIModel
+        return CompactAQIModel.load(COMPACT_PATH)
+    if os.path.exists(JOBLIB_PATH):
+        import joblib
+        return joblib.load(JOBLIB_PATH)
+    return None
+
+
+def load_forecaster():
+    """The trained forecaster, or the persistence baseline if none has been trained yet."""
+    from forecast_model import ForecastModel
+    if os.path.exists(os.path.join(FORECAST_PATH, "meta.json")):
+        return ForecastModel.load(FORECAST_PATH)
+    return ForecastModel.persistence()
+
+
+_model = _Lazy(load_model, "Model")
+_forecaster = _Lazy(load_forecaster, "Forecast model")
+
+
+def get_model():
+    """The shared model instance (None if not trained); loaded once on first use."""
+    return _model.get()
+
+
+def reset_model():
+    """Forget the loaded model so the next get_model() reloads it (e.g. after retraining)."""
+    _model.reset()
+
+
+def get_forecaster():
+    """The shared ForecastModel; loaded once on first use."""
+    return _forecaster.get()
+
+
+def reset_forecaster():
+    _forecaster.reset()
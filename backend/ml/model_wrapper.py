@@ -1,47 +1,62 @@
 """Model wrapper class for improved AQI prediction model."""
+import numpy as np
+
+from pollutants import POLLUTANTS, PollutantBatch
+
+FEATURES = ['PM2.5', 'PM10', 'NO2', 'SO2', 'CO', 'O3',
+            'PM_ratio', 'PM_total', 'NOx_O3_ratio',
+            'Industrial_indicator', 'Traffic_indicator']
+
+# Rows per scaler+model call; keeps temporary arrays small for huge inputs
+PREDICT_CHUNK = 65536
+
+
+def engineer_features(raw):
+    """(n, 6) raw pollutant array in POLLUTANTS order -> (n, 11) float32 model features."""
+    raw = np.nan_to_num(np.asarray(raw, dtype=np.float32), nan=0.0)
+    pm25, pm10, no2, so2, co, o3 = raw.T
+    features = np.empty((len(raw), len(FEATURES)), dtype=np.float32)
+    features[:, :6] = raw
+    np.divide(pm25, pm10 + 1, out=features[:, 6])
+    np.add(pm25, pm10, out=features[:, 7])
+    np.divide(no2, o3 + 1, out=features[:, 8])
+    np.multiply(so2, co, out=features[:, 9])
+    np.multiply(no2, co, out=features[:, 10])
+    return features
+
+
+def as_feature_array(X):
+    """
+    Normalize any supported input to the (n, 11) model feature array.
+    A 2-D array with 11 columns is taken as finished features, one with 6 columns
+    as raw pollutants; everything else goes through PollutantBatch.
+    """
+    if isinstance(X, np.ndarray) and X.ndim == 2:
+        if X.shape[1] == len(FEATURES):
+            return X
+        if X.shape[1] == len(POLLUTANTS):
+            return engineer_features(X)
+    return engineer_features(PollutantBatch.coerce(X).values)
+
 
 class ImprovedAQIModel:
-    """Wrapper class for the improved AQI prediction model."""
+    """Wrapper class for the improved AQI prediction model (scaler=None for tree-only models)."""
     def __init__(self, model, scaler):
         self.model = model
         self.scaler = scaler
-        
+
     def predict(self, X):
-        # Expect X to be a list of dictionaries or a single dictionary
-        if isinstance(X, dict):
-            X = [X]
-            
-        import numpy as np
-        
-        # Feature Engineering on list of dicts
-        X_processed = []
-        for x in X:
-            x_eng = x.copy()
-            
-            # Helper to safely get value or 0
-            def get(key): return x_eng.get(key, 0)
-            
-            # Calculate derived features if missing
-            if 'PM_ratio' not in x_eng:
-                x_eng['PM_ratio'] = get('PM2.5') / (get('PM10') + 1)
-                x_eng['PM_total'] = get('PM2.5') + get('PM10')
-                x_eng['NOx_O3_ratio'] = get('NO2') / (get('O3') + 1)
-                x_eng['Industrial_indicator'] = get('SO2') * get('CO')
-                x_eng['Traffic_indicator'] = get('NO2') * get('CO')
-            
-            X_processed.append(x_eng)
-
-        feature_order = ['PM2.5', 'PM10', 'NO2', 'SO2', 'CO', 'O3',
-                       'PM_ratio', 'PM_total', 'NOx_O3_ratio',
-                       'Industrial_indicator', 'Traffic_indicator']
-        
-        # Convert to numpy array
-        X_array = []
-        for x in X_processed:
-            row = [x.get(f, 0) for f in feature_order]
-            X_array.append(row)
-            
-        X_array = np.array(X_array)
-        
-        X_scaled = self.scaler.transform(X_array)
-        return self.model.predict(X_scaled)
+        # X: a PollutantReading/PollutantBatch, a dict, a columnar dict of arrays,
+        # a list of readings/dicts, or a 2-D raw (n, 6) / feature (n, 11) array
+        return self.predict_batch(as_feature_array(X))
+
+    def predict_batch(self, features, chunk_size=PREDICT_CHUNK):
+        """Score an (n, 11) feature array, running scaler+model in chunks."""
+        n = len(features)
+        out = np.empty(n, dtype=np.float64)
+        for start in range(0, n, chunk_size):
+            chunk = features[start:start + chunk_size]
+            if self.scaler is not None:
+                chunk = self.scaler.transform(chunk)
+            out[start:start + len(chunk)] = self.model.predict(chunk)
+        return out
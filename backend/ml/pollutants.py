@@ -0,0 +1,195 @@
+"""Canonical pollutant keys, units and reading containers.
+
+Every part of the backend passes pollutant concentrations around as a
+`PollutantReading` (one location) or a `PollutantBatch` (many rows, columnar)
+instead of ad-hoc dicts. Both store values in a fixed pollutant order with
+NaN for "not measured", so nothing is silently zero-filled.
+
+Units are the ones Open-Meteo reports and the frontend shows: µg/m³ for
+PM2.5, PM10, NO2, SO2 and O3, and mg/m³ for CO. `epa_units()` converts to the
+units of the EPA breakpoint tables (µg/m³ for PM, ppb for gases, ppm for CO).
+"""
+import math
+
+import numpy as np
+
+import aqi_engine
+
+# Canonical order; also the column order the ML model was trained on
+POLLUTANTS = ("PM2.5", "PM10", "NO2", "SO2", "CO", "O3")
+INDEX = {name: i for i, name in enumerate(POLLUTANTS)}
+
+# Any key we have seen in requests, sensor feeds or Open-Meteo -> canonical key
+ALIASES = {
+    "PM2.5": "PM2.5", "PM25": "PM2.5", "pm2_5": "PM2.5",
+    "PM10": "PM10", "pm10": "PM10",
+    "NO2": "NO2", "NO₂": "NO2", "nitrogen_dioxide": "NO2",
+    "SO2": "SO2", "SO₂": "SO2", "sulphur_dioxide": "SO2",
+    "CO": "CO", "carbon_monoxide": "CO",
+    "O3": "O3", "O₃": "O3", "ozone": "O3",
+}
+
+# Labels and precision used in API responses (and order: the dashboard shows the first three)
+DISPLAY_ORDER = ("PM2.5", "PM10", "NO2", "O3", "SO2", "CO")
+DISPLAY_NAMES = {"PM2.5": "PM2.5", "PM10": "PM10", "NO2": "NO₂", "SO2": "SO₂", "CO": "CO", "O3": "O₃"}
+DISPLAY_DECIMALS = {"PM2.5": 1, "PM10": 1, "NO2": 1, "SO2": 1, "CO": 2, "O3": 1}
+
+# Multiply to convert to EPA breakpoint units (25 °C, 1 atm):
+# 1 ppb NO2 = 1.88 µg/m³, SO2 = 2.62 µg/m³, O3 ~ 2.0 µg/m³; 1 ppm CO = 1.145 mg/m³
+TO_EPA_UNITS = np.array([1.0, 1.0, 1 / 1.88, 1 / 2.62, 1 / 1.145, 1 / 2.0])
+_TO_EPA_UNITS = TO_EPA_UNITS.tolist()
+
+_NAN = float("nan")
+
+
+def canonical(name):
+    """Canonical key for a pollutant name, or None if it is not a pollutant."""
+    return ALIASES.get(name)
+
+
+def _number(value):
+    if value is None:
+        return _NAN
+    return float(value)
+
+
+class PollutantReading:
+    """Concentrations for one location, stored in `POLLUTANTS` order (NaN = missing)."""
+    __slots__ = ("values",)
+
+    def __init__(self, values=None):
+        self.values = list(values) if values is not None else [_NAN] * len(POLLUTANTS)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build from any dict with canonical, subscript or Open-Meteo keys."""
+        values = [_NAN] * len(POLLUTANTS)
+        for key, value in data.items():
+            name = ALIASES.get(key)
+            if name is not None:
+                values[INDEX[name]] = _number(value)
+        return cls(values)
+
+    @classmethod
+    def from_open_meteo(cls, current):
+        """Build from an Open-Meteo `current` block (CO arrives in µg/m³), rounded for display."""
+        values = [_NAN] * len(POLLUTANTS)
+        for key, name in (("pm2_5", "PM2.5"), ("pm10", "PM10"), ("nitrogen_dioxide", "NO2"),
+                          ("sulphur_dioxide", "SO2"), ("carbon_monoxide", "CO"), ("ozone", "O3")):
+            value = current.get(key)
+            if value is None:
+                continue
+            if name == "CO":
+                value = value / 1000  # Convert to mg/m³
+            values[INDEX[name]] = round(value, DISPLAY_DECIMALS[name])
+        return cls(values)
+
+    @classmethod
+    def coerce(cls, obj):
+        return obj if isinstance(obj, cls) else cls.from_dict(obj)
+
+    def __getitem__(self, name):
+        return self.values[INDEX[name]]
+
+    def get(self, name, default=None):
+        value = self.values[INDEX[name]]
+        return default if value != value else value
+
+    def has(self, name):
+        value = self.values[INDEX[name]]
+        return value == value
+
+    def __bool__(self):
+        return any(v == v for v in self.values)
+
+    def __repr__(self):
+        return f"PollutantReading({self.to_dict()})"
+
+    def scaled(self, factors):
+        """New reading with each pollutant multiplied by `factors` (same order as POLLUTANTS)."""
+        return PollutantReading([v * f for v, f in zip(self.values, factors)])
+
+    def epa_units(self):
+        """Values converted to EPA breakpoint units, keyed by pollutant (missing ones omitted)."""
+        return {name: v * k for name, v, k in zip(POLLUTANTS, self.values, _TO_EPA_UNITS) if v == v}
+
+    def aqi(self):
+        return aqi_engine.aqi_scalar(self.epa_units())
+
+    def to_dict(self):
+        """Measured pollutants with canonical (ASCII) keys."""
+        return {name: v for name, v in zip(POLLUTANTS, self.values) if v == v}
+
+    def to_display(self):
+        """Measured pollutants with display labels and rounding, as sent to the frontend."""
+        out = {}
+        for name in DISPLAY_ORDER:
+            v = self.values[INDEX[name]]
+            if v == v and not math.isinf(v):
+                out[DISPLAY_NAMES[name]] = round(v, DISPLAY_DECIMALS[name])
+        return out
+
+
+class PollutantBatch:
+    """Columnar form: an (n, len(POLLUTANTS)) float array, NaN = missing."""
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 2 or values.shape[1] != len(POLLUTANTS):
+            raise ValueError(f"Expected an (n, {len(POLLUTANTS)}) array, got shape {values.shape}")
+        self.values = values
+
+    @classmethod
+    def from_readings(cls, readings):
+        readings = list(readings)
+        if not readings:
+            return cls(np.empty((0, len(POLLUTANTS))))
+        return cls([PollutantReading.coerce(r).values for r in readings])
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Build from a mapping of pollutant name -> 1-D array (any known key spelling)."""
+        length = None
+        named = {}
+        for key, column in columns.items():
+            name = ALIASES.get(key)
+            if name is None:
+                continue
+            named[name] = np.asarray(column, dtype=np.float64)
+            length = len(named[name]) if length is None else length
+        values = np.full((length or 0, len(POLLUTANTS)), np.nan)
+        for name, column in named.items():
+            values[:, INDEX[name]] = column
+        return cls(values)
+
+    @classmethod
+    def coerce(cls, obj):
+        """Accept a batch, a reading, a dict, a list of readings/dicts, or a columnar dict."""
+        if isinstance(obj, cls):
+            return obj
+        if isinstance(obj, PollutantReading):
+            return cls([obj.values])
+        if isinstance(obj, dict):
+            if any(np.ndim(v) == 1 for v in obj.values()):
+                return cls.from_columns(obj)
+            return cls([PollutantReading.from_dict(obj).values])
+        if isinstance(obj, np.ndarray):
+            return cls(obj)
+        return cls.from_readings(obj)
+
+    def __len__(self):
+        return len(self.values)
+
+    def column(self, name):
+        return self.values[:, INDEX[name]]
+
+    def reading(self, i):
+        return PollutantReading(self.values[i].tolist())
+
+    def epa_units(self):
+        return self.values * TO_EPA_UNITS
+
+    def aqi(self):
+        epa = self.epa_units()
+        return aqi_engine.aqi({name: epa[:, i] for i, name in enumerate(POLLUTANTS)})
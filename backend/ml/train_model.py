@@ -1,60 +1,43 @@
 import pandas as pd
 import numpy as np
-from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor, StackingRegressor
+from sklearn.ensemble import (RandomForestRegressor, GradientBoostingRegressor, HistGradientBoostingRegressor,
+                              StackingRegressor)
 from sklearn.linear_model import Ridge
 from sklearn.model_selection import train_test_split, cross_val_score
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 from sklearn.preprocessing import StandardScaler
 import joblib
+import argparse
+import json
 import os
+import sqlite3
 import sys
+import time
 
 # Ensure the directory exists
 os.makedirs('backend/ml', exist_ok=True)
 
 # Import the wrapper class from model_wrapper
 sys.path.insert(0, os.path.dirname(__file__))
-from model_wrapper import ImprovedAQIModel
-
-def calculate_sub_aqi(concentration, breakpoints):
-    """Calculate sub-AQI for a pollutant using EPA breakpoints."""
-    for (c_low, c_high, aqi_low, aqi_high) in breakpoints:
-        if c_low <= concentration <= c_high:
-            return ((aqi_high - aqi_low) / (c_high - c_low)) * (concentration - c_low) + aqi_low
-    return 500
+from model_wrapper import FEATURES, ImprovedAQIModel, engineer_features
+from compact_model import export_compact
+from forecast_model import HORIZONS, LAGS, ForecastModel, training_windows
+from pollutants import PollutantBatch
 
 def calculate_aqi_accurate(pm25, pm10, no2, so2, co, o3):
-    """Calculate AQI using proper EPA breakpoints."""
-    pm25_bp = [(0.0, 12.0, 0, 50), (12.1, 35.4, 51, 100), (35.5, 55.4, 101, 150),
-               (55.5, 150.4, 151, 200), (150.5, 250.4, 201, 300), (250.5, 500.4, 301, 500)]
-    pm10_bp = [(0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150),
-               (255, 354, 151, 200), (355, 424, 201, 300), (425, 604, 301, 500)]
-    no2_bp = [(0, 53, 0, 50), (54, 100, 51, 100), (101, 360, 101, 150),
-              (361, 649, 151, 200), (650, 1249, 201, 300), (1250, 2049, 301, 500)]
-    so2_bp = [(0, 35, 0, 50), (36, 75, 51, 100), (76, 185, 101, 150),
-              (186, 304, 151, 200), (305, 604, 201, 300), (605, 1004, 301, 500)]
-    o3_bp = [(0, 54, 0, 50), (55, 70, 51, 100), (71, 85, 101, 150),
-             (86, 105, 151, 200), (106, 200, 201, 300), (201, 504, 301, 500)]
-    co_bp = [(0.0, 4.4, 0, 50), (4.5, 9.4, 51, 100), (9.5, 12.4, 101, 150),
-             (12.5, 15.4, 151, 200), (15.5, 30.4, 201, 300), (30.5, 50.4, 301, 500)]
-    
-    aqi_values = []
-    for i in range(len(pm25)):
-        sub_aqis = [
-            calculate_sub_aqi(pm25[i], pm25_bp),
-            calculate_sub_aqi(pm10[i], pm10_bp),
-            calculate_sub_aqi(no2[i], no2_bp),
-            calculate_sub_aqi(so2[i], so2_bp),
-            calculate_sub_aqi(co[i], co_bp),
-            calculate_sub_aqi(o3[i], o3_bp),
-        ]
-        aqi_values.append(max(sub_aqis))
-    return np.array(aqi_values)
-
-def generate_realistic_data(n_samples=20000):
-    """Generate realistic synthetic data matching Open-Meteo API ranges."""
-    np.random.seed(42)
-    
+    """
+    Calculate AQI using proper EPA breakpoints (vectorized over all samples).
+    Samples are in Open-Meteo units and converted to the EPA table units the same
+    way the API does, so labels match what the app serves.
+    """
+    return PollutantBatch(np.column_stack([pm25, pm10, no2, so2, co, o3])).aqi()
+
+def sample_pollutants(rng, n_samples):
+    """
+    Realistic synthetic pollutant concentrations matching Open-Meteo API ranges,
+    drawn from `rng` (a np.random.Generator or the legacy np.random module).
+    Returns (pm25, pm10, no2, so2, co, o3).
+    """
     # Open-Meteo typically returns values in these realistic ranges
     # PM2.5: 5-300 µg/m³ (most common 10-100)
     # PM10: 10-400 µg/m³ (most common 20-150)
@@ -64,56 +47,62 @@ def generate_realistic_data(n_samples=20000):
     # CO: 0.1-5 mg/m³ (most common 0.2-1.5)
     
     # Generate base conditions (good/moderate/poor air quality mix)
-    condition = np.random.choice([0, 1, 2], n_samples, p=[0.5, 0.35, 0.15])  # good, moderate, poor
+    condition = rng.choice([0, 1, 2], n_samples, p=[0.5, 0.35, 0.15])  # good, moderate, poor
     
     # PM2.5 - primary driver of AQI
     pm25 = np.where(condition == 0, 
-                    np.random.uniform(5, 35, n_samples),      # Good
+                    rng.uniform(5, 35, n_samples),      # Good
                     np.where(condition == 1,
-                             np.random.uniform(35, 90, n_samples),   # Moderate
-                             np.random.uniform(90, 250, n_samples))) # Poor
-    pm25 += np.random.normal(0, 5, n_samples)
+                             rng.uniform(35, 90, n_samples),   # Moderate
+                             rng.uniform(90, 250, n_samples))) # Poor
+    pm25 += rng.normal(0, 5, n_samples)
     pm25 = np.clip(pm25, 1, 400)
     
     # PM10 - correlated with PM2.5
-    pm10 = pm25 * np.random.uniform(1.1, 1.8, n_samples) + np.random.normal(5, 8, n_samples)
+    pm10 = pm25 * rng.uniform(1.1, 1.8, n_samples) + rng.normal(5, 8, n_samples)
     pm10 = np.clip(pm10, 2, 500)
     
     # NO2 - traffic-related
     no2 = np.where(condition == 0,
-                   np.random.uniform(5, 40, n_samples),
+                   rng.uniform(5, 40, n_samples),
                    np.where(condition == 1,
-                            np.random.uniform(40, 80, n_samples),
-                            np.random.uniform(80, 150, n_samples)))
-    no2 += np.random.normal(0, 5, n_samples)
+                            rng.uniform(40, 80, n_samples),
+                            rng.uniform(80, 150, n_samples)))
+    no2 += rng.normal(0, 5, n_samples)
     no2 = np.clip(no2, 1, 180)
     
     # SO2 - industrial
     so2 = np.where(condition == 0,
-                   np.random.uniform(2, 20, n_samples),
+                   rng.uniform(2, 20, n_samples),
                    np.where(condition == 1,
-                            np.random.uniform(20, 50, n_samples),
-                            np.random.uniform(50, 100, n_samples)))
-    so2 += np.random.normal(0, 3, n_samples)
+                            rng.uniform(20, 50, n_samples),
+                            rng.uniform(50, 100, n_samples)))
+    so2 += rng.normal(0, 3, n_samples)
     so2 = np.clip(so2, 1, 150)
     
     # O3 - inversely correlated with NO2 somewhat
     o3 = np.where(condition == 0,
-                  np.random.uniform(15, 50, n_samples),
+                  rng.uniform(15, 50, n_samples),
                   np.where(condition == 1,
-                           np.random.uniform(30, 70, n_samples),
-                           np.random.uniform(50, 120, n_samples)))
-    o3 += np.random.normal(0, 5, n_samples)
+                           rng.uniform(30, 70, n_samples),
+                           rng.uniform(50, 120, n_samples)))
+    o3 += rng.normal(0, 5, n_samples)
     o3 = np.clip(o3, 5, 150)
     
     # CO - traffic-related (in mg/m³)
     co = np.where(condition == 0,
-                  np.random.uniform(0.1, 0.6, n_samples),
+                  rng.uniform(0.1, 0.6, n_samples),
                   np.where(condition == 1,
-                           np.random.uniform(0.5, 1.2, n_samples),
-                           np.random.uniform(1.0, 3.0, n_samples)))
-    co += np.random.normal(0, 0.1, n_samples)
+                           rng.uniform(0.5, 1.2, n_samples),
+                           rng.uniform(1.0, 3.0, n_samples)))
+    co += rng.normal(0, 0.1, n_samples)
     co = np.clip(co, 0.05, 5)
+    return pm25, pm10, no2, so2, co, o3
+
+def generate_realistic_data(n_samples=20000, seed=42):
+    """Generate realistic synthetic data matching Open-Meteo API ranges."""
+    np.random.seed(seed)
+    pm25, pm10, no2, so2, co, o3 = sample_pollutants(np.random, n_samples)
     
     # Calculate AQI using EPA breakpoints
     aqi = calculate_aqi_accurate(pm25, pm10, no2, so2, co, o3)
@@ -129,6 +118,19 @@ def generate_realistic_data(n_samples=20000):
     })
     return df
 
+def iter_training_chunks(n_samples, chunk_size=250_000, seed=42):
+    """
+    Yield (features, aqi) float32 chunks of synthetic training data, never holding
+    more than one chunk of intermediates. Each chunk has its own child seed, so the
+    stream is reproducible for a given seed and chunk size.
+    """
+    n_chunks = -(-n_samples // chunk_size)
+    for k, child in enumerate(np.random.SeedSequence(seed).spawn(n_chunks)):
+        m = min(chunk_size, n_samples - k * chunk_size)
+        raw = np.column_stack(sample_pollutants(np.random.default_rng(child), m))
+        aqi = PollutantBatch(raw).aqi()
+        yield engineer_features(raw), np.asarray(aqi, dtype=np.float32)
+
 def train_improved():
     print("=" * 50)
     print("Training Improved AQI Model")
@@ -175,7 +177,195 @@ def train_improved():
     improved_model = ImprovedAQIModel(stacking_model, scaler)
     joblib.dump(improved_model, 'backend/ml/aqi_model.joblib')
     print("   Saved to backend/ml/aqi_model.joblib")
+    export_compact(improved_model, 'backend/ml/aqi_model_compact')
+    print("   Compact export saved to backend/ml/aqi_model_compact/")
+    print("\n" + "=" * 50)
+
+def train_streaming(n_samples=2_000_000, chunk_size=250_000, seed=42, test_fraction=0.05,
+                    max_iter=500, out_path='backend/ml/aqi_model.joblib',
+                    compact_path='backend/ml/aqi_model_compact', report_path=None):
+    """
+    Large-scale variant of train_improved: data is generated chunk by chunk straight
+    into preallocated float32 arrays (~44 bytes/row, no DataFrame or float64 copies)
+    and fitted with histogram-based gradient boosting, which bins features to uint8
+    and builds trees on all cores. Trees need no scaling, so there is no scaler.
+    """
+    print("=" * 50)
+    print(f"Training AQI Model (streaming, {n_samples} rows, seed {seed})")
+    print("=" * 50)
+    timings = {}
+
+    print("\n1. Generating data...")
+    start = time.perf_counter()
+    X = np.empty((n_samples, len(FEATURES)), dtype=np.float32)
+    y = np.empty(n_samples, dtype=np.float32)
+    row = 0
+    for features, aqi in iter_training_chunks(n_samples, chunk_size, seed):
+        X[row:row + len(aqi)] = features
+        y[row:row + len(aqi)] = aqi
+        row += len(aqi)
+    timings["generate"] = time.perf_counter() - start
+    # Rows are i.i.d., so the tail is as good a test set as a shuffled split
+    n_test = max(1, int(n_samples * test_fraction))
+    X_train, y_train, X_test, y_test = X[:-n_test], y[:-n_test], X[-n_test:], y[-n_test:]
+    print(f"   Train: {len(X_train)}, Test: {len(X_test)}, {(X.nbytes + y.nbytes) / 2**20:.0f} MiB")
+
+    print("\n2. Training histogram gradient boosting...")
+    start = time.perf_counter()
+    model = HistGradientBoostingRegressor(
+        max_iter=max_iter, learning_rate=0.1, max_leaf_nodes=63, min_samples_leaf=20,
+        early_stopping=True, validation_fraction=0.1, n_iter_no_change=20, random_state=seed,
+    )
+    model.fit(X_train, y_train)
+    timings["fit"] = time.perf_counter() - start
+    print(f"   Iterations: {model.n_iter_}")
+
+    print("\n3. Evaluation:")
+    start = time.perf_counter()
+    improved_model = ImprovedAQIModel(model, None)
+    y_pred = improved_model.predict_batch(X_test)
+    metrics = {"mae": float(mean_absolute_error(y_test, y_pred)), "r2": float(r2_score(y_test, y_pred))}
+    timings["evaluate"] = time.perf_counter() - start
+    print(f"   MAE: {metrics['mae']:.2f}")
+    print(f"   R²:  {metrics['r2']:.4f}")
+
+    print("\n4. Saving model...")
+    start = time.perf_counter()
+    joblib.dump(improved_model, out_path)
+    print(f"   Saved to {out_path}")
+    export_compact(improved_model, compact_path)
+    print(f"   Compact export saved to {compact_path}/")
+    timings["save"] = time.perf_counter() - start
+
+    print("\nTimings:")
+    for stage, seconds in timings.items():
+        print(f"   {stage:<9} {seconds:8.2f}s")
+    report = {
+        "rows": n_samples, "chunk_size": chunk_size, "seed": seed, "iterations": int(model.n_iter_),
+        "cpus": os.cpu_count(), "metrics": metrics,
+        "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+    }
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"   Report saved to {report_path}")
     print("\n" + "=" * 50)
+    return report
+
+# Cells are stored in integer 1e-4 degrees (see backend/history.py)
+HISTORY_CELL_SCALE = 10000
+
+
+def load_history_series(db_path, now=None):
+    """
+    Hourly AQI series per cell from the history store: {(lat, lng): (start_epoch, values)}.
+    Observations win; hours without one use the latest recorded Open-Meteo value for
+    that hour (past hours only, so no upstream forecast leaks into the targets).
+    """
+    now = now or time.time()
+    db = sqlite3.connect(db_path)
+    try:
+        rows = db.execute(
+            "SELECT cell_lat, cell_lng, kind, ts, aqi FROM aqi_history"
+            " WHERE aqi IS NOT NULL AND ts <= ? ORDER BY cell_lat, cell_lng, kind DESC, ts",
+            (int(now),),
+        ).fetchall()
+    finally:
+        db.close()
+    hourly = {}
+    # kind DESC: forecast rows first, so observations overwrite them
+    for cell_lat, cell_lng, kind, ts, aqi in rows:
+        hourly.setdefault((cell_lat / HISTORY_CELL_SCALE, cell_lng / HISTORY_CELL_SCALE), {})[ts // 3600] = aqi
+    series = {}
+    for cell, by_hour in hourly.items():
+        first, last = min(by_hour), max(by_hour)
+        values = np.full(last - first + 1, np.nan)
+        hours = np.fromiter(by_hour.keys(), dtype=np.int64)
+        values[hours - first] = np.fromiter(by_hour.values(), dtype=np.float64)
+        series[cell] = (first * 3600, values)
+    return series
+
+
+def synthetic_series(n_cells=200, hours=24 * 60, seed=42):
+    """Hourly AQI with a diurnal cycle (morning/evening peaks) and AR(1) weather noise."""
+    rng = np.random.default_rng(seed)
+    start = 1_700_000_000 // 3600 * 3600
+    series = {}
+    for _ in range(n_cells):
+        lat, lng = rng.uniform(-50, 60), rng.uniform(-180, 180)
+        base = rng.uniform(20, 160)
+        local = (np.arange(hours) + lng / 15) % 24
+        diurnal = 0.25 * np.exp(-((local - 8.5) ** 2) / 4) + 0.3 * np.exp(-((local - 19) ** 2) / 6) - 0.15 * np.exp(-((local - 3.5) ** 2) / 5)
+        noise = np.empty(hours)
+        noise[0] = 0.0
+        shocks = rng.normal(0, 0.06, hours)
+        for t in range(1, hours):
+            noise[t] = 0.92 * noise[t - 1] + shocks[t]
+        values = base * (1 + diurnal + noise)
+        # Occasional gaps, like cells nobody asked for
+        values[rng.random(hours) < 0.02] = np.nan
+        series[(round(lat, 2), round(lng, 2))] = (start, np.clip(values, 0, 500))
+    return series
+
+
+def train_forecaster(history_path='backend/data/history.sqlite3', out_path='backend/ml/aqi_forecast',
+                     min_samples=2000, ridge=1.0):
+    print("=" * 50)
+    print("Training AQI Forecast Model")
+    print("=" * 50)
+
+    print("\n1. Loading history...")
+    series = load_history_series(history_path) if os.path.exists(history_path) else {}
+    parts = [training_windows(values, start, cell[1]) for cell, (start, values) in series.items()]
+    n_real = sum(len(p[0]) for p in parts)
+    print(f"   Cells: {len(series)}, windows: {n_real}")
+    source = "history"
+    if n_real < min_samples:
+        print(f"   Fewer than {min_samples} windows, adding synthetic series")
+        parts += [training_windows(values, start, cell[1]) for cell, (start, values) in synthetic_series().items()]
+        source = "history+synthetic" if n_real else "synthetic"
+
+    lags = np.concatenate([p[0] for p in parts])
+    hours = np.concatenate([p[1] for p in parts])
+    targets = np.concatenate([p[2] for p in parts])
+    X_train, X_test, h_train, h_test, y_train, y_test = train_test_split(
+        lags, hours, targets, test_size=0.2, random_state=42
+    )
+    print(f"   Train: {len(X_train)}, Test: {len(X_test)} (lags={LAGS}, horizons={list(HORIZONS)})")
+
+    print("\n2. Fitting ridge AR model...")
+    model = ForecastModel.fit(X_train, h_train, y_train, HORIZONS, ridge=ridge)
+
+    print("\n3. Evaluation (MAE, model vs. persistence):")
+    y_pred = model.predict(X_test, h_test)
+    baseline = ForecastModel.persistence().predict(X_test, h_test)
+    mae = {}
+    for j, h in enumerate(HORIZONS):
+        mae[h] = float(mean_absolute_error(y_test[:, j], y_pred[:, j]))
+        print(f"   +{h}h: {mae[h]:.2f} vs {mean_absolute_error(y_test[:, j], baseline[:, j]):.2f}")
+
+    print("\n4. Saving model...")
+    model.meta.update({"source": source, "samples": int(len(lags)), "mae": {str(h): round(v, 3) for h, v in mae.items()}})
+    model.save(out_path)
+    print(f"   Saved to {out_path}/")
+    print("\n" + "=" * 50)
+    return model
+
 
 if __name__ == "__main__":
-    train_improved()
+    parser = argparse.ArgumentParser(description="Train the AirZen models")
+    parser.add_argument("--forecast", action="store_true", help="train the AQI forecaster instead")
+    parser.add_argument("--history", default="backend/data/history.sqlite3", help="history store to train on")
+    parser.add_argument("--streaming", action="store_true",
+                        help="chunked float32 data + histogram gradient boosting (millions of rows)")
+    parser.add_argument("--rows", type=int, default=2_000_000, help="streaming: rows to generate")
+    parser.add_argument("--chunk-size", type=int, default=250_000, help="streaming: rows per generated chunk")
+    parser.add_argument("--seed", type=int, default=42, help="streaming: random seed")
+    parser.add_argument("--report", help="streaming: write timings and metrics as JSON here")
+    args = parser.parse_args()
+    if args.forecast:
+        train_forecaster(args.history)
+    elif args.streaming:
+        train_streaming(args.rows, args.chunk_size, args.seed, report_path=args.report)
+    else:
+        train_improved()
@@ -0,0 +1,144 @@
+"""Warms the AQI cache for popular cells right after each hourly upstream update.
+
+Requests are counted per grid cell with exponential decay, so the ranking
+follows recent demand. Shortly after Open-Meteo publishes new values (when
+the cached snapshots expire), the top-N cells are refetched in batched
+multi-location calls, a bounded number at a time, so the first users of the
+hour hit a warm cache instead of the upstream.
+"""
+import asyncio
+import heapq
+import time
+
+from cache import seconds_until_upstream_update
+
+
+class PopularityCounter:
+    """Decayed request counts per key; `decay()` ages every count by `factor`."""
+
+    def __init__(self, factor=0.5, max_keys=20000, floor=0.05):
+        self.factor = factor
+        self.max_keys = max_keys
+        self.floor = floor
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.counts)
+
+    def hit(self, key, weight=1.0):
+        self.counts[key] = self.counts.get(key, 0.0) + weight
+        if len(self.counts) > self.max_keys:
+            self._prune(self.max_keys // 2)
+
+    def top(self, n):
+        return heapq.nlargest(n, self.counts, key=self.counts.__getitem__)
+
+    def decay(self):
+        self.counts = {
+            key: count * self.factor
+            for key, count in self.counts.items()
+            if count * self.factor >= self.floor
+        }
+
+    def _prune(self, keep):
+        self.counts = {key: self.counts[key] for key in self.top(keep)}
+
+
+class PrefetchScheduler:
+    """
+    `load_many(cells)` fetches and caches a list of cells with one upstream call;
+    `is_fresh(cell)` tells whether a cell is already cached for the new hour.
+    `pinned(limit)`, if given, is an async function returning up to `limit` cells refreshed every hour
+    whatever their popularity (e.g. the most subscribed alert cells). They take
+    at most `pinned_share` of the `top_n` budget and popular cells fill the rest.
+    `claim()`, if given, is asked before each hourly run; with several workers
+    sharing a cache only the one whose claim succeeds prefetches.
+    """
+
+    def __init__(self, load_many, is_fresh, top_n=300, chunk_size=50, concurrency=4,
+                 ttl_offset=300, lag=5.0, claim=None, pinned=None, pinned_share=0.5):
+        self.load_many = load_many
+        self.is_fresh = is_fresh
+        self.claim = claim
+        self.pinned = pinned
+        self.pinned_share = pinned_share
+        self.top_n = top_n
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.ttl_offset = ttl_offset
+        self.lag = lag
+        self.popularity = PopularityCounter()
+        self.runs = 0
+        self.warmed = 0
+        self.failed_chunks = 0
+        self.last_run = None
+        self.last_duration = None
+        self._task = None
+
+    def record(self, cell):
+        self.popularity.hit(cell)
+
+    async def start(self):
+        if self._task is None and self.top_n > 0:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Cached snapshots expire at the upstream update; start just after it
+            await asyncio.sleep(seconds_until_upstream_update(self.ttl_offset, minimum=0) + self.lag)
+            if self.claim is not None and not await asyncio.to_thread(self.claim):
+                self.popularity.decay()
+                continue
+            try:
+                await self.prefetch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Prefetch error: {e}")
+
+    async def prefetch(self):
+        """Fetch the top-N cells that are not fresh yet; returns how many were warmed."""
+        start = time.monotonic()
+        cells = []
+        if self.pinned is not None:
+            cells = list(dict.fromkeys(await self.pinned(int(self.top_n * self.pinned_share))))
+        pinned = set(cells)
+        cells += [cell for cell in self.popularity.top(self.top_n) if cell not in pinned][:self.top_n - len(cells)]
+        cells = [cell for cell in cells if not self.is_fresh(cell)]
+        self.popularity.decay()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def load(chunk):
+            async with semaphore:
+                try:
+                    return len(await self.load_many(chunk))
+                except Exception as e:
+                    print(f"Prefetch chunk error: {e}")
+                    self.failed_chunks += 1
+                    return 0
+
+        chunks = [cells[k:k + self.chunk_size] for k in range(0, len(cells), self.chunk_size)]
+        warmed = sum(await asyncio.gather(*(load(chunk) for chunk in chunks)))
+        self.runs += 1
+        self.warmed += warmed
+        self.last_run = time.time()
+        self.last_duration = time.monotonic() - start
+        return warmed
+
+    def snapshot_stats(self):
+        return {
+            "tracked_cells": len(self.popularity),
+            "top_n": self.top_n,
+            "runs": self.runs,
+            "warmed": self.warmed,
+            "failed_chunks": self.failed_chunks,
+            "last_run": self.last_run,
+            "last_duration_ms": round(self.last_duration * 1000, 1) if self.last_duration is not None else None,
+            "next_run_in": round(seconds_until_upstream_update(self.ttl_offset, minimum=0) + self.lag),
+        }
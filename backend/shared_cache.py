@@ -0,0 +1,336 @@
+"""Cache tier shared by every worker process on a host (AIRZEN_CACHE_BACKEND=sqlite).
+
+With several uvicorn workers each process would otherwise hold its own copy
+of every cached snapshot and fetch the same cell from the upstream on its
+own. `SharedStore` is a SQLite file in WAL mode on local disk: entries (JSON
+values with wall-clock expiry) and short leases. `SharedTTLCache` is a
+drop-in TTLCache that keeps a small per-process LRU in front of the store,
+writes behind to it, and turns its single-flight fill into a cross-process
+one: the worker holding a key's lease fetches, the others wait for the value
+to appear in the store. `SharedTokenBucket` is a TokenBucket whose schedule
+lives in the store, so a rate limit holds for all workers together.
+
+Store calls are short statements (tens of microseconds on local disk). The
+event loop never waits on a write:
+- Cache sets and deletes are queued to the store's writer thread, which also
+  runs the periodic prune.
+- The fill path (leases, polling, writing the fetched value) and rate limit
+  slots run in worker threads.
+- Lookups, which stay synchronous, use a separate read-only connection that
+  WAL mode never blocks behind writers.
+A short busy timeout bounds the rare lock wait. A call that times out
+degrades to a cache miss, a skipped write or a refused lease (counted in
+`busy`).
+"""
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from cache import TTLCache
+from upstream import RateLimited
+
+
+def _json_default(value):
+    # numpy scalars and arrays in computed payloads
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _key_text(key):
+    return json.dumps(list(key) if isinstance(key, tuple) else key, separators=(",", ":"))
+
+
+class SharedStore:
+    def __init__(self, path, busy_timeout=0.1, keep_stale=24 * 3600, prune_every=500):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.keep_stale = keep_stale
+        self.prune_every = prune_every
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._puts = 0
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._deleting = set()
+        self._writes = queue.SimpleQueue()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, stored_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        # Size pruning keeps the newest `maxsize` entries per namespace
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_entries_stored ON cache_entries (namespace, stored_at)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_leases ("
+            " name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_slots ("
+            " name TEXT PRIMARY KEY, next_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        # Lookups from the event loop never queue behind the write connection's lock
+        self.reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout)
+        self.reader.execute("PRAGMA query_only=ON")
+        self._writer = threading.Thread(target=self._write_loop, name="shared-store-writer", daemon=True)
+        self._writer.start()
+
+    def _run(self, work, default=None, read=False):
+        """work(db) under its lock; `default` if the file stays locked past the busy timeout."""
+        lock, db = (self._read_lock, self.reader) if read else (self._lock, self.db)
+        with lock:
+            try:
+                return work(db)
+            except sqlite3.OperationalError as e:
+                if e.sqlite_errorcode not in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED):
+                    raise
+                self.busy += 1
+                return default
+
+    def _write_loop(self):
+        while True:
+            write = self._writes.get()
+            if write is None:
+                return
+            try:
+                write()
+            except Exception as e:
+                print(f"Shared store write error: {e}")
+
+    def get(self, namespace, key):
+        """(value, expires_at, stored_at), expired or not, or None."""
+        text = _key_text(key)
+        if (namespace, text) in self._deleting:
+            return None
+        row = self._run(lambda db: db.execute(
+            "SELECT value, expires_at, stored_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, text),
+        ).fetchone(), read=True)
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def put_later(self, namespace, key, value, ttl, maxsize=None):
+        """put() on the writer thread; returns at once."""
+        self._writes.put(lambda: self.put(namespace, key, value, ttl, maxsize))
+
+    def delete_later(self, namespace, key):
+        """delete() on the writer thread; get() already misses the key until it has run."""
+        pending = (namespace, _key_text(key))
+        self._deleting.add(pending)
+
+        def write():
+            try:
+                self.delete(namespace, key)
+            finally:
+                self._deleting.discard(pending)
+
+        self._writes.put(write)
+
+    def put(self, namespace, key, value, ttl, maxsize=None):
+        now = time.time()
+        text = json.dumps(value, separators=(",", ":"), default=_json_default)
+
+        def work(db):
+            db.execute(
+                "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?)",
+                (namespace, _key_text(key), text, now + ttl, now),
+            )
+            self._puts += 1
+            if self._puts % self.prune_every == 0:
+                self._prune(namespace, maxsize, now)
+
+        self._run(work)
+
+    def _prune(self, namespace, maxsize, now):
+        # Expired entries are kept for a while as stale fallbacks
+        self.db.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND expires_at < ?",
+            (namespace, now - self.keep_stale),
+        )
+        if maxsize:
+            self.db.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND stored_at < ("
+                " SELECT stored_at FROM cache_entries WHERE namespace = ?"
+                " ORDER BY stored_at DESC LIMIT 1 OFFSET ?)",
+                (namespace, namespace, maxsize),
+            )
+
+    def delete(self, namespace, key):
+        self._run(lambda db: db.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, _key_text(key))
+        ))
+
+    def acquire(self, name, ttl):
+        """Take the lease `name` for `ttl` seconds if no other process holds an unexpired one."""
+        now = time.time()
+        return self._run(lambda db: db.execute(
+            "INSERT INTO cache_leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE"
+            " SET owner = excluded.owner, expires_at = excluded.expires_at"
+            " WHERE cache_leases.expires_at < ? OR cache_leases.owner = excluded.owner",
+            (name, self.owner, now + ttl, now),
+        ).rowcount == 1, default=False)
+
+    def release(self, name):
+        # If the file is locked the lease is left to expire
+        self._run(lambda db: db.execute(
+            "DELETE FROM cache_leases WHERE name = ? AND owner = ?", (name, self.owner)
+        ))
+
+    def reserve(self, name, interval, burst=1, max_wait=None):
+        """
+        Book the next of a series of slots `interval` seconds apart (up to `burst`
+        may be booked ahead of time). Returns the seconds to wait for the booked
+        slot, or None without booking if that would be more than `max_wait`.
+        """
+        now = time.time()
+        # next_at is when the slot after the last booked one starts
+        ahead = (burst - 1) * interval
+        limit = float("inf") if max_wait is None else max_wait
+        row = self._run(lambda db: db.execute(
+            "INSERT INTO cache_slots VALUES (?, ?) ON CONFLICT (name) DO UPDATE"
+            " SET next_at = MAX(next_at, ?) + ?"
+            " WHERE MAX(next_at, ?) - ? - ? <= ? RETURNING next_at",
+            (name, now + interval, now, interval, now, now, ahead, limit),
+        ).fetchone())
+        if row is None:
+            return None
+        return max(0.0, row[0] - interval - now - ahead)
+
+    def close(self):
+        # Pending writes are flushed first
+        self._writes.put(None)
+        self._writer.join()
+        self.reader.close()
+        self.db.close()
+
+
+class SharedTTLCache(TTLCache):
+    """
+    TTLCache backed by a SharedStore namespace. Values must be JSON-serializable.
+    `memory_size` bounds the per-process copy; `maxsize` bounds the shared one.
+    """
+
+    def __init__(self, store, namespace, maxsize=10000, ttl=3600, memory_size=2000,
+                 lease_timeout=15.0, poll_interval=0.05):
+        super().__init__(maxsize=memory_size, ttl=ttl)
+        self.store = store
+        self.namespace = namespace
+        self.shared_maxsize = maxsize
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.shared_hits = 0
+        self.waited_fills = 0
+
+    def _load_shared(self, key, fresh_only=True):
+        """Copy the store's entry into the local tier; returns (value, age) or (None, None)."""
+        return self._keep(key, self.store.get(self.namespace, key), fresh_only)
+
+    def _keep(self, key, row, fresh_only=True):
+        if row is None:
+            return None, None
+        value, expires_at, stored_at = row
+        now = time.time()
+        if expires_at > now:
+            super().set(key, value, expires_at - now, age=now - stored_at)
+        elif fresh_only:
+            return None, None
+        return value, now - stored_at
+
+    def get(self, key, count=True):
+        value = super().get(key, count=False)
+        if value is None:
+            value, _ = self._load_shared(key)
+            if value is not None:
+                self.shared_hits += 1
+        if count:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get_stale(self, key):
+        value, age = super().get_stale(key)
+        if value is None or super().get(key, count=False) is None:
+            # Another worker may hold a newer copy than our expired one
+            shared, shared_age = self._load_shared(key, fresh_only=False)
+            if shared is not None and (age is None or shared_age < age):
+                return shared, shared_age
+        return value, age
+
+    def set(self, key, value, ttl=None, age=0.0):
+        ttl = self.ttl if ttl is None else ttl
+        super().set(key, value, ttl, age)
+        self.store.put_later(self.namespace, key, value, ttl, self.shared_maxsize)
+
+    def delete(self, key):
+        super().delete(key)
+        self.store.delete_later(self.namespace, key)
+
+    async def _waited_value(self, key):
+        row = await asyncio.to_thread(self.store.get, self.namespace, key)
+        value, _ = self._keep(key, row)
+        if value is not None:
+            self.waited_fills += 1
+        return value
+
+    async def _fill(self, key, fetch, ttl):
+        lease = f"{self.namespace}:{_key_text(key)}"
+        waited = False
+        # Another worker holds the lease: wait for its value (or for the lease to
+        # be released or expire, e.g. its fetch failed, and then fetch ourselves)
+        while not await asyncio.to_thread(self.store.acquire, lease, self.lease_timeout):
+            waited = True
+            await asyncio.sleep(self.poll_interval)
+            value = await self._waited_value(key)
+            if value is not None:
+                return value
+        try:
+            if waited:
+                value = await self._waited_value(key)
+                if value is not None:
+                    return value
+            value = await fetch()
+            if value is not None:
+                ttl = ttl() if callable(ttl) else ttl
+                ttl = self.ttl if ttl is None else ttl
+                TTLCache.set(self, key, value, ttl)
+                await asyncio.to_thread(self.store.put, self.namespace, key, value, ttl, self.shared_maxsize)
+            return value
+        finally:
+            await asyncio.to_thread(self.store.release, lease)
+
+
+class SharedTokenBucket:
+    """TokenBucket (same `acquire`) spacing calls from every worker on `store`."""
+
+    def __init__(self, store, name, rate, burst=1):
+        self.store = store
+        self.name = f"bucket:{name}"
+        self.rate = rate
+        self.burst = burst
+
+    async def acquire(self, max_wait=None):
+        wait = await asyncio.to_thread(self.store.reserve, self.name, 1 / self.rate, self.burst, max_wait)
+        if wait is None:
+            raise RateLimited("Upstream rate limit: no slot within the wait budget")
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def make_cache(store, namespace, maxsize, ttl=3600, memory_size=2000):
+    """A SharedTTLCache on `store`, or a plain per-process TTLCache if store is None."""
+    if store is None:
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    return SharedTTLCache(store, namespace, maxsize=maxsize, ttl=ttl, memory_size=min(memory_size, maxsize))
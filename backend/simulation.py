@@ -0,0 +1,140 @@
+"""Source-reduction simulation for /simulate.
+
+A scenario scales each pollution source by a multiplier (1.0 = unchanged);
+each pollutant is then scaled by  prod_s (1 - impact[s, p] + impact[s, p] * m_s).
+For one baseline, a whole grid of multiplier combinations is evaluated in a
+single vectorized pass into a "response surface" (AQI per grid point), which
+is cached by baseline hash so later slider positions become lookups.
+IMPACT_MATRIX is also what attribution.py unmixes readings against.
+"""
+import hashlib
+import itertools
+
+import numpy as np
+
+from pollutants import POLLUTANTS, PollutantBatch, PollutantReading
+
+# Impact Factors (Source -> Pollutant contribution)
+# These are approximations based on environmental science literature
+IMPACTS = {
+    "traffic":      {"NO2": 0.6, "CO": 0.8, "PM2.5": 0.3, "O3": 0.5},
+    "industrial":   {"SO2": 0.5, "PM10": 0.3, "PM2.5": 0.3},
+    "power":        {"SO2": 0.5, "NO2": 0.2},
+    "biomass":      {"PM2.5": 0.2, "CO": 0.2},
+    "dust":         {"PM10": 0.6, "PM2.5": 0.1}
+}
+SOURCES = tuple(IMPACTS)
+
+# (n_sources, n_pollutants)
+IMPACT_MATRIX = np.array([[IMPACTS[s].get(p, 0.0) for p in POLLUTANTS] for s in SOURCES])
+
+# Sliders in Simulator.jsx: the first four sources, 0..2 in steps of 0.1
+SLIDER_SOURCES = ("traffic", "industrial", "power", "biomass")
+SLIDER_MIN, SLIDER_MAX, SLIDER_STEP = 0.0, 2.0, 0.1
+
+MAX_GRID_POINTS = 500_000
+
+
+def pollutant_factors(multipliers, sources=SOURCES):
+    """
+    (..., len(sources)) multipliers -> (..., len(POLLUTANTS)) pollutant scale factors.
+    Formula per source: New = Old * ( (1 - Impact) + (Impact * Multiplier) )
+    """
+    multipliers = np.asarray(multipliers, dtype=np.float64)
+    factors = np.ones(multipliers.shape[:-1] + (len(POLLUTANTS),))
+    for j, source in enumerate(sources):
+        impact = IMPACT_MATRIX[SOURCES.index(source)]
+        factors *= 1.0 - impact + impact * multipliers[..., j:j + 1]
+    return factors
+
+
+def evaluate_scenarios(reading, multipliers, sources=SOURCES):
+    """AQI of `reading` under each row of an (M, len(sources)) multiplier array."""
+    values = np.asarray(PollutantReading.coerce(reading).values) * pollutant_factors(multipliers, sources)
+    return PollutantBatch(values.reshape(-1, len(POLLUTANTS))).aqi().reshape(np.shape(multipliers)[:-1])
+
+
+def axis_length(step=SLIDER_STEP, low=SLIDER_MIN, high=SLIDER_MAX):
+    return int(round((high - low) / step)) + 1
+
+
+def grid_points(step, n_sources, low=SLIDER_MIN, high=SLIDER_MAX):
+    """Points of a grid_axis(step) ** n_sources surface, without building it."""
+    return axis_length(step, low, high) ** n_sources
+
+
+def grid_axis(step=SLIDER_STEP, low=SLIDER_MIN, high=SLIDER_MAX):
+    return np.round(np.linspace(low, high, axis_length(step, low, high)), 6)
+
+
+def baseline_hash(reading, sources, axis):
+    """Stable key for a (baseline, sources, axis) surface; values rounded like the API shows them."""
+    reading = PollutantReading.coerce(reading)
+    parts = [f"{v:.3f}" if v == v else "nan" for v in reading.values]
+    parts += list(sources) + [f"{a:g}" for a in axis]
+    return hashlib.blake2b("|".join(parts).encode(), digest_size=12).hexdigest()
+
+
+class ResponseSurface:
+    """AQI over a regular grid of multipliers for one baseline reading."""
+
+    def __init__(self, key, sources, axis, aqi, original_aqi):
+        self.key = key
+        self.sources = tuple(sources)
+        self.axis = axis
+        self.aqi = aqi
+        self.original_aqi = original_aqi
+
+    @classmethod
+    def compute(cls, reading, sources=SLIDER_SOURCES, axis=None):
+        reading = PollutantReading.coerce(reading)
+        axis = grid_axis() if axis is None else np.asarray(axis, dtype=np.float64)
+        n_points = len(axis) ** len(sources)
+        if n_points > MAX_GRID_POINTS:
+            raise ValueError(f"Grid has {n_points} points, limit is {MAX_GRID_POINTS}")
+        mesh = np.stack(np.meshgrid(*([axis] * len(sources)), indexing="ij"), axis=-1)
+        aqi = evaluate_scenarios(reading, mesh, sources)
+        return cls(baseline_hash(reading, sources, axis), sources, axis, aqi, reading.aqi())
+
+    def covers(self, multipliers):
+        """True if every multiplier is for a grid source and inside the grid."""
+        low, high = self.axis[0], self.axis[-1]
+        return all(
+            source in self.sources and low <= value <= high
+            for source, value in multipliers.items() if source in IMPACTS
+        )
+
+    def lookup(self, multipliers):
+        """AQI for a multiplier dict, multilinear-interpolated between grid points (exact on them)."""
+        positions = []
+        for source in self.sources:
+            value = float(multipliers.get(source, 1.0))
+            i = int(np.clip(np.searchsorted(self.axis, value, side="right") - 1, 0, len(self.axis) - 2))
+            t = (value - self.axis[i]) / (self.axis[i + 1] - self.axis[i])
+            # Snap float noise (0.30000000000000004) onto the grid point
+            if abs(t) < 1e-9:
+                t = 0.0
+            elif abs(t - 1) < 1e-9:
+                i, t = i + 1, 0.0
+            positions.append((i, t))
+        total = 0.0
+        for corner in itertools.product((0, 1), repeat=len(positions)):
+            weight = 1.0
+            index = []
+            for (i, t), bit in zip(positions, corner):
+                weight *= t if bit else 1.0 - t
+                index.append(min(i + bit, len(self.axis) - 1))
+            if weight:
+                total += weight * self.aqi[tuple(index)]
+        return float(total)
+
+    def to_dict(self):
+        return {
+            "baseline": self.key,
+            "sources": list(self.sources),
+            "axis": self.axis.tolist(),
+            "shape": list(self.aqi.shape),
+            "original_aqi": round(self.original_aqi),
+            # Row-major (C order) over `sources`
+            "aqi": np.rint(self.aqi).astype(np.int32).ravel().tolist(),
+        }
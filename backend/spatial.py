@@ -0,0 +1,216 @@
+"""In-memory spatial index over every location we hold an AQI value for.
+
+Points (cached grid cells and ingested stations) live in fixed-size lat/lng
+buckets, so an update is a dict move and a query only visits the buckets
+around it: k-nearest searches ring by ring outwards until no closer point
+can remain, bounding boxes walk the covered buckets (or the occupied ones,
+whichever is fewer). Values near known points can then be estimated locally
+by inverse-distance weighting instead of calling the upstream.
+"""
+import heapq
+import math
+import time
+from collections import OrderedDict
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Point:
+    __slots__ = ("key", "lat", "lng", "aqi", "kind", "updated", "bucket")
+
+    def __init__(self, key, lat, lng, aqi, kind, updated, bucket):
+        self.key = key
+        self.lat = lat
+        self.lng = lng
+        self.aqi = aqi
+        self.kind = kind
+        self.updated = updated
+        self.bucket = bucket
+
+    def to_dict(self, now=None):
+        return {
+            "lat": self.lat,
+            "lng": self.lng,
+            "aqi": self.aqi,
+            "kind": self.kind,
+            "age_seconds": round((now or time.time()) - self.updated),
+        }
+
+
+class SpatialIndex:
+    """
+    Bucketed point index. `key` identifies a point (a cell tuple, a station id);
+    updating an existing key moves it. Holds at most `max_points`, dropping the
+    least recently updated.
+    """
+
+    def __init__(self, bucket_deg=1.0, max_points=200_000):
+        self.bucket_deg = bucket_deg
+        self.max_points = max_points
+        self._lng_buckets = int(math.ceil(360 / bucket_deg))
+        self._buckets = {}
+        self._points = OrderedDict()
+
+    def __len__(self):
+        return len(self._points)
+
+    def _bucket(self, lat, lng):
+        i = int(math.floor((lat + 90) / self.bucket_deg))
+        j = int(math.floor((lng + 180) / self.bucket_deg)) % self._lng_buckets
+        return i, j
+
+    def update(self, key, lat, lng, aqi, kind="cell", updated=None):
+        self.remove(key)
+        bucket = self._bucket(lat, lng)
+        point = Point(key, lat, lng, aqi, kind, updated or time.time(), bucket)
+        self._points[key] = point
+        self._buckets.setdefault(bucket, {})[key] = point
+        while len(self._points) > self.max_points:
+            self.remove(next(iter(self._points)))
+
+    def remove(self, key):
+        point = self._points.pop(key, None)
+        if point is None:
+            return
+        bucket = self._buckets[point.bucket]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[point.bucket]
+
+    def get(self, key):
+        return self._points.get(key)
+
+    def _ring(self, i, j, r):
+        """Buckets at Chebyshev distance exactly r from (i, j)."""
+        n_lat = int(math.ceil(180 / self.bucket_deg))
+        if r == 0:
+            cells = [(i, j)]
+        else:
+            cells = [(i + di, j + dj) for di in (-r, r) for dj in range(-r, r + 1)]
+            cells += [(i + di, j + dj) for di in range(-r + 1, r) for dj in (-r, r)]
+        seen = set()
+        for bi, bj in cells:
+            if 0 <= bi < n_lat:
+                key = (bi, bj % self._lng_buckets)
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def nearest(self, lat, lng, k=1, max_distance_km=None, max_age=None, accept=None):
+        """
+        Up to `k` points closest to (lat, lng), as [(distance_km, Point)] nearest first.
+        `max_age` (seconds) skips old points; `accept(point)` filters further and is only
+        asked about points that are in range and would enter the current best k.
+        """
+        now = time.time()
+        i, j = self._bucket(lat, lng)
+        max_rings = max(int(math.ceil(180 / self.bucket_deg)), self._lng_buckets // 2)
+        if max_distance_km is not None:
+            # Buckets get narrower towards the poles, so more rings span the same distance
+            edge = min(89.0, abs(lat) + max_distance_km / KM_PER_DEGREE)
+            bucket_km = self.bucket_deg * KM_PER_DEGREE * math.cos(math.radians(edge))
+            max_rings = min(max_rings, int(math.ceil(max_distance_km / bucket_km)) + 1)
+        # Max-heap (negated distances) of the best k so far
+        best = []
+        visited = 0
+        probes = 0
+        for r in range(max_rings + 1):
+            probes += 8 * r or 1
+            if probes * 8 > len(self._points):
+                # Rings have grown past the data (sparse index, or near a pole where
+                # longitude rings bound little): one pass over everything is cheaper
+                best, rings = [], [self._buckets]
+            else:
+                rings = [self._ring(i, j, r)]
+            for bucket in (b for ring in rings for b in ring):
+                points = self._buckets.get(bucket)
+                if not points:
+                    continue
+                visited += len(points)
+                for point in points.values():
+                    if max_age is not None and now - point.updated > max_age:
+                        continue
+                    d = haversine_km(lat, lng, point.lat, point.lng)
+                    if max_distance_km is not None and d > max_distance_km:
+                        continue
+                    full = len(best) >= k
+                    if full and d >= -best[0][0]:
+                        continue
+                    # Last: accept() may be costly (e.g. a cache lookup)
+                    if accept is not None and not accept(point):
+                        continue
+                    if not full:
+                        heapq.heappush(best, (-d, id(point), point))
+                    else:
+                        heapq.heapreplace(best, (-d, id(point), point))
+            if visited >= len(self._points) or rings[0] is self._buckets:
+                break
+            if len(best) >= k and self._ring_bound_km(lat, r) >= -best[0][0]:
+                break
+        return [(-neg_d, point) for neg_d, _, point in sorted(best, reverse=True)]
+
+    def _ring_bound_km(self, lat, r):
+        """Lower bound on the distance from a point to anything outside the first r rings around it."""
+        span = r * self.bucket_deg
+        # Outside the rings a point is >= span away in latitude, or >= span away in
+        # longitude, i.e. at least as far as the meridian `span` degrees over is
+        cross_track = math.cos(math.radians(lat)) * math.sin(math.radians(min(span, 90.0)))
+        lng_bound = EARTH_RADIUS_KM * math.asin(min(1.0, cross_track))
+        return min(span * KM_PER_DEGREE, lng_bound)
+
+    def bbox(self, south, west, north, east, max_age=None, limit=None):
+        """Points inside the box (west > east means it crosses the antimeridian)."""
+        now = time.time()
+        crosses = west > east
+        i0, j0 = self._bucket(south, west)
+        i1, _ = self._bucket(north, east)
+        span_east = east + 360 if crosses else east
+        width = int(math.floor((span_east + 180) / self.bucket_deg)) - int(math.floor((west + 180) / self.bucket_deg)) + 1
+        width = min(width, self._lng_buckets)
+        if (i1 - i0 + 1) * width > len(self._buckets):
+            buckets = list(self._buckets)
+        else:
+            buckets = [(bi, (j0 + dj) % self._lng_buckets) for bi in range(i0, i1 + 1) for dj in range(width)]
+        out = []
+        for bucket in buckets:
+            for point in self._buckets.get(bucket, {}).values():
+                if not south <= point.lat <= north:
+                    continue
+                if crosses:
+                    if not (point.lng >= west or point.lng <= east):
+                        continue
+                elif not west <= point.lng <= east:
+                    continue
+                if max_age is not None and now - point.updated > max_age:
+                    continue
+                out.append(point)
+                if limit is not None and len(out) >= limit:
+                    return out
+        return out
+
+    def interpolate(self, lat, lng, k=6, max_distance_km=50.0, power=2.0, max_age=None, exact_km=0.5):
+        """
+        Inverse-distance-weighted AQI at (lat, lng) from up to `k` neighbours
+        within `max_distance_km`. Returns (aqi, [(distance_km, Point)]); aqi is
+        None when there are no neighbours.
+        """
+        neighbours = [
+            (d, p) for d, p in self.nearest(lat, lng, k, max_distance_km, max_age)
+            if p.aqi is not None
+        ]
+        if not neighbours:
+            return None, []
+        if neighbours[0][0] <= exact_km:
+            return float(neighbours[0][1].aqi), neighbours[:1]
+        weights = [1.0 / d ** power for d, _ in neighbours]
+        aqi = sum(w * p.aqi for w, (_, p) in zip(weights, neighbours)) / sum(weights)
+        return aqi, neighbours
@@ -0,0 +1,239 @@
+"""AQI raster tiles for the map and globe views (/api/tiles/{z}/{x}/{y}).
+
+A tile is a small Web Mercator raster interpolated (inverse-distance, in one
+vectorized pass) from AQI samples: a regular grid of upstream cells over the
+tile, fetched in batched calls, plus every known point inside it. Encoded
+tiles are cached as bytes in a memory LRU and on disk; both are keyed by the
+upstream hour, so they invalidate when Open-Meteo publishes new values.
+"""
+import asyncio
+import math
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from cache import TTLCache, seconds_until_upstream_update
+
+MAX_ZOOM = 10
+NO_DATA = 0xFFFF
+FORMATS = {"png": "image/png", "u16": "application/octet-stream"}
+
+# EPA AQI colours at the category breakpoints, blended in between
+_COLOR_STOPS = np.array([0, 50, 100, 150, 200, 300, 500], dtype=np.float64)
+_COLORS = np.array([
+    (0, 228, 0), (255, 255, 0), (255, 126, 0), (255, 0, 0), (143, 63, 151), (126, 0, 35), (126, 0, 35),
+], dtype=np.float64)
+
+
+def tile_bounds(z, x, y):
+    """(south, west, north, east) of a Web Mercator tile."""
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return south, west, north, east
+
+
+def pixel_centers(z, x, y, size):
+    """(size, size) arrays of pixel-centre latitudes and longitudes, row 0 at the top."""
+    n = 2 ** z
+    t = (np.arange(size) + 0.5) / size
+    lng = (x + t) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + t) / n))))
+    return np.meshgrid(lat, lng, indexing="ij")
+
+
+def sample_grid(bounds, per_side):
+    """Evenly spaced (lat, lng) sample points covering a tile (cell centres of a per_side grid)."""
+    south, west, north, east = bounds
+    t = (np.arange(per_side) + 0.5) / per_side
+    return [(south + (north - south) * a, west + (east - west) * b) for a in t for b in t]
+
+
+def idw_grid(lat, lng, sample_lat, sample_lng, sample_value, power=2.0, chunk=2048):
+    """
+    Inverse-distance-weighted values at every (lat, lng) pixel from scattered samples,
+    using local equirectangular distances. NaN where there are no samples.
+    """
+    out = np.full(lat.shape, np.nan, dtype=np.float32)
+    if len(sample_value) == 0:
+        return out
+    flat_lat, flat_lng, flat_out = lat.ravel(), lng.ravel(), out.reshape(-1)
+    s_lat = np.asarray(sample_lat, dtype=np.float32)[None, :]
+    s_lng = np.asarray(sample_lng, dtype=np.float32)[None, :]
+    s_val = np.asarray(sample_value, dtype=np.float32)
+    for start in range(0, flat_lat.size, chunk):
+        p_lat = flat_lat[start:start + chunk, None].astype(np.float32)
+        p_lng = flat_lng[start:start + chunk, None].astype(np.float32)
+        dlng = (p_lng - s_lng + 180) % 360 - 180
+        dx = dlng * np.cos(np.radians((p_lat + s_lat) / 2))
+        d2 = dx * dx + (p_lat - s_lat) ** 2
+        w = 1.0 / np.maximum(d2, 1e-12) ** (power / 2)
+        flat_out[start:start + chunk] = (w @ s_val) / w.sum(axis=1)
+    return out
+
+
+def colorize(aqi, alpha=200):
+    """(h, w) AQI -> (h, w, 4) uint8 RGBA; NaN becomes transparent."""
+    rgba = np.zeros(aqi.shape + (4,), dtype=np.uint8)
+    valid = ~np.isnan(aqi)
+    values = np.clip(aqi[valid], 0, 500)
+    for c in range(3):
+        rgba[..., c][valid] = np.interp(values, _COLOR_STOPS, _COLORS[:, c]).astype(np.uint8)
+    rgba[..., 3][valid] = alpha
+    return rgba
+
+
+def encode_png(rgba):
+    """Minimal RGBA PNG encoder (no imaging library needed)."""
+    height, width = rgba.shape[:2]
+    # Filter type 0 (None) in front of every row
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, -1)], axis=1)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def encode_u16(aqi):
+    """Row-major little-endian uint16 AQI, NO_DATA (65535) where unknown."""
+    out = np.full(aqi.shape, NO_DATA, dtype="<u2")
+    valid = ~np.isnan(aqi)
+    out[valid] = np.clip(np.rint(aqi[valid]), 0, NO_DATA - 1)
+    return out.tobytes()
+
+
+def render_tile(z, x, y, samples, size, fmt):
+    """Encode a tile from [(lat, lng, aqi)] samples."""
+    lat, lng = pixel_centers(z, x, y, size)
+    if samples:
+        s_lat, s_lng, s_val = (np.array(column, dtype=np.float64) for column in zip(*samples))
+    else:
+        s_lat = s_lng = s_val = np.empty(0)
+    aqi = idw_grid(lat, lng, s_lat, s_lng, s_val)
+    return encode_png(colorize(aqi)) if fmt == "png" else encode_u16(aqi)
+
+
+def upstream_epoch(offset=300, now=None):
+    """Counter that increases at every hourly upstream update (top of hour + offset)."""
+    return int(((now or time.time()) - offset) // 3600)
+
+
+class DiskTileCache:
+    """
+    Tiles as files under root/<epoch>/, evicted least recently used beyond
+    `max_bytes`. Directories of past epochs are removed when a new one starts.
+    """
+
+    def __init__(self, root, max_bytes=256 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self._epoch = None
+        self._lock = threading.Lock()
+
+    def _path(self, epoch, key):
+        z, x, y, fmt = key
+        return os.path.join(self.root, str(epoch), str(z), str(x), f"{y}.{fmt}")
+
+    def _roll(self, epoch):
+        if epoch == self._epoch:
+            return
+        self._epoch = epoch
+        self._lru.clear()
+        self._bytes = 0
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                if name != str(epoch):
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def get(self, epoch, key):
+        with self._lock:
+            self._roll(epoch)
+            path = self._path(epoch, key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                return None
+            if key not in self._lru:
+                # Written before a restart
+                self._bytes += len(data)
+            self._lru[key] = len(data)
+            self._lru.move_to_end(key)
+            return data
+
+    def put(self, epoch, key, data):
+        with self._lock:
+            self._roll(epoch)
+            path = self._path(epoch, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self._bytes += len(data) - self._lru.pop(key, 0)
+            self._lru[key] = len(data)
+            while self._bytes > self.max_bytes and self._lru:
+                old, size = self._lru.popitem(last=False)
+                self._bytes -= size
+                try:
+                    os.remove(self._path(epoch, old))
+                except OSError:
+                    pass
+
+
+class TileService:
+    """
+    `sample(bounds, points)` is an async callable returning [(lat, lng, aqi)] for a
+    tile's bounding box, given the regular sample points to fetch.
+    """
+
+    def __init__(self, sample, size=64, samples_per_side=8, memory_size=2048,
+                 disk_dir=None, disk_bytes=256 * 1024 * 1024, ttl_offset=300):
+        self.sample = sample
+        self.size = size
+        self.samples_per_side = samples_per_side
+        self.ttl_offset = ttl_offset
+        self.memory = TTLCache(maxsize=memory_size)
+        self.disk = DiskTileCache(disk_dir, disk_bytes) if disk_dir else None
+        self.rendered = 0
+
+    async def get(self, z, x, y, fmt="png"):
+        """Encoded tile bytes; concurrent requests for the same tile share one render."""
+        epoch = upstream_epoch(self.ttl_offset)
+        key = (z, x, y, fmt)
+        data, complete = await self.memory.get_or_fetch(
+            (epoch,) + key,
+            lambda: self._load(epoch, key),
+            ttl=lambda: seconds_until_upstream_update(self.ttl_offset),
+        )
+        if not complete:
+            # Rendered without any data (upstream down): do not keep it for the hour
+            self.memory.delete((epoch,) + key)
+        return data
+
+    async def _load(self, epoch, key):
+        if self.disk is not None:
+            data = await asyncio.to_thread(self.disk.get, epoch, key)
+            if data is not None:
+                return data, True
+        z, x, y, fmt = key
+        bounds = tile_bounds(z, x, y)
+        samples = await self.sample(bounds, sample_grid(bounds, self.samples_per_side))
+        data = await asyncio.to_thread(render_tile, z, x, y, samples, self.size, fmt)
+        self.rendered += 1
+        if self.disk is not None and samples:
+            await asyncio.to_thread(self.disk.put, epoch, key, data)
+        return data, bool(samples)
@@ -0,0 +1,303 @@
+"""Shared, pooled HTTP clients for the upstream APIs (Open-Meteo, Nominatim).
+
+One httpx.AsyncClient per upstream is created at app startup and closed at
+shutdown, so requests reuse keep-alive connections instead of paying a new
+TCP/TLS handshake every time. Limits and timeouts can be tuned per upstream
+through environment variables, e.g. AIRZEN_OPEN_METEO_MAX_CONNECTIONS=200.
+
+Calls made through `UpstreamPool.get` are retried with jittered backoff on
+transient failures and go through a per-upstream circuit breaker, so an
+outage makes callers fail fast instead of each waiting out the timeouts.
+"""
+import asyncio
+import os
+import random
+import time
+
+import httpx
+
+from metrics import registry
+
+# HTTP/2 needs the optional `h2` package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def _env(name, key, default, cast):
+    value = os.environ.get(f"AIRZEN_{name.upper()}_{key}")
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        print(f"Invalid value for AIRZEN_{name.upper()}_{key}: {value!r}, using {default}")
+        return default
+
+
+# Defaults for each upstream; every key can be overridden via AIRZEN_<NAME>_<KEY>
+UPSTREAMS = {
+    "open_meteo": {
+        "url": "https://air-quality-api.open-meteo.com",
+        "timeout": 5.0,
+        "connect_timeout": 1.5,
+        "max_connections": 100,
+        "max_keepalive": 20,
+        "keepalive_expiry": 30.0,
+        "headers": {},
+        "retries": 2,
+        "backoff": 0.2,
+        "backoff_max": 1.0,
+        "deadline": 8.0,
+        "failure_threshold": 5,
+        "reset_timeout": 30.0,
+    },
+    "nominatim": {
+        "url": "https://nominatim.openstreetmap.org",
+        "timeout": 10.0,
+        "connect_timeout": 5.0,
+        "max_connections": 10,
+        "max_keepalive": 5,
+        "keepalive_expiry": 30.0,
+        "headers": {"User-Agent": "AirZen-AQI-App/1.0"},
+        # Retries would spend extra requests of the 1 req/s budget
+        "retries": 0,
+        "backoff": 0.5,
+        "backoff_max": 2.0,
+        "deadline": 10.0,
+        "failure_threshold": 5,
+        "reset_timeout": 60.0,
+    },
+}
+
+
+def upstream_settings(name):
+    """Resolve the settings for an upstream, applying environment overrides."""
+    defaults = UPSTREAMS[name]
+    return {
+        "url": _env(name, "URL", defaults["url"], str),
+        "timeout": _env(name, "TIMEOUT", defaults["timeout"], float),
+        "connect_timeout": _env(name, "CONNECT_TIMEOUT", defaults["connect_timeout"], float),
+        "max_connections": _env(name, "MAX_CONNECTIONS", defaults["max_connections"], int),
+        "max_keepalive": _env(name, "MAX_KEEPALIVE", defaults["max_keepalive"], int),
+        "keepalive_expiry": _env(name, "KEEPALIVE_EXPIRY", defaults["keepalive_expiry"], float),
+        "headers": defaults["headers"],
+        "retries": _env(name, "RETRIES", defaults["retries"], int),
+        "backoff": _env(name, "BACKOFF", defaults["backoff"], float),
+        "backoff_max": _env(name, "BACKOFF_MAX", defaults["backoff_max"], float),
+        "deadline": _env(name, "DEADLINE", defaults["deadline"], float),
+        "failure_threshold": _env(name, "FAILURE_THRESHOLD", defaults["failure_threshold"], int),
+        "reset_timeout": _env(name, "RESET_TIMEOUT", defaults["reset_timeout"], float),
+    }
+
+
+def build_client(name):
+    settings = upstream_settings(name)
+    return httpx.AsyncClient(
+        base_url=settings["url"],
+        headers=settings["headers"],
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+        limits=httpx.Limits(
+            max_connections=settings["max_connections"],
+            max_keepalive_connections=settings["max_keepalive"],
+            keepalive_expiry=settings["keepalive_expiry"],
+        ),
+    )
+
+
+class UpstreamError(Exception):
+    """An upstream answered with a retryable error status (5xx or 429)."""
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures; while open, calls fail
+    fast with CircuitOpen. After `reset_timeout` seconds a single trial call is
+    let through (half-open): success closes the circuit, failure re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        """Raise CircuitOpen unless a call may go out now."""
+        if self.opened_at is None:
+            return
+        retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+        if retry_in > 0 or self._trial:
+            raise CircuitOpen(f"{self.name} circuit open, retrying in {max(retry_in, 0):.0f}s")
+        self._trial = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """The call ended without a verdict (e.g. it was cancelled)."""
+        self._trial = False
+
+
+UPSTREAM_SECONDS = registry.histogram(
+    "airzen_upstream_request_seconds", "Upstream call duration per attempt", ("upstream", "outcome")
+)
+UPSTREAM_REJECTED = registry.counter(
+    "airzen_upstream_rejected_total", "Calls failed fast by an open circuit breaker", ("upstream",)
+)
+
+
+def backoff_delay(attempt, base, cap):
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class UpstreamPool:
+    """Holds one long-lived AsyncClient and circuit breaker per upstream."""
+
+    def __init__(self):
+        self._clients = {}
+        self._settings = {}
+        self._breakers = {}
+
+    async def start(self):
+        for name in UPSTREAMS:
+            if name not in self._clients:
+                self._clients[name] = build_client(name)
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def client(self, name):
+        # Created lazily as well, for runtimes that skip the lifespan events
+        # (e.g. some serverless adapters).
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = build_client(name)
+        return client
+
+    def settings(self, name):
+        if name not in self._settings:
+            self._settings[name] = upstream_settings(name)
+        return self._settings[name]
+
+    def breaker(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            settings = self.settings(name)
+            breaker = self._breakers[name] = CircuitBreaker(
+                name, settings["failure_threshold"], settings["reset_timeout"]
+            )
+        return breaker
+
+    async def get(self, name, path, **kwargs):
+        """
+        GET from an upstream through its circuit breaker. Connection errors,
+        timeouts, 5xx and 429 are retried with jittered backoff while the
+        upstream's deadline allows; other responses are returned as they are.
+        """
+        settings = self.settings(name)
+        breaker = self.breaker(name)
+        deadline = time.monotonic() + settings["deadline"]
+        attempt = 0
+        while True:
+            try:
+                breaker.before_call()
+            except CircuitOpen:
+                UPSTREAM_REJECTED.inc((name,))
+                raise
+            # Later attempts only get what is left of the deadline
+            remaining = max(deadline - time.monotonic(), 0.1)
+            timeout = httpx.Timeout(
+                min(settings["timeout"], remaining), connect=min(settings["connect_timeout"], remaining)
+            )
+            start = time.perf_counter()
+            try:
+                response = await self.client(name).get(path, timeout=timeout, **kwargs)
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, (name, str(response.status_code)))
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise UpstreamError(f"{name} returned HTTP {response.status_code}")
+            except (httpx.TransportError, UpstreamError) as e:
+                if isinstance(e, httpx.TransportError):
+                    UPSTREAM_SECONDS.observe(time.perf_counter() - start, (name, type(e).__name__))
+                breaker.record_failure()
+                delay = backoff_delay(attempt, settings["backoff"], settings["backoff_max"])
+                if attempt >= settings["retries"] or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            return response
+
+
+upstreams = UpstreamPool()
+
+registry.collector(
+    "airzen_upstream_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)",
+    lambda: {(name,): {"closed": 0, "half_open": 1, "open": 2}[b.state] for name, b in upstreams._breakers.items()},
+    labels=("upstream",),
+)
+
+
+class RateLimited(Exception):
+    """Raised when an upstream call would have to wait longer than allowed for a token."""
+
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, holding at most `burst`.
+    Waiters reserve their slot up front (the balance may go negative), so
+    concurrent callers are spaced out fairly without holding a lock while sleeping.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, max_wait=None):
+        """Take one token, sleeping until its slot; RateLimited if that is more than max_wait away."""
+        self._refill()
+        wait = max(0.0, (1 - self._tokens) / self.rate)
+        if max_wait is not None and wait > max_wait:
+            raise RateLimited(f"Upstream rate limit: next slot in {wait:.1f}s")
+        self._tokens -= 1
+        if wait > 0:
+            await asyncio.sleep(wait)